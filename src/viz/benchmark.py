@@ -0,0 +1,324 @@
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import utils
+
+script_dir_path = os.path.dirname(os.path.realpath(__file__))
+benchmarks_dir_path = os.path.join(utils.cache_dir_path, 'benchmarks')
+
+# Scale points of every builder, the parameters of the synthetic data generators
+default_scales = {
+    'covid': [{'regions': 250, 'rows_per_region': 4}, {'regions': 1000, 'rows_per_region': 4}],
+    'gdp': [{'regions': 250, 'years': 60}, {'regions': 250, 'years': 120}, {'regions': 1000, 'years': 60}],
+    'sf_crime': [{'incidents': 2000}, {'incidents': 20000}, {'incidents': 100000}],
+    'uk_accidents': [{'rows': 100000, 'years': 1}, {'rows': 400000, 'years': 4}]
+}
+
+# The published page of every builder
+output_filenames = {
+    'covid': 'COVID-19_viz.html',
+    'gdp': 'GDP_viz.html',
+    'sf_crime': 'SF_crime_viz.html',
+    'uk_accidents': 'UK_accidents_viz.html'
+}
+
+'''
+Synthetic data generators, writing files in the same layout as the real datasets
+'''
+def _region_codes(n_regions):
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    index = np.arange(n_regions)
+    return [''.join(code) for code in zip(letters[index // 676 % 26], letters[index // 26 % 26], letters[index % 26])]
+
+def generate_borders(path, regions, vertices=64, seed=0) -> pd.DataFrame:
+    '''
+    Write a borders geojson with the given number of regions, jagged polygons laid out on a world-wide grid.
+    Returns the names and the codes of the regions
+    '''
+    rng = np.random.default_rng(seed)
+    columns = int(np.ceil(np.sqrt(regions * 2)))
+    rows = int(np.ceil(regions / columns))
+    cell_width, cell_height = 360 / columns, 135 / rows
+    codes = _region_codes(regions)
+    names = ['Region ' + code for code in codes]
+
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    features = []
+    for i in range(regions):
+        center_lon = -180 + (i % columns + 0.5) * cell_width
+        center_lat = -60 + (i // columns + 0.5) * cell_height
+        radii = 0.45 * rng.uniform(0.7, 1.0, vertices)
+        ring = np.column_stack([center_lon + radii * np.cos(angles) * cell_width,
+                                center_lat + radii * np.sin(angles) * cell_height])
+        ring = np.vstack([ring, ring[:1]])
+        features.append({'type': 'Feature',
+                         'properties': {'ADMIN': names[i], 'ISO_A3': codes[i], 'ISO_A2': codes[i][:2]},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring.tolist()]}})
+
+    with open(path, 'w') as file:
+        json.dump({'type': 'FeatureCollection', 'features': features}, file)
+    return pd.DataFrame({'name': names, 'code': codes})
+
+def generate_covid_data(path, regions, rows_per_region=4, date='11-27-2020', seed=0):
+    '''
+    Write a JHU CSSE daily report with a few provinces for every region
+    '''
+    rng = np.random.default_rng(seed)
+    n_rows = len(regions) * rows_per_region
+    confirmed = rng.lognormal(8, 2.5, n_rows).astype(np.int64)
+    deaths = (confirmed * rng.uniform(0, 0.05, n_rows)).astype(np.int64)
+    recovered = (confirmed * rng.uniform(0, 0.8, n_rows)).astype(np.int64)
+    df = pd.DataFrame({
+        'FIPS': np.nan,
+        'Admin2': np.nan,
+        'Province_State': ['Province ' + str(i % rows_per_region) for i in range(n_rows)],
+        'Country_Region': np.repeat(regions['name'].to_numpy(), rows_per_region),
+        'Last_Update': datetime.strptime(date, '%m-%d-%Y').strftime('%Y-%m-%d 05:25:55'),
+        'Lat': rng.uniform(-60, 75, n_rows),
+        'Long_': rng.uniform(-180, 180, n_rows),
+        'Confirmed': confirmed,
+        'Deaths': deaths,
+        'Recovered': recovered,
+        'Active': confirmed - deaths - recovered,
+        'Combined_Key': '',
+        'Incident_Rate': rng.lognormal(6, 1.5, n_rows),
+        'Case_Fatality_Ratio': deaths / np.maximum(confirmed, 1) * 100
+    })
+    df.to_csv(os.path.join(path, 'covid_' + date + '.csv'), index=False)
+
+def generate_gdp_data(path, regions, years=60, end_year=2019, missing=0.1, seed=0):
+    '''
+    Write a World Bank GDP per capita CSV with a random walk per region over the given number of years
+    '''
+    rng = np.random.default_rng(seed)
+    year_columns = [str(year) for year in range(end_year - years + 1, end_year + 1)]
+    start = rng.lognormal(7, 1.5, (len(regions), 1))
+    values = start * np.exp(np.cumsum(rng.normal(0.02, 0.08, (len(regions), years)), axis=1))
+    values[rng.random(values.shape) < missing] = np.nan
+
+    df = pd.DataFrame(values, columns=year_columns)
+    df.insert(0, 'Country Name', regions['name'].to_numpy())
+    df.insert(1, 'Country Code', regions['code'].to_numpy())
+    df.insert(2, 'Indicator Name', 'GDP per capita (current US$)')
+    df.insert(3, 'Indicator Code', 'NY.GDP.PCAP.CD')
+    df[str(end_year + 1)] = np.nan
+
+    with open(path, 'w') as file:
+        file.write('"Data Source","World Development Indicators",\n\n"Last Updated Date","2020-10-15",\n\n')
+        df.to_csv(file, index=False)
+
+def generate_sf_crime_data(path, incidents, days=7, seed=0):
+    '''
+    Write a SFPD incident reports CSV with the given number of incidents over the last days
+    '''
+    rng = np.random.default_rng(seed)
+    end = datetime(2020, 11, 27)
+    incident_datetimes = pd.to_datetime(end) - pd.to_timedelta(rng.uniform(0, days * 86400, incidents), unit='s')
+    incident_datetimes = incident_datetimes.floor('min')
+    descriptions = ['Theft, From Locked Vehicle, >$950', 'Battery', 'Malicious Mischief, Vandalism to Property',
+                    'Burglary, Residence, Forcible Entry', 'Stolen Automobile', 'Lost Property', 'Warrant Arrest, Enroute To Outside Jurisdiction']
+    df = pd.DataFrame({
+        'incident_datetime': incident_datetimes.strftime('%Y-%m-%dT%H:%M:%S.000'),
+        'incident_date': incident_datetimes.strftime('%Y-%m-%dT00:00:00.000'),
+        'incident_day_of_week': incident_datetimes.strftime('%A'),
+        'row_id': np.arange(incidents) + 10**10,
+        'incident_description': rng.choice(descriptions, incidents),
+        'incident_category': rng.choice(['Larceny Theft', 'Assault', 'Malicious Mischief', 'Burglary', 'Motor Vehicle Theft',
+                                         'Lost Property', 'Warrant'], incidents),
+        'latitude': rng.normal(37.76, 0.025, incidents),
+        'longitude': rng.normal(-122.43, 0.03, incidents)
+    })
+    df.to_csv(path)
+
+def generate_accidents_data(path, rows, years=1, end_year=2015, seed=0):
+    '''
+    Write a UK accidents CSV with the given number of rows spread over the years, clustered around a few cities
+    '''
+    rng = np.random.default_rng(seed)
+    cities = np.array([[51.51, -0.13], [52.49, -1.89], [53.48, -2.24], [53.80, -1.55], [55.86, -4.25], [51.45, -2.59]])
+    city = rng.integers(0, len(cities), rows)
+    start = np.datetime64(str(end_year - years + 1) + '-01-01')
+    days = (np.datetime64(str(end_year + 1) + '-01-01') - start).astype(np.int64)
+    df = pd.DataFrame({
+        'Accident_Index': np.arange(rows),
+        'Longitude': cities[city, 1] + rng.normal(0, 0.3, rows),
+        'Latitude': cities[city, 0] + rng.normal(0, 0.2, rows),
+        'Accident_Severity': rng.choice([1, 2, 3], rows, p=[0.02, 0.18, 0.8]),
+        'Date': (start + rng.integers(0, days, rows)).astype(str),
+        'Time': pd.Series(rng.integers(0, 24, rows)).map('{:02d}'.format) + ':' + pd.Series(rng.integers(0, 60, rows)).map('{:02d}'.format)
+    })
+    df.to_csv(path, index=False)
+
+def generate_data(builder, scale, directory):
+    '''
+    Write the synthetic inputs of a builder at a scale point into the directory
+    '''
+    if builder in ['covid', 'gdp']:
+        regions = generate_borders(os.path.join(directory, 'borders_geo.json'), scale['regions'])
+    if builder == 'covid':
+        generate_covid_data(directory, regions, rows_per_region=scale.get('rows_per_region', 4))
+    elif builder == 'gdp':
+        generate_gdp_data(os.path.join(directory, 'GDP_per_capita_world_data.csv'), regions, years=scale['years'])
+    elif builder == 'sf_crime':
+        generate_sf_crime_data(os.path.join(directory, 'last_week_SF_crimes.csv'), scale['incidents'])
+    elif builder == 'uk_accidents':
+        generate_accidents_data(os.path.join(directory, 'Accidents1115.csv'), scale['rows'], years=scale['years'])
+    else:
+        raise ValueError('Unknown builder: ' + str(builder))
+
+'''
+Benchmark runs
+'''
+def _init_benchmark_worker():
+    if script_dir_path not in sys.path:
+        sys.path.append(script_dir_path)
+
+def _peak_rss_mb() -> float:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def _run_build(builder, scale, directory) -> dict:
+    '''
+    Point the viz modules at the synthetic data and run the build, in a fresh process of its own
+    so that the peak RSS belongs to this build alone
+    '''
+    import geometry_store, stage_cache, publish, instrumentation
+    import covid_viz, gdp_viz, sf_crime_viz, uk_accidents_viz
+
+    cache_dir = os.path.join(directory, 'cache')
+    geometry_store.geojson_path = os.path.join(directory, 'borders_geo.json')
+    geometry_store.cache_path = os.path.join(cache_dir, 'borders_geo.pkl')
+    geometry_store.cache_meta_path = os.path.join(cache_dir, 'borders_geo.json')
+    stage_cache.stage_cache = stage_cache.StageCache(os.path.join(cache_dir, 'stages'))
+    publish.artifacts_dir_path = os.path.join(directory, 'artifacts')
+    publish.resources_dir_path = os.path.join(directory, 'artifacts', 'resources')
+    instrumentation.runs_dir_path = os.path.join(cache_dir, 'runs')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    if builder == 'covid':
+        covid_viz.data_dir_path = directory
+        build = lambda: covid_viz.create_covid_viz(force=True)
+    elif builder == 'gdp':
+        gdp_viz.df_GDP_path = os.path.join(directory, 'GDP_per_capita_world_data.csv')
+        build = gdp_viz.create_gdp_viz
+    elif builder == 'sf_crime':
+        sf_crime_viz.store_dir_path = os.path.join(directory, 'sf_crime_store')
+        sf_crime_viz.seed_csv_path = os.path.join(directory, 'last_week_SF_crimes.csv')
+        build = sf_crime_viz.create_sf_crime_viz
+    else:
+        uk_accidents_viz.df_accidents_path = os.path.join(directory, 'Accidents1115.csv')
+        uk_accidents_viz.accidents_cache_path = os.path.join(cache_dir, 'accidents')
+        build = lambda: uk_accidents_viz.create_uk_accidents_viz(start_year=2015 - scale['years'] + 1, end_year=2015)
+
+    rss_before = _peak_rss_mb()
+    start = time.perf_counter()
+    # The builds are chatty, their output is of no interest here
+    with contextlib.redirect_stdout(io.StringIO()):
+        build()
+    wall_time = time.perf_counter() - start
+
+    return {'wall_time': wall_time,
+            'peak_rss_mb': _peak_rss_mb(),
+            'baseline_rss_mb': rss_before,
+            'html_bytes': os.path.getsize(publish.get_published_path(output_filenames[builder])),
+            'payload': {component: entry['bytes'] for component, entry
+                        in publish.get_published(output_filenames[builder])['payload']['components'].items()}}
+
+def run_case(builder, scale) -> dict:
+    '''
+    Generate the inputs of a scale point and benchmark a cold build of them
+    '''
+    result = {'builder': builder, 'scale': scale, 'status': 'ok'}
+    directory = tempfile.mkdtemp(prefix='viz-benchmark-')
+    try:
+        generate_data(builder, scale, directory)
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_benchmark_worker) as pool:
+            result.update(pool.submit(_run_build, builder, scale, directory).result())
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=script_dir_path,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(builders=None, scales=None, output_path=None) -> dict:
+    '''
+    Benchmark the builders at their scale points and save the results as JSON, by default into
+    data/cache/benchmarks named after the current commit. Everything runs offline on synthetic data
+    '''
+    scales = scales or default_scales
+    builders = builders or list(scales)
+    commit = _git_commit()
+    report = {'commit': commit,
+              'created_at': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': []}
+
+    for builder in builders:
+        for scale in scales[builder]:
+            result = run_case(builder, scale)
+            report['results'].append(result)
+            if result['status'] == 'ok':
+                print('{} {}: {:.2f}s, peak RSS {:.0f}MB, {:.1f}KB of HTML'.format(builder, scale, result['wall_time'],
+                                                                              result['peak_rss_mb'], result['html_bytes'] / 1024))
+            else:
+                print('{} {}: failed - {}'.format(builder, scale, result['error']))
+
+    if output_path is None:
+        os.makedirs(benchmarks_dir_path, exist_ok=True)
+        output_path = os.path.join(benchmarks_dir_path, (commit or datetime.now().strftime('%Y%m%dT%H%M%S')) + '.json')
+    with open(output_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('Saved the benchmark results to ' + output_path)
+    return report
+
+def compare_benchmarks(baseline_path, current_path, tolerance=0.1) -> list:
+    '''
+    Compare two saved benchmark runs and return the metrics that got worse by more than the tolerance
+    '''
+    with open(baseline_path, 'r') as file:
+        baseline = {(result['builder'], json.dumps(result['scale'], sort_keys=True)): result for result in json.load(file)['results']}
+    with open(current_path, 'r') as file:
+        current = json.load(file)['results']
+
+    regressions = []
+    for result in current:
+        previous = baseline.get((result['builder'], json.dumps(result['scale'], sort_keys=True)))
+        if previous is None or result['status'] != 'ok' or previous['status'] != 'ok':
+            continue
+        for metric in ['wall_time', 'peak_rss_mb', 'html_bytes']:
+            ratio = result[metric] / previous[metric] if previous[metric] else 1
+            print('{} {} {}: {:.3g} -> {:.3g} ({:+.1%})'.format(result['builder'], result['scale'], metric,
+                                                               previous[metric], result[metric], ratio - 1))
+            if ratio > 1 + tolerance:
+                regressions.append({'builder': result['builder'], 'scale': result['scale'], 'metric': metric, 'ratio': ratio})
+    return regressions
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        # Compare two saved runs: benchmark.py baseline.json current.json
+        sys.exit(1 if compare_benchmarks(sys.argv[1], sys.argv[2]) else 0)
+    run_benchmarks(builders=sys.argv[1:] or None)
@@ -0,0 +1,186 @@
+import numpy as np
+from shapely.ops import transform as shapely_transform
+from branca.element import Template, MacroElement
+import streaming
+
+# Metres per degree of latitude, for the positional errors of the coordinate encodings
+METRES_PER_DEGREE = 111320
+
+# Whether the encoders measure the bytes saved by default. Measuring serializes everything encoded twice more,
+# the payload profile of the published page already has the sizes of its components
+MEASURE_SIZES = False
+
+def _json_size(value) -> int:
+    return sum(len(chunk) for chunk in streaming.iter_json(value))
+
+def _polyline(values) -> str:
+    '''
+    Encode a sequence of integers as polyline characters, 5 bits per character with a continuation bit
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return ''
+    zigzag = ((values << 1) ^ (values >> 63)).astype(np.uint64)
+    chunks = max(1, -(-int(zigzag.max()).bit_length() // 5))
+    characters = np.zeros((len(values), chunks), dtype=np.uint8)
+    valid = np.zeros((len(values), chunks), dtype=bool)
+    for k in range(chunks):
+        rest = zigzag >> np.uint64(5 * k)
+        more = (rest >> np.uint64(5)) != 0
+        characters[:, k] = ((rest & np.uint64(31)) + more.astype(np.uint64) * np.uint64(32) + np.uint64(63)).astype(np.uint8)
+        valid[:, k] = (k == 0) | (rest != 0)
+    return characters[valid].tobytes().decode('ascii')
+
+# Client side decoder of the encoded coordinates, turning them back into [lat, lon(, weight)] arrays
+coordinate_decoder_template = '''
+{% macro header(this, kwargs) %}
+<script>
+function decodeCoordinates(encoded) {
+    if (Array.isArray(encoded)) { return encoded; }
+    var scale = Math.pow(10, encoded.precision), values = encoded.values;
+    if (encoded.encoding === 'polyline') {
+        values = [];
+        for (var i = 0; i < encoded.values.length;) {
+            var result = 0, factor = 1, code;
+            do {
+                code = encoded.values.charCodeAt(i++) - 63;
+                result += (code & 31) * factor;
+                factor *= 32;
+            } while (code >= 32);
+            values.push(result % 2 ? -(result + 1) / 2 : result / 2);
+        }
+    }
+    var points = new Array(values.length / 2), lat = 0, lon = 0, weights = encoded.weights;
+    for (var k = 0; k < points.length; k++) {
+        lat += values[2 * k];
+        lon += values[2 * k + 1];
+        points[k] = weights ? [lat / scale, lon / scale, weights[k]] : [lat / scale, lon / scale];
+    }
+    return points;
+}
+function decodeCoordinateFrames(frames) { return frames.map(decodeCoordinates); }
+</script>
+{% endmacro %}
+'''
+
+class CoordinateEncoder:
+    '''
+    Encoding of the [lat, lon] coordinates embedded in the maps. 'fixed' rounds them to `precision` decimals,
+    'delta' writes them as integer steps of 10^-precision from the previous point, and 'polyline' writes those
+    steps as a polyline string. The delta and polyline encodings are decoded on the client by the shim
+    which add_decoder adds to a map. The encoder keeps the largest positional error over everything it encodes
+    and, with measure_sizes, adds up the bytes saved over full precision floats, see report
+    '''
+    modes = ['fixed', 'delta', 'polyline']
+
+    def __init__(self, mode='fixed', precision=5, measure_sizes=None):
+        if mode not in self.modes:
+            raise ValueError('Unknown coordinate encoding: ' + str(mode))
+        self.mode = mode
+        self.precision = precision
+        self.measure_sizes = MEASURE_SIZES if measure_sizes is None else measure_sizes
+        self.points = 0
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.max_error = 0.0
+
+    @property
+    def decoded_on_client(self) -> bool:
+        return self.mode != 'fixed'
+
+    def _add_error(self, latitudes, longitudes, decoded_latitudes, decoded_longitudes):
+        if len(latitudes) == 0:
+            return
+        north = (decoded_latitudes - latitudes) * METRES_PER_DEGREE
+        east = (decoded_longitudes - longitudes) * METRES_PER_DEGREE * np.cos(np.radians(latitudes))
+        self.max_error = max(self.max_error, float(np.max(np.hypot(north, east))))
+
+    def encode(self, points, weights=None):
+        '''
+        Encode an array of [lat, lon] points, with an optional weight per point. Returns a JSON serializable
+        value, an array of [lat, lon(, weight)] in the fixed mode, which decodeCoordinates turns into such an array
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self.mode == 'fixed':
+            decoded = np.round(points, self.precision)
+            encoded = decoded if weights is None else np.column_stack([decoded, weights])
+        else:
+            steps = np.round(points * 10**self.precision).astype(np.int64)
+            decoded = steps / 10**self.precision
+            deltas = np.diff(steps, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+            encoded = {'encoding': self.mode, 'precision': self.precision,
+                       'values': deltas if self.mode == 'delta' else _polyline(deltas)}
+            if weights is not None:
+                encoded['weights'] = np.asarray(weights)
+
+        self.points += len(points)
+        if self.measure_sizes:
+            self.raw_bytes += _json_size(points if weights is None else np.column_stack([points, weights]))
+            self.encoded_bytes += _json_size(encoded)
+        self._add_error(points[:, 0], points[:, 1], decoded[:, 0], decoded[:, 1])
+        return encoded
+
+    def encode_frames(self, frames) -> list:
+        '''
+        Encode a list of [lat, lon(, weight)] arrays, decoded on the client by decodeCoordinateFrames
+        '''
+        encoded = []
+        for frame in frames:
+            frame = np.asarray(frame, dtype=np.float64).reshape(len(frame), -1)
+            encoded.append(self.encode(frame[:, :2], frame[:, 2] if frame.shape[1] > 2 else None))
+        return encoded
+
+    def encode_geometries(self, gdf):
+        '''
+        Return a copy of a GeoDataFrame with its coordinates rounded to the precision, whatever the mode,
+        since the GeoJSON layers read the coordinates as they are
+        '''
+        def round_coordinates(x, y, z=None):
+            x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+            rounded_x, rounded_y = np.round(x, self.precision), np.round(y, self.precision)
+            self.points += x.size
+            self._add_error(np.atleast_1d(y), np.atleast_1d(x), np.atleast_1d(rounded_y), np.atleast_1d(rounded_x))
+            return rounded_x, rounded_y
+
+        encoded = gdf.copy()
+        encoded['geometry'] = gdf.geometry.apply(lambda geometry: geometry if geometry is None
+                                                 else shapely_transform(round_coordinates, geometry))
+        if self.measure_sizes:
+            self.raw_bytes += _json_size(gdf)
+            self.encoded_bytes += _json_size(encoded)
+        return encoded
+
+    def add_decoder(self, map_object):
+        '''
+        Add the client side decoder to a map, if the mode needs one
+        '''
+        if self.decoded_on_client:
+            macro = MacroElement()
+            macro._template = Template(coordinate_decoder_template)
+            map_object.get_root().add_child(macro, name='coordinate_decoder')
+
+    def report(self) -> dict:
+        '''
+        Return the encoding, the number of points and the largest positional error, and the bytes saved
+        when they were measured
+        '''
+        report = {'mode': self.mode,
+                  'precision': self.precision,
+                  'points': self.points,
+                  'max_error_m': round(self.max_error, 3)}
+        if self.measure_sizes:
+            saved = self.raw_bytes - self.encoded_bytes
+            report.update(raw_bytes=self.raw_bytes,
+                          encoded_bytes=self.encoded_bytes,
+                          saved_bytes=saved,
+                          saved_ratio=round(saved / self.raw_bytes, 4) if self.raw_bytes else 0.0)
+        return report
+
+    def print_report(self, label):
+        report = self.report()
+        sizes = ''
+        if self.measure_sizes:
+            sizes = ', {:,} -> {:,} bytes ({:.1%} saved)'.format(report['raw_bytes'], report['encoded_bytes'],
+                                                                 report['saved_ratio'])
+        print('Coordinates of {}: {:,} points{} with {} encoding at {} decimals, max error {:.3f} m'.format(
+            label, report['points'], sizes, self.mode, self.precision, report['max_error_m']))
@@ -0,0 +1,115 @@
+import os
+import json
+import numpy as np
+import utils
+
+class CovidSeriesStore:
+    '''
+    Append-only columnar store of the daily COVID-19 reports. Every day is a single (countries x metrics) float32
+    row appended to one raw file, so the whole history reads as a (dates x countries x metrics) array through
+    a memory map and ingesting a day only writes its own row. The state file holds the axes and the date of
+    every row, in the order they were appended
+    '''
+    def __init__(self, directory, countries, metrics):
+        self.directory = directory
+        self.countries = list(countries)
+        self.metrics = list(metrics)
+        self.state_path = os.path.join(directory, 'state.json')
+        self.values_path = os.path.join(directory, 'values.f32')
+
+    @property
+    def row_shape(self) -> tuple:
+        return (len(self.countries), len(self.metrics))
+
+    @property
+    def row_bytes(self) -> int:
+        return len(self.countries) * len(self.metrics) * np.dtype(np.float32).itemsize
+
+    def _read_state(self) -> dict:
+        try:
+            with open(self.state_path, 'r') as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return {'countries': self.countries, 'metrics': self.metrics, 'dates': []}
+        if state['countries'] != self.countries or state['metrics'] != self.metrics:
+            state = self._relayout(state)
+        return state
+
+    def _write_state(self, state):
+        with open(self.state_path + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def _relayout(self, state) -> dict:
+        '''
+        Rewrite the stored rows onto the current country and metric axes, the values of the countries or metrics
+        that weren't stored before being NaN. Only happens when the borders or the metrics change
+        '''
+        dates = state['dates']
+        if dates:
+            old_shape = (len(dates), len(state['countries']), len(state['metrics']))
+            old_values = np.memmap(self.values_path, dtype=np.float32, mode='r', shape=old_shape)
+            old_countries = {name: i for i, name in enumerate(state['countries'])}
+            old_metrics = {name: i for i, name in enumerate(state['metrics'])}
+            country_pairs = [(i, old_countries[name]) for i, name in enumerate(self.countries) if name in old_countries]
+            metric_pairs = [(i, old_metrics[name]) for i, name in enumerate(self.metrics) if name in old_metrics]
+            new_rows, old_rows = np.array([pair[0] for pair in country_pairs], dtype=np.int64), np.array([pair[1] for pair in country_pairs], dtype=np.int64)
+            new_columns, old_columns = np.array([pair[0] for pair in metric_pairs], dtype=np.int64), np.array([pair[1] for pair in metric_pairs], dtype=np.int64)
+            with open(self.values_path + '.tmp', 'wb') as file:
+                for day in range(len(dates)):
+                    row = np.full(self.row_shape, np.nan, dtype=np.float32)
+                    row[np.ix_(new_rows, new_columns)] = old_values[day][np.ix_(old_rows, old_columns)]
+                    file.write(row.tobytes())
+            del old_values
+            os.replace(self.values_path + '.tmp', self.values_path)
+        state = {'countries': self.countries, 'metrics': self.metrics, 'dates': dates}
+        self._write_state(state)
+        return state
+
+    def dates(self) -> list:
+        return sorted(self._read_state()['dates'])
+
+    def has_day(self, date) -> bool:
+        return date in self._read_state()['dates']
+
+    def fingerprint(self) -> str:
+        '''
+        Return a hash identifying the current content of the store, which changes with every ingested day
+        '''
+        state = self._read_state()
+        stat = os.stat(self.values_path) if os.path.exists(self.values_path) else None
+        return utils.hash_inputs(dict(state, size=stat.st_size if stat else 0, mtime=stat.st_mtime if stat else 0))
+
+    def append_day(self, date, values):
+        '''
+        Store the (countries x metrics) values of a day, replacing the ones stored for that date before.
+        The row is written before the state referencing it, so a crash never leaves a dangling date
+        '''
+        values = np.asarray(values, dtype=np.float32).reshape(self.row_shape)
+        os.makedirs(self.directory, exist_ok=True)
+        state = self._read_state()
+        dates = state['dates']
+        row = dates.index(date) if date in dates else len(dates)
+        with open(self.values_path, 'r+b' if os.path.exists(self.values_path) else 'wb') as file:
+            file.seek(row * self.row_bytes)
+            file.write(values.tobytes())
+        if row == len(dates):
+            dates.append(date)
+            self._write_state(state)
+
+    def read(self, days=None) -> tuple:
+        '''
+        Return the sorted dates and their (dates x countries x metrics) values, only the last days of them if given.
+        When the days were appended in order the values are a view on the memory map, so only the rows used get read
+        '''
+        stored_dates = self._read_state()['dates']
+        if not stored_dates:
+            return [], np.empty((0,) + self.row_shape, dtype=np.float32)
+        values = np.memmap(self.values_path, dtype=np.float32, mode='r', shape=(len(stored_dates),) + self.row_shape)
+        order = np.argsort(stored_dates, kind='stable')
+        if days is not None:
+            order = order[-days:]
+        dates = [stored_dates[i] for i in order]
+        if np.all(np.diff(order) == 1):
+            return dates, values[order[0]:order[-1] + 1]
+        return dates, values[order]
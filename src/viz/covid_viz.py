@@ -1,24 +1,39 @@
 import folium
 import os
-import requests
 import utils
+import coordinates
+import publish
+import layers
+import geometry_store
+import stage_cache
+import instrumentation
 import glob
+import tempfile
+from covid_store import CovidSeriesStore
+from datetime import datetime
 import json
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-import branca.colormap as cm
 from branca.element import MacroElement
 from jinja2 import Template
 
 # Important paths
 script_dir_path = os.path.dirname(os.path.realpath(__file__))
 data_dir_path = os.path.join(script_dir_path, '..', 'data')
-geojson_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'borders_geo.json'))
-try:
-    newest_dataset = glob.glob(os.path.join(data_dir_path, 'covid*'))[0]
-except:
-    print('No Covid dataset found in the data folder')
+fetch_metadata_path = os.path.join(utils.cache_dir_path, 'covid_fetch.json')
+listing_path = os.path.join(utils.cache_dir_path, 'covid_daily_reports.json')
+store_dir_path = os.path.join(data_dir_path, 'covid_store')
+
+# Bump whenever the output of the builds changes in a way their sources don't show, so the live page gets rebuilt
+BUILD_VERSION = 1
+
+# Modules whose code shapes the page, hashed into the build inputs so that a deploy changing them triggers a rebuild
+builder_modules = ['covid_viz', 'covid_store', 'utils', 'coordinates', 'layers', 'topology', 'geometry_store', 'streaming']
+
+# JHU CSSE daily reports
+daily_reports_api_url = 'https://api.github.com/repos/CSSEGISandData/COVID-19/contents/csse_covid_19_data/csse_covid_19_daily_reports'
+daily_reports_raw_url = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_daily_reports/'
 
 # Color palettes
 color_dict = {
@@ -29,61 +44,135 @@ color_dict = {
     'Case_Fatality_Ratio': ['#808080','#fff5f0','#fee0d2','#fcbba1','#fc9272','#fb6a4a','#ef3b2c','#cb181d','#a50f15','#67000d']
 }
 
+# Metrics shown on the map, and kept for every day in the time series store
+covid_metrics = ['Confirmed', 'Deaths', 'Active', 'Incident_Rate', 'Case_Fatality_Ratio']
+
 # pandas options
 pd.set_option('display.max_rows', None)
 
-def download_covid_data():
+def get_dataset_date(filename):
+    return datetime.strptime(os.path.basename(filename)[:-len('.csv')].replace('covid_', ''), '%m-%d-%Y')
+
+def load_fetch_metadata() -> dict:
+    try:
+        with open(fetch_metadata_path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+@instrumentation.instrumented('covid_download')
+def download_covid_data(folder_url=daily_reports_api_url, download_base_url=daily_reports_raw_url, history_days=30) -> bool:
     '''
-    Download the latest JHU CSSE COVID-19 dataset from github
+    Download the latest JHU CSSE COVID-19 dataset from github. Both the folder listing and the dataset are
+    fetched conditionally, with their ETag / Last-Modified validators and content hashes recorded in the 
+    fetch metadata. The dataset is ingested into the time series store, together with the reports of the 
+    last history_days which aren't stored yet. Returns True when the newest dataset's content changed,
+    raises utils.DownloadError when the listing or the dataset couldn't be fetched
     '''
+    fetch_metadata = load_fetch_metadata()
+    os.makedirs(utils.cache_dir_path, exist_ok=True)
+    
     # Get information on the newest dataset currently available
-    folder_url = 'https://api.github.com/repos/CSSEGISandData/COVID-19/contents/csse_covid_19_data/csse_covid_19_daily_reports'
     try:
-        req = requests.get(folder_url)
-    except:
-        print('Could not get COVID-19 data from requested URL')
-        return
-        
-    if req.status_code == 200:
-        req = req.json()
-    else:
-        print('Could not get COVID-19 data from requested URL')
-        return
-    
-    global newest_dataset
-    newest_dataset = req[-2]['name']
+        fetch_metadata['listing'] = utils.conditional_download(folder_url, listing_path, previous=fetch_metadata.get('listing'))
+        with open(listing_path, 'r') as file:
+            listing = json.load(file)
+        newest_dataset = max((entry['name'] for entry in listing if entry['name'].endswith('.csv')), key=get_dataset_date)
+    except Exception as e:
+        raise utils.DownloadError('Could not get COVID-19 data from requested URL: ' + str(e)) from e
     print('Latest available dataset: ' + newest_dataset)
 
-    # Check if the newest available dataset on github is newer than the one currently possesed
-    download_url = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_daily_reports/' + newest_dataset
+    # Download the dataset unless the copy from the previous fetch is still current
+    previous = fetch_metadata.get('dataset')
+    if previous is not None and previous.get('name') != newest_dataset:
+        previous = None
     try:
-        utils.download_file(download_url=download_url, location=data_dir_path, 
-                            filename='covid_' + newest_dataset)
-        covid_old_csv = glob.glob(os.path.join(data_dir_path, 'covid*'))
-        for filename in covid_old_csv:
-            if newest_dataset in filename:
-                covid_old_csv.remove(filename)
-        for filename in covid_old_csv:
-            os.remove(filename)
-            
+        dataset = utils.conditional_download(download_base_url + newest_dataset, 
+                                             os.path.join(data_dir_path, 'covid_' + newest_dataset), previous=previous)
     except Exception as e:
-        print(str(e) + '\nCould not fetch newest dataset.')
-        return
+        raise utils.DownloadError('Could not fetch the newest COVID-19 dataset: ' + str(e)) from e
+    dataset['name'] = newest_dataset
+    fetch_metadata['dataset'] = dataset
+    
+    with open(fetch_metadata_path, 'w') as file:
+        json.dump(fetch_metadata, file)
+    
+    # Remove the older datasets, their data is kept by the time series store
+    for filename in glob.glob(os.path.join(data_dir_path, 'covid_*.csv')):
+        if not filename.endswith('covid_' + newest_dataset):
+            os.remove(filename)
+    
+    store = get_covid_store()
+    newest_path = os.path.join(data_dir_path, 'covid_' + newest_dataset)
+    if dataset['changed'] or not store.has_day(get_dataset_day(newest_path)):
+        ingest_covid_report(newest_path, store)
+    backfill_covid_store(listing, history_days, download_base_url, store)
+    
+    if not dataset['changed']:
+        print('The COVID-19 dataset has not changed since the last fetch')
+    return dataset['changed']
+
+def get_builder_hash() -> str:
+    '''
+    Return a hash of the build version and of the source of the builder modules
+    '''
+    sources = {name: utils.file_fingerprint(os.path.join(script_dir_path, name + '.py'))['sha256'] for name in builder_modules}
+    return utils.hash_inputs({'version': BUILD_VERSION, 'sources': sources})
+
+def get_dataset_day(filename) -> str:
+    return get_dataset_date(filename).strftime('%Y-%m-%d')
 
-def create_covid_viz():    
+def backfill_covid_store(listing, days, download_base_url=daily_reports_raw_url, store=None, concurrency=4) -> int:
     '''
-    Load and pre-process the geojson file
+    Ingest the daily reports of the last days of the listing which are missing from the time series store.
+    The reports are downloaded concurrently (at most concurrency at a time) to temporary files, which are 
+    removed once ingested. Returns the number of days ingested
     '''
-    world_geojson = gpd.read_file(geojson_path)
-    world_geojson.drop(columns=['ISO_A2'], inplace=True)
+    store = store or get_covid_store()
+    stored_days = set(store.dates())
+    reports = sorted((entry['name'] for entry in listing if entry['name'].endswith('.csv')), key=get_dataset_date)
+    missing = [name for name in reports[-days:] if days > 0 and get_dataset_day(name) not in stored_days]
     
+    ingested = 0
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, 'covid_' + name) for name in missing]
+        results = utils.download_files([{'url': download_base_url + name, 'path': path} 
+                                        for name, path in zip(missing, paths)], concurrency=concurrency)
+        for name, path, result in zip(missing, paths, results):
+            if isinstance(result, Exception):
+                print(str(result) + '\nCould not fetch the {} dataset.'.format(name))
+                continue
+            ingest_covid_report(path, store)
+            os.remove(path)
+            ingested += 1
+    if ingested:
+        print('Ingested {} past daily reports'.format(ingested))
+    return ingested
+
+def get_newest_dataset() -> str:
     '''
-    Load and pre-process the COVID-19 data
+    Return the path of the newest COVID-19 dataset in the data folder, judging by the date in its name
     '''
-    # Load the COVID-19 data
-    df_covid = pd.read_csv(os.path.join(data_dir_path, 'covid_' + newest_dataset))
-    timestamp = df_covid['Last_Update'][0]
+    datasets = glob.glob(os.path.join(data_dir_path, 'covid_*.csv'))
+    if not datasets:
+        raise FileNotFoundError('No Covid dataset found in the data folder')
+    return max(datasets, key=get_dataset_date)
+
+def load_covid_borders() -> gpd.GeoDataFrame:
+    '''
+    Return the borders with the country names of the COVID-19 data in a 'Country_Region' column, sorted by name
+    '''
+    world_geojson = geometry_store.load_world_borders()
+    world_geojson.replace(to_replace={'ADMIN' : 'Macedonia'}, value='North Macedonia', inplace=True)
     
+    # Change the name of 'ADMIN' column in the geojson DF to match the one in COVID DF
+    world_geojson.rename(columns={'ADMIN': 'Country_Region'}, inplace=True)
+    return world_geojson.sort_values('Country_Region').reset_index(drop=True)
+
+def aggregate_covid_report(df_covid) -> pd.DataFrame:
+    '''
+    Aggregate a daily report per country, the countries being named like in the borders
+    '''
     # Replace some country names
     df_covid.replace(to_replace={'Country_Region' : 'US'}, value='United States of America', inplace=True)
     df_covid.replace(to_replace={'Country_Region' : 'Bahamas'}, value='The Bahamas', inplace=True)
@@ -92,28 +181,54 @@ def create_covid_viz():
     df_covid.replace(to_replace={'Country_Region' : 'Taiwan*'}, value='Taiwan', inplace=True)
     df_covid.replace(to_replace={'Country_Region' : "Cote d'Ivoire"}, value='Ivory Coast', inplace=True)
     df_covid.replace(to_replace={'Country_Region' : "Czechia"}, value='Czech Republic', inplace=True)
-    world_geojson.replace(to_replace={'ADMIN' : 'Macedonia'}, value='North Macedonia', inplace=True)
-    
-    # Change the name of 'ADMIN' column in the geojson DF to match the one in COVID DF
-    world_geojson.rename(columns={'ADMIN': 'Country_Region'}, inplace=True)
     
     # Aggregate the data for countries that have regional information
-    df_covid_agg = df_covid.groupby('Country_Region').agg({'Confirmed': 'sum', 'Deaths': 'sum', 'Recovered': 'sum',
-                                                            'Active': 'sum', 'Incident_Rate': 'mean', 'Case_Fatality_Ratio': 'mean'})
-    world_geojson = world_geojson.sort_values('Country_Region').reset_index(drop=True)
+    return df_covid.groupby('Country_Region').agg({'Confirmed': 'sum', 'Deaths': 'sum', 'Recovered': 'sum',
+                                                   'Active': 'sum', 'Incident_Rate': 'mean', 'Case_Fatality_Ratio': 'mean'})
+
+def get_covid_store() -> CovidSeriesStore:
+    '''
+    Return the local time series store, over the countries of the borders
+    '''
+    return CovidSeriesStore(store_dir_path, countries=load_covid_borders()['Country_Region'], metrics=covid_metrics)
+
+def ingest_covid_report(dataset_path, store=None) -> str:
+    '''
+    Aggregate a daily report and append it to the time series store as the day in its name. Returns that day
+    '''
+    store = store or get_covid_store()
+    df_covid_agg = aggregate_covid_report(pd.read_csv(dataset_path))
+    day = get_dataset_day(dataset_path)
+    store.append_day(day, df_covid_agg.reindex(store.countries)[store.metrics].to_numpy(dtype=np.float32))
+    return day
+
+def join_covid_data(dataset_path):
+    '''
+    Load the borders and the COVID-19 dataset, aggregate the data per country and join it with the borders
+    '''
+    world_geojson = load_covid_borders()
+    
+    # Load the COVID-19 data
+    df_covid = pd.read_csv(dataset_path)
+    timestamp = df_covid['Last_Update'][0]
+    df_covid_agg = aggregate_covid_report(df_covid)
     
     # Join the geojson with the DataFrame
     df_covid_joined = df_covid_agg.merge(world_geojson, how='right', on='Country_Region')
-    
-    # Count min and max values for specific columns
-    min_dict, max_dict = {}, {}
-    column_names = ['Confirmed', 'Deaths', 'Active', 'Incident_Rate', 'Case_Fatality_Ratio']
-    for name in column_names:
-        min_dict[name] = min(df_covid_joined[name])
-        max_dict[name] = max(df_covid_joined[name])
+    return world_geojson, df_covid_joined, timestamp
+
+def classify_covid_data(joined, column_names, k) -> dict:
+    '''
+    Classify all the metrics in one pass, each metric with its own geometrically spaced bins,
+    and add the metric values and their colors to the borders
+    '''
+    world_geojson, df_covid_joined, timestamp = joined
+    metric_values = df_covid_joined[column_names].to_numpy(dtype=float)
+    bins = utils.classify_bins(metric_values, k=k, scheme='geometric', per_column=True)
+    color_index = utils.classify(metric_values, bins)
     
     # Replace NaNs in the DataFrame with '-1'
-    df_covid_joined.fillna(-1, inplace=True)
+    df_covid_joined = df_covid_joined.fillna(-1)
     
     # Add the data columns to geo json for future popup displaying
     world_geojson = world_geojson.assign(Confirmed=df_covid_joined['Confirmed'],
@@ -121,36 +236,171 @@ def create_covid_viz():
                                          Active=df_covid_joined['Active'],
                                          Incident_Rate=df_covid_joined['Incident_Rate'],
                                          Case_Fatality_Ratio=df_covid_joined['Case_Fatality_Ratio'])
-    print(world_geojson)
+    instrumentation.describe_frame('world_geojson', world_geojson)
     
-    # Set the correct index columns
-    df_covid_joined.set_index('Country_Region', inplace=True)
+    # Assign the colors corresponding to the class indices, indexed by the country names
+    colors = pd.DataFrame({name + '_color': np.take(color_dict[name], color_index[:, i]) for i, name in enumerate(column_names)},
+                          index=df_covid_joined['Country_Region'])
     
-    # Create a lists of evenly spaced attribute values over computed min-max intervals and assign corresponding colors to the DataFrame
-    colormap_dict = {}
-    bins = []
+    return {'geojson': world_geojson, 'colors': colors, 'bins': bins, 'timestamp': timestamp}
+
+def encode_covid_borders(joined, borders_format, simplify_tolerance) -> bytes:
+    return geometry_store.encode_borders(joined[0], ['Country_Region'], borders_format=borders_format,
+                                         simplify_tolerance=simplify_tolerance)
+
+def encode_covid_border_levels(joined, levels) -> list:
+    return geometry_store.encode_border_levels(joined[0], ['Country_Region'], id_field='Country_Region', levels=levels)
+
+def encode_covid_series_border_levels(levels) -> list:
+    return encode_covid_border_levels([load_covid_borders()], levels)
+
+def classify_covid_series(metric, days, k) -> dict:
+    '''
+    Classify the last days of a metric from the time series store over bins shared by all the days
+    and build the styledict of the time slider, keyed by the country names
+    '''
+    store = get_covid_store()
+    dates, values = store.read(days=days)
+    if not dates:
+        raise FileNotFoundError('The COVID-19 time series store is empty')
+    
+    # (countries x days) values of the metric, only the rows of the window are read from the memory map
+    metric_values = np.asarray(values[:, :, store.metrics.index(metric)], dtype=float).T
+    bins = utils.classify_bins(metric_values, k=k, scheme='geometric')
+    color_index = utils.classify(metric_values, bins)
+    timestamps = utils.to_unix_timestamps(dates)
+    styledict = utils.create_styledict(color_index, color_dict[metric], timestamps, store.countries, delta=True)
+    return {'styledict': styledict, 'timestamps': timestamps, 'bins': bins, 'dates': dates}
+
+def publish_covid_data(covid_data, column_names) -> dict:
+    '''
+    Publish every metric as a small JSON document with the values and the colors per country.
+    The documents are immutable resources named by their content, so the live page keeps fetching the data
+    it was built with until the new page, whose legend matches the new data, replaces it. Returns the URL of every metric
+    '''
+    world_geojson, df_colors = covid_data['geojson'], covid_data['colors']
+    data_urls = {}
     for name in column_names:
-        # Work-around for geometric space not accepting zeros in the sequence
-        tmp_min = min_dict[name]
-        if min_dict[name] < 1:
-            min_dict[name] = 1
-        
-        inner_bins = np.geomspace(start=min_dict[name], stop=max_dict[name], num=10)
-        min_dict[name] = tmp_min
-        inner_bins = np.delete(inner_bins, 0)
-        inner_bins = np.insert(inner_bins, 0, min_dict[name])
-        inner_bins = np.insert(inner_bins, 0, -1.)
-        inner_bins = inner_bins.tolist()
-        
-        # Round the inner_bins values before appending to the bins list
-        if name in ['Confirmed', 'Deaths', 'Active']:
-            inner_bins = [int(round(bin, 0)) for bin in inner_bins]
-        else:
-            inner_bins = [round(bin, 2) for bin in inner_bins]
-        
-        bins.append(inner_bins)
-        colormap_dict[name] = cm.StepColormap(colors=color_dict[name], index=inner_bins, vmin=min_dict[name], vmax=max_dict[name])
-        df_covid_joined[name+'_color'] = df_covid_joined[name].map(lambda x: colormap_dict[name].rgb_hex_str(x))
+        decimals = 0 if name in ['Confirmed', 'Deaths', 'Active'] else 2
+        values = world_geojson.set_index('Country_Region')[name]
+        values = values[values != -1].round(decimals)
+        document = {'metric': name,
+                    'timestamp': str(covid_data['timestamp']),
+                    'values': {country: (int(value) if decimals == 0 else float(value)) for country, value in values.items()},
+                    'colors': df_colors[name + '_color'].to_dict()}
+        encoded = json.dumps(document, separators=(',', ':')).encode('utf-8')
+        data_urls[name] = publish.resources_url_path + publish.publish_resource(encoded, '.json')
+    return data_urls
+
+@instrumentation.instrumented('covid_series_build')
+def create_covid_series_viz(metric='Confirmed', days=90, multi_resolution=True, coordinate_precision=5, force=False):
+    '''
+    Create the COVID-19 map with a time slider over the last days of a metric, read from the time series store.
+    Like the GDP map, a country's style is only emitted for the days in which its color changes and with 
+    multi_resolution the borders are fetched as TopoJSON levels of detail instead of being embedded.
+    Only the rows of the window are read from the store, so the build time doesn't grow with the history
+    '''
+    store = get_covid_store()
+    inputs = {
+        'store': store.fingerprint(),
+        'borders': geometry_store.get_source_fingerprint()['sha256']
+    }
+    input_hash = utils.hash_inputs(dict(inputs, builder=get_builder_hash(), time_slider=True, metric=metric, days=days, 
+                                        multi_resolution=multi_resolution, coordinate_precision=coordinate_precision))
+    if not force and (publish.get_published('COVID-19_viz.html') or {}).get('input_hash') == input_hash:
+        print('COVID-19 viz inputs unchanged, skipping the build')
+        return
+    
+    classified = stage_cache.stage('covid_series_classify', classify_covid_series, inputs=inputs,
+                                   params={'metric': metric, 'days': days, 'k': len(color_dict[metric]) - 1})
+    series = classified.result()
+    encoder = coordinates.CoordinateEncoder('fixed', precision=coordinate_precision)
+    
+    ''' 
+    Initialize the map
+    '''
+    map_covid = folium.Map(location=[0, 0], zoom_start=4, max_bounds=True, min_zoom=3)
+    
+    '''
+    Create the map content and add it to the map object
+    '''
+    border_levels = None
+    if multi_resolution:
+        levels = stage_cache.stage('covid_series_border_levels', encode_covid_series_border_levels,
+                                   inputs={'borders': inputs['borders']}, params={'levels': geometry_store.border_levels})
+        border_levels = [{'url': publish.resources_url_path + publish.publish_resource(encoded, '.topojson'),
+                          'min_zoom': level['min_zoom']}
+                         for level, encoded in zip(geometry_store.border_levels, levels.result())]
+        world_geojson = None
+    else:
+        world_geojson = encoder.encode_geometries(load_covid_borders().set_index('Country_Region')[['geometry']])
+    choropleth = layers.TimeSliderDeltaChoropleth(
+        world_geojson,
+        styledict=series['styledict'],
+        timestamps=series['timestamps'],
+        init_timestamp=-1,
+        date_length=10,
+        border_levels=border_levels
+    )
+    choropleth.add_to(map_covid)
+    
+    # Create the map legend
+    decimals = 0 if metric in ['Confirmed', 'Deaths', 'Active'] else 2
+    legend_labels = utils.create_legend_labels(series['bins'], color_dict[metric], decimals=decimals)
+    template = utils.create_legend(caption='COVID-19 ' + metric.replace('_', ' ') + ' between ' + series['dates'][0] 
+                                   + ' and ' + series['dates'][-1], legend_labels=legend_labels)
+    macro = MacroElement()
+    macro._template = Template(template)
+    map_covid.get_root().add_child(macro)
+    
+    '''
+    Publish the completed map viz as the new live version
+    '''
+    if encoder.points:
+        encoder.print_report('COVID-19_viz.html')
+    publish.publish_map(map_covid, 'COVID-19_viz.html', metadata={'input_hash': input_hash,
+                                                                  'coordinates': encoder.report()})
+    print('Successfully created the COVID-19 time slider viz!')
+
+@instrumentation.instrumented('covid_build')
+def create_covid_viz(client_join=True, shared_geometry=True, borders_format='topojson', simplify_tolerance=None,
+                     multi_resolution=True, coordinate_precision=5, time_slider=False, slider_metric='Confirmed',
+                     slider_days=90, force=False):
+    '''
+    Create the COVID-19 map. With client_join the page fetches the borders, served as an immutable 
+    content-addressed resource, and the per-metric data documents and joins them on the client; so a data
+    update doesn't change the borders the browsers have cached. With multi_resolution the borders are fetched
+    as TopoJSON levels of detail, the coarse one first and the finer ones as the map zooms in, instead of
+    a single borders_format resource. Otherwise, with shared_geometry the borders
+    are embedded once and the metrics are switched on the client, instead of embedding one GeoJson layer per metric.
+    The embedded borders are rounded to coordinate_precision decimals, the TopoJSON ones keep their quantization.
+    The build is skipped when its inputs and the builder code match the ones of the live version, unless forced.
+    The joined and classified data are cached, so a change of the map styling doesn't redo them.
+    With time_slider the map shows the last slider_days of the slider_metric instead, see create_covid_series_viz
+    '''
+    if time_slider:
+        return create_covid_series_viz(metric=slider_metric, days=slider_days, multi_resolution=multi_resolution,
+                                       coordinate_precision=coordinate_precision, force=force)
+    
+    dataset_path = get_newest_dataset()
+    inputs = {
+        'dataset': utils.file_fingerprint(dataset_path)['sha256'],
+        'borders': geometry_store.get_source_fingerprint()['sha256']
+    }
+    input_hash = utils.hash_inputs(dict(inputs, builder=get_builder_hash(), client_join=client_join, shared_geometry=shared_geometry,
+                                        borders_format=borders_format, simplify_tolerance=simplify_tolerance,
+                                        multi_resolution=multi_resolution, coordinate_precision=coordinate_precision))
+    if not force and (publish.get_published('COVID-19_viz.html') or {}).get('input_hash') == input_hash:
+        print('COVID-19 viz inputs unchanged, skipping the build')
+        return
+    
+    column_names = covid_metrics
+    joined = stage_cache.stage('covid_join', join_covid_data, inputs=inputs, args=[dataset_path])
+    classified = stage_cache.stage('covid_classify', classify_covid_data, args=[joined],
+                                   params={'column_names': column_names, 'k': len(color_dict['Confirmed']) - 1})
+    covid_data = classified.result()
+    world_geojson, df_colors, bins, timestamp = covid_data['geojson'], covid_data['colors'], covid_data['bins'], covid_data['timestamp']
+    encoder = coordinates.CoordinateEncoder('fixed', precision=coordinate_precision)
     
     ''' 
     Initialize the map
@@ -165,82 +415,61 @@ def create_covid_viz():
     '''
     # Create FeatureGroups to group the data
     feature_groups = []
-    for category, _ in color_dict.items():
-        group = folium.FeatureGroup(category, overlay=False)
+    for i, (category, _) in enumerate(color_dict.items()):
+        group = folium.FeatureGroup(category, overlay=False, show=(i == 0))
         feature_groups.append(group)
     
-    # Create the choropleths
-    choropleth_confirmed = folium.GeoJson(data=world_geojson,
-                                          zoom_on_click=False,
-                                          name='Confirmed Cases',
-                                          style_function=lambda x: {
-                                              'fillColor': df_covid_joined['Confirmed_color'][x['properties']['Country_Region']],
-                                              'fillOpacity': 0.7,
-                                              'color': 'black',
-                                              'weight': 0.5
-                                          }).add_to(feature_groups[0])
-    popup_confirmed = folium.GeoJsonPopup(fields=['Country_Region', 'Confirmed'], labels=False)
-    popup_confirmed.add_to(choropleth_confirmed)
-    
-    choropleth_deaths = folium.GeoJson(data=world_geojson,
-                                       name='Deaths',
-                                       style_function=lambda x: {
-                                           'fillColor': df_covid_joined['Deaths_color'][x['properties']['Country_Region']],
-                                           'fillOpacity': 0.7,
-                                           'color': 'black',
-                                           'weight': 1
-                                        }).add_to(feature_groups[1])
-    popup_deaths = folium.GeoJsonPopup(fields=['Country_Region', 'Deaths'], labels=False)
-    popup_deaths.add_to(choropleth_deaths)
-    
-    choropleth_active = folium.GeoJson(data=world_geojson,
-                                       name='Active Cases',
-                                       style_function=lambda x: {
-                                           'fillColor': df_covid_joined['Active_color'][x['properties']['Country_Region']],
-                                           'fillOpacity': 0.7,
-                                           'color': 'black',
-                                           'weight': 1
-                                        }).add_to(feature_groups[2])
-    popup_active = folium.GeoJsonPopup(fields=['Country_Region', 'Active'], labels=False)
-    popup_active.add_to(choropleth_active)
-    
-    choropleth_incident_rate = folium.GeoJson(data=world_geojson,
-                                              name='Incident Rate',
-                                              style_function=lambda x: {
-                                                  'fillColor': df_covid_joined['Incident_Rate_color'][x['properties']['Country_Region']],
-                                                  'fillOpacity': 0.7,
-                                                  'color': 'black',
-                                                  'weight': 1
-                                                  }).add_to(feature_groups[3])
-    popup_incident_rate = folium.GeoJsonPopup(fields=['Country_Region', 'Incident_Rate'], labels=False)
-    popup_incident_rate.add_to(choropleth_incident_rate)
-    
-    choropleth_case_fatality_ratio = folium.GeoJson(data=world_geojson,
-                                                     name='Case Fatality Ratio',
-                                                     style_function=lambda x: {
-                                                         'fillColor': df_covid_joined['Case_Fatality_Ratio_color'][x['properties']['Country_Region']],
-                                                         'fillOpacity': 0.7,
-                                                         'color': 'black',
-                                                         'weight': 1
-                                                         }).add_to(feature_groups[4])
-    popup_case_fatality_ratio = folium.GeoJsonPopup(fields=['Country_Region', 'Case_Fatality_Ratio'], labels=False)
-    popup_case_fatality_ratio.add_to(choropleth_case_fatality_ratio)
+    if client_join:
+        # Fetch the borders and the metric documents, the empty FeatureGroups being the metric switches
+        borders_url, border_levels = None, None
+        if multi_resolution:
+            levels = stage_cache.stage('covid_border_levels', encode_covid_border_levels, args=[joined],
+                                       params={'levels': geometry_store.border_levels}, version=2)
+            border_levels = [{'url': publish.resources_url_path + publish.publish_resource(encoded, '.topojson'),
+                              'min_zoom': level['min_zoom']}
+                             for level, encoded in zip(geometry_store.border_levels, levels.result())]
+        else:
+            borders = stage_cache.stage('covid_borders', encode_covid_borders, args=[joined],
+                                        params={'borders_format': borders_format, 'simplify_tolerance': simplify_tolerance})
+            borders_url = publish.resources_url_path + publish.publish_resource(
+                borders.result(), geometry_store.border_extensions[borders_format])
+        choropleth = layers.ClientJoinChoropleth(borders_url=borders_url,
+                                                 data_urls=publish_covid_data(covid_data, column_names),
+                                                 name_field='Country_Region',
+                                                 borders_format=borders_format,
+                                                 border_levels=border_levels)
+        map_covid.add_child(choropleth)
+    elif shared_geometry:
+        # Embed the geometry only once, with every metric and its color as feature properties;
+        # the empty FeatureGroups only serve as the LayerControl switches between the metrics
+        world_geojson = encoder.encode_geometries(world_geojson)
+        for name in column_names:
+            world_geojson[name + '_color'] = df_colors[name + '_color'].to_numpy()
+        choropleth = layers.SharedGeometryChoropleth(data=world_geojson,
+                                                     metrics=column_names,
+                                                     name_field='Country_Region')
+        map_covid.add_child(choropleth)
+    else:
+        # Create the choropleths, one GeoJson copy per metric
+        world_geojson = encoder.encode_geometries(world_geojson)
+        for name, feature_group in zip(column_names, feature_groups):
+            choropleth = folium.GeoJson(data=world_geojson,
+                                        zoom_on_click=False,
+                                        name=name,
+                                        style_function=lambda x, name=name: {
+                                            'fillColor': df_colors[name + '_color'][x['properties']['Country_Region']],
+                                            'fillOpacity': 0.7,
+                                            'color': 'black',
+                                            'weight': 1
+                                        }).add_to(feature_group)
+            popup = folium.GeoJsonPopup(fields=['Country_Region', name], labels=False)
+            popup.add_to(choropleth)
     
     # Create the map legends templates
     legend_str_dict = {}
     for i, (k, v) in enumerate(color_dict.items()):
-        legend_labels_dict = {}
-        j = 0
-        for color in v:
-            if j == 0:
-                legend_labels_dict[color] = 'No data'
-            elif j == len(v) - 1:
-                legend_labels_dict[color] = '> ' + str(bins[i][j])
-                break
-            else:
-                legend_labels_dict[color] = str(bins[i][j]) + ' - ' + str(bins[i][j+1])
-            j += 1
-        legend_str_dict[k] = legend_labels_dict
+        decimals = 0 if k in ['Confirmed', 'Deaths', 'Active'] else 2
+        legend_str_dict[k] = utils.create_legend_labels(bins[i], v, decimals=decimals)
       
     template = utils.create_legend(caption='COVID-19 status as of: ' +str(timestamp) + ' UTC', legend_labels=legend_str_dict)
     macro = MacroElement()
@@ -254,9 +483,12 @@ def create_covid_viz():
     folium.LayerControl(collapsed=True).add_to(map_covid)
     
     '''
-    Save completed map viz to an appropriate folder
+    Publish the completed map viz as the new live version
     '''
-    map_covid.save(os.path.join(script_dir_path, '..', 'webapp', 'templates', 'COVID-19_viz.html'))
+    if encoder.points:
+        encoder.print_report('COVID-19_viz.html')
+    publish.publish_map(map_covid, 'COVID-19_viz.html', metadata={'input_hash': input_hash,
+                                                                  'coordinates': encoder.report()})
     print('Successfully created the COVID-19 viz!')
     
 if __name__ == '__main__':
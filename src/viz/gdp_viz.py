@@ -1,26 +1,36 @@
 import folium
-import branca.colormap as cm
 import os
 import pandas as pd
-import geopandas as gpd
-import numpy as np
-import json
-import time
-from datetime import datetime
 from folium.plugins import TimeSliderChoropleth
 from branca.element import Template, MacroElement
 import utils
+import coordinates
+import publish
+import layers
+import geometry_store
+import stage_cache
+import instrumentation
 
 script_dir_path = os.path.dirname(os.path.realpath(__file__))
 pd.set_option('display.max_rows', None)
 
-def create_gdp_viz():
+df_GDP_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'GDP_per_capita_world_data.csv'))
+
+# Color list, the first color is for the missing data
+color_list = [
+        '#808080','#A50026','#D73027','#F46D43','#FDAE61','#FEE08B','#FFFFBF','#D9EF8B','#A6D96A','#66BD63','#1A9850','#006837'
+    ]
+
+def join_gdp_data():
+    '''
+    Load the borders and the GDP data and leave only the countries present in both
+    '''
+    
     '''
     Load and pre-process the geojson file
     '''
-    geojson_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'borders_geo.json'))
-    world_geojson = gpd.read_file(geojson_path)
-    world_geojson.drop(columns=['ISO_A2', 'ADMIN'], inplace=True)
+    world_geojson = geometry_store.load_world_borders()
+    world_geojson.drop(columns=['ADMIN'], inplace=True)
     world_geojson.drop(world_geojson[world_geojson['ISO_A3'] == '-99'].index, inplace=True)
     country_list = world_geojson['ISO_A3'].tolist()
 
@@ -28,11 +38,11 @@ def create_gdp_viz():
     Load and pre-process the GDP data
     '''
     # Load the GDP data
-    df_GDP_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'GDP_per_capita_world_data.csv'))
     df_GDP = pd.read_csv(df_GDP_path, index_col='Country Code', skiprows=4)
 
-    # Drop unnecessary data
-    df_GDP.drop(labels='2020', axis=1, inplace=True)  
+    # Drop unnecessary data, keeping the year columns with any values in them
+    year_columns = [column for column in df_GDP.columns if column.isdigit() and df_GDP[column].notna().any()]
+    df_GDP = df_GDP[year_columns]
 
     csv_country_list = df_GDP.index.tolist()
     country_list = list(set(country_list).intersection(csv_country_list))
@@ -43,51 +53,57 @@ def create_gdp_viz():
     # Create an enumerated country dict for id mapping
     country_dict = {k: v for v, k in enumerate(country_list)}
     world_geojson['country_id']=world_geojson['ISO_A3'].map(country_dict)
+    
+    instrumentation.describe_frame('df_GDP', df_GDP)
+    return world_geojson, df_GDP, country_dict, year_columns
 
-    # Count min and max GDP values
-    min_GDP_val, max_GDP_val = df_GDP[df_GDP.columns[4:]].min().min(), df_GDP[df_GDP.columns[4:]].max().max()
-
-    # Create a color list
-    color_list = [
-            '#808080','#A50026','#D73027','#F46D43','#FDAE61','#FEE08B','#FFFFBF','#D9EF8B','#A6D96A','#66BD63','#1A9850','#006837'
-        ]
-
-    # Create a list of geometrically spaced numbers over a min-max interval
-    bins = np.geomspace(min_GDP_val, max_GDP_val, 12)
-
-    # Replace NaNs (records with no data available) with '-1'
-    df_GDP.fillna(-1, inplace=True)
-
-    # Add NaN category to the bins
-    bins = np.insert(bins, 0, -1.)
-    bins = bins.tolist()
-
-    # Append 'color_[year]' columns to the GDP DataFrame
-    year = 1960
-    while year <= 2019:
-        pasted_col_id = df_GDP.columns.get_loc(str(year)) + 1
-        col_value = pd.cut(df_GDP[str(year)], bins, include_lowest=True, labels = [
-            '#808080','#A50026','#D73027','#F46D43','#FDAE61','#FEE08B','#FFFFBF','#D9EF8B','#A6D96A','#66BD63','#1A9850','#006837'
-        ])
-        df_GDP.insert(loc=pasted_col_id, column='color_'+str(year), value=col_value)
-        year += 1 
-
-    print(df_GDP)
+def classify_gdp_data(joined, colors, scheme='geometric', delta_styledict=True) -> dict:
+    '''
+    Classify the GDP values of all the years and build the styledict and the geojson of the time slider
+    '''
+    world_geojson, df_GDP, country_dict, year_columns = joined
+    
+    # Classify all the years at once over bins shared by the whole min-max interval
+    gdp_values = df_GDP[year_columns].to_numpy(dtype=float)
+    bins = utils.classify_bins(gdp_values, k=len(colors) - 1, scheme=scheme)
+    color_index = utils.classify(gdp_values, bins)
 
     '''
     Create appropriately formatted dictionary that the TimeSliderChoropleth will receive as an input
     '''
-    gdp_dict = {}
-    for country_code in df_GDP.index.tolist():
-        country_id = str(country_dict[country_code]) 
-        gdp_dict[country_id] = {}
-        year = 1960
-        while year <= 2019:
-            dt_obj = datetime(year=year, month=12, day=31)
-            year_in_ms = str(time.mktime(dt_obj.timetuple()))
-            color_hex = df_GDP.at[country_code, 'color_'+str(year)]
-            gdp_dict[country_id][year_in_ms] = {'color':color_hex, 'opacity':0.7} 
-            year += 1
+    # Year timestamps are computed once, the styles come straight from the color index matrix
+    year_timestamps = utils.to_unix_timestamps([year + '-12-31' for year in year_columns])
+    country_ids = df_GDP.index.map(country_dict)
+    styledict = utils.create_styledict(color_index, colors, year_timestamps, country_ids, delta=delta_styledict)
+    
+    return {'geojson': world_geojson.set_index('country_id'),
+            'styledict': styledict,
+            'timestamps': year_timestamps,
+            'bins': bins}
+
+def encode_gdp_border_levels(joined, levels) -> list:
+    return geometry_store.encode_border_levels(joined[0], [], id_field='country_id', levels=levels)
+
+@instrumentation.instrumented('gdp_build')
+def create_gdp_viz(delta_styledict=True, scheme='geometric', multi_resolution=True, coordinate_precision=5):
+    '''
+    Create the GDP per capita map. With delta_styledict a country's style is only emitted 
+    for the years in which its color changes, which the slider resolves on the client.
+    With multi_resolution the delta slider doesn't embed the borders, it fetches their TopoJSON 
+    levels of detail, the coarse one first and the finer ones as the map zooms in. Otherwise the embedded
+    borders are rounded to coordinate_precision decimals.
+    The joined and classified data are cached, keyed by the hashes of the source files
+    and the classification parameters, so only the changed stages run again
+    '''
+    joined = stage_cache.stage('gdp_join', join_gdp_data,
+                               inputs={'borders': geometry_store.get_source_fingerprint()['sha256'],
+                                       'gdp': utils.file_fingerprint(df_GDP_path)['sha256']},
+                               version=2)
+    classified = stage_cache.stage('gdp_classify', classify_gdp_data, args=[joined],
+                                   params={'colors': color_list, 'scheme': scheme, 'delta_styledict': delta_styledict},
+                                   version=2)
+    gdp_data = classified.result()
+    encoder = coordinates.CoordinateEncoder('fixed', precision=coordinate_precision)
         
     ''' 
     Initialize the map
@@ -98,24 +114,30 @@ def create_gdp_viz():
     Create the map content and add it to the map object
     '''
     # Create the choropleth
-    choropleth = TimeSliderChoropleth(
-        world_geojson.set_index('country_id').to_json(),
-        styledict=gdp_dict
-    )
+    if delta_styledict:
+        border_levels = None
+        if multi_resolution:
+            levels = stage_cache.stage('gdp_border_levels', encode_gdp_border_levels, args=[joined],
+                                       params={'levels': geometry_store.border_levels})
+            border_levels = [{'url': publish.resources_url_path + publish.publish_resource(encoded, '.topojson'),
+                              'min_zoom': level['min_zoom']}
+                             for level, encoded in zip(geometry_store.border_levels, levels.result())]
+        choropleth = layers.TimeSliderDeltaChoropleth(
+            None if border_levels else encoder.encode_geometries(gdp_data['geojson']),
+            styledict=gdp_data['styledict'],
+            timestamps=gdp_data['timestamps'],
+            date_length=4,
+            border_levels=border_levels
+        )
+    else:
+        choropleth = TimeSliderChoropleth(
+            encoder.encode_geometries(gdp_data['geojson']).to_json(),
+            styledict=gdp_data['styledict']
+        )
     choropleth.add_to(map_GDP)
 
     # Create the map legend
-    legend_labels_dict = {}
-    i = 0
-    for color in color_list:
-        if i == 0:
-            legend_labels_dict[color_list[i]] = 'No data'
-        elif i == len(color_list) - 1:
-            legend_labels_dict[color_list[i]] = '> ' + str(round(bins[i], 2)) + '$'
-            break
-        else:         
-            legend_labels_dict[color] = str(round(bins[i], 2)) + '$' + ' - ' + str(round(bins[i+1], 2)) + '$'
-        i += 1
+    legend_labels_dict = utils.create_legend_labels(gdp_data['bins'], color_list, decimals=2, unit='$')
 
     template = utils.create_legend(caption='GDP per capita in USD', legend_labels=legend_labels_dict)
     macro = MacroElement()
@@ -123,7 +145,9 @@ def create_gdp_viz():
     map_GDP.get_root().add_child(macro)
 
     '''
-    Save completed map viz to an appropriate folder
+    Publish the completed map viz as the new live version
     '''
-    map_GDP.save(os.path.join(script_dir_path, '..', 'webapp', 'templates', 'GDP_viz.html'))
+    if encoder.points:
+        encoder.print_report('GDP_viz.html')
+    publish.publish_map(map_GDP, 'GDP_viz.html', metadata={'coordinates': encoder.report()})
     print('Successfully created the GDP viz!')
\ No newline at end of file
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import pickle
+import geopandas as gpd
+import utils
+import topology
+
+script_dir_path = os.path.dirname(os.path.realpath(__file__))
+geojson_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'borders_geo.json'))
+cache_path = os.path.join(utils.cache_dir_path, 'borders_geo.pkl')
+cache_meta_path = os.path.join(utils.cache_dir_path, 'borders_geo.json')
+
+# Bump whenever the pre-processing below changes, so that old caches get discarded
+CACHE_VERSION = 1
+
+# In-process copy of the borders, shared by all the viz modules
+_borders = None
+_borders_fingerprint = None
+
+def _parse_borders():
+    '''
+    Parse the geojson file and apply the pre-processing steps that every viz needs
+    '''
+    world_geojson = gpd.read_file(geojson_path)
+    world_geojson.drop(columns=['ISO_A2'], inplace=True)
+    world_geojson = world_geojson.sort_values('ADMIN').reset_index(drop=True)
+    return world_geojson
+
+def _read_cache_meta():
+    try:
+        with open(cache_meta_path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _write_cache_meta(fingerprint):
+    with open(cache_meta_path, 'w') as file:
+        json.dump({'version': CACHE_VERSION, 'source': fingerprint}, file)
+
+def _write_cache(world_geojson, fingerprint):
+    os.makedirs(utils.cache_dir_path, exist_ok=True)
+    with open(cache_path + '.tmp', 'wb') as file:
+        pickle.dump(world_geojson, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + '.tmp', cache_path)
+    _write_cache_meta(fingerprint)
+
+def get_source_fingerprint() -> dict:
+    '''
+    Return the fingerprint of the borders geojson, reusing the cached hash while the file is untouched
+    '''
+    meta = _read_cache_meta()
+    previous = meta.get('source') if meta.get('version') == CACHE_VERSION else None
+    return utils.file_fingerprint(geojson_path, previous=previous)
+
+def load_world_borders() -> gpd.GeoDataFrame:
+    '''
+    Return a copy of the pre-processed world borders. The geojson is parsed only once;
+    afterwards it's served from memory or from the pickled cache in the data/cache folder,
+    which is invalidated when the mtime and the hash of the source file change
+    '''
+    global _borders, _borders_fingerprint
+    start = time.perf_counter()
+
+    # Serve from memory if the source file hasn't been touched since the last load
+    if _borders is not None:
+        stat = os.stat(geojson_path)
+        if stat.st_mtime == _borders_fingerprint['mtime'] and stat.st_size == _borders_fingerprint['size']:
+            return _borders.copy()
+
+    meta = _read_cache_meta()
+    previous = meta.get('source') if meta.get('version') == CACHE_VERSION else None
+    fingerprint = utils.file_fingerprint(geojson_path, previous=previous)
+
+    world_geojson = None
+    if previous is not None and previous.get('sha256') == fingerprint['sha256']:
+        try:
+            with open(cache_path, 'rb') as file:
+                world_geojson = pickle.load(file)
+            source = 'disk cache'
+        except Exception as e:
+            print(str(e) + '\nCould not load the cached borders, parsing the geojson instead.')
+
+    if world_geojson is None:
+        world_geojson = _parse_borders()
+        source = 'geojson'
+        _write_cache(world_geojson, fingerprint)
+    elif previous['mtime'] != fingerprint['mtime']:
+        # Same content under a new mtime, only the metadata needs refreshing
+        _write_cache_meta(fingerprint)
+
+    _borders, _borders_fingerprint = world_geojson, fingerprint
+    print('Loaded the world borders from {} in {:.3f}s'.format(source, time.perf_counter() - start))
+    return _borders.copy()
+
+# File extensions of the encoded borders
+border_extensions = {'geojson': '.geojson', 'topojson': '.topojson'}
+
+# Levels of detail of the borders fetched by the maps, each from the zoom level where it's shown.
+# The simplification tolerance is about half a pixel at the highest zoom of the level, in degrees,
+# and the quantization step stays below it
+border_levels = [
+    {'min_zoom': 0, 'tolerance': 0.05, 'quantization': 20000},
+    {'min_zoom': 5, 'tolerance': 0.01, 'quantization': 50000},
+    {'min_zoom': 7, 'tolerance': 0.0025, 'quantization': 200000},
+    {'min_zoom': 9, 'tolerance': None, 'quantization': 1000000}
+]
+
+def _encode_json(content) -> bytes:
+    return json.dumps(content, separators=(',', ':'), default=lambda value: value.item()).encode('utf-8')
+
+def encode_borders(world_geojson, properties, borders_format='topojson', simplify_tolerance=None, quantization=100000,
+                   id_field=None) -> bytes:
+    '''
+    Encode the borders with only the listed properties for the pages to fetch, as GeoJSON or as a quantized
+    TopoJSON topology, optionally simplified with the tolerance in degrees
+    '''
+    columns = list(properties) + ([id_field] if id_field is not None and id_field not in properties else [])
+    borders = world_geojson[columns + ['geometry']]
+    if borders_format == 'topojson':
+        # The shared borders are simplified once in the topology, so the neighbours stay gap-free
+        return _encode_json(topology.to_topojson(borders, properties, quantization=quantization, id_field=id_field,
+                                                 tolerance=simplify_tolerance))
+    elif borders_format == 'geojson':
+        if simplify_tolerance:
+            borders = borders.assign(geometry=borders.geometry.simplify(simplify_tolerance, preserve_topology=True))
+        return borders.to_json().encode('utf-8')
+    raise ValueError('Unknown borders format: ' + str(borders_format))
+
+def encode_border_levels(world_geojson, properties, id_field=None, levels=None) -> list:
+    '''
+    Encode the borders as one TopoJSON topology per level of detail, coarsest first
+    '''
+    return [encode_borders(world_geojson, properties, simplify_tolerance=level['tolerance'],
+                           quantization=level['quantization'], id_field=id_field)
+            for level in (levels or border_levels)]
+
+if __name__ == '__main__':
+    # Report the cold (geojson), warm (disk cache) and hot (memory) load times
+    if os.path.exists(cache_meta_path):
+        os.remove(cache_meta_path)
+    for label in ['cold', 'warm']:
+        _borders = None
+        start = time.perf_counter()
+        load_world_borders()
+        print('{} load: {:.3f}s'.format(label, time.perf_counter() - start))
+    start = time.perf_counter()
+    load_world_borders()
+    print('in-memory load: {:.3f}s'.format(time.perf_counter() - start))
@@ -0,0 +1,115 @@
+import os
+import json
+import uuid
+import pandas as pd
+import utils
+
+class IncidentStore:
+    '''
+    Append-only local store of incident records keyed by a unique row id. Every fetch is appended as a new
+    pickled segment, and reading the store keeps the latest revision of every record. Segments are merged,
+    and records older than the retention period dropped, once there are more than max_segments of them
+    '''
+    def __init__(self, directory, key='row_id', updated_field=':updated_at', date_field='incident_date',
+                 retention_days=30, max_segments=14):
+        self.directory = directory
+        self.key = key
+        self.updated_field = updated_field
+        self.date_field = date_field
+        self.retention_days = retention_days
+        self.max_segments = max_segments
+        self.state_path = os.path.join(directory, 'state.json')
+
+    def _read_state(self) -> dict:
+        try:
+            with open(self.state_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {'high_water_mark': None, 'segments': []}
+
+    def _write_state(self, state):
+        with open(self.state_path + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def _normalize(self, df):
+        df = df.copy()
+        df[self.key] = df[self.key].astype(str)
+        for column in ['latitude', 'longitude']:
+            if column in df:
+                df[column] = pd.to_numeric(df[column], errors='coerce')
+        if self.updated_field in df:
+            df.sort_values(self.updated_field, kind='mergesort', inplace=True)
+        return df
+
+    def _write_segment(self, df) -> str:
+        name = 'segment-' + uuid.uuid4().hex + '.pkl'
+        df.to_pickle(os.path.join(self.directory, name))
+        return name
+
+    def is_empty(self) -> bool:
+        return not self._read_state()['segments']
+
+    def high_water_mark(self) -> str:
+        '''
+        Return the latest update timestamp stored so far, None for an empty store
+        '''
+        return self._read_state()['high_water_mark']
+
+    def fingerprint(self) -> str:
+        '''
+        Return a hash identifying the current content of the store, which changes with every append or compaction
+        '''
+        return utils.hash_inputs(self._read_state())
+
+    def append(self, df, high_water_mark=None) -> int:
+        '''
+        Append the fetched records as a new segment; records already in the store are superseded by them
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        state = self._read_state()
+        if len(df):
+            # The segment is written before the state referencing it, so a crash never leaves a dangling entry
+            state['segments'].append(self._write_segment(self._normalize(df)))
+        if high_water_mark is not None:
+            state['high_water_mark'] = high_water_mark
+        self._write_state(state)
+
+        if len(state['segments']) > self.max_segments:
+            self.compact()
+        return len(df)
+
+    def load(self) -> pd.DataFrame:
+        '''
+        Return the latest revision of every stored record
+        '''
+        segments = self._read_state()['segments']
+        if not segments:
+            return pd.DataFrame(columns=[self.key])
+        df = pd.concat([pd.read_pickle(os.path.join(self.directory, name)) for name in segments], ignore_index=True)
+        return df.drop_duplicates(self.key, keep='last').reset_index(drop=True)
+
+    def load_window(self, days) -> pd.DataFrame:
+        '''
+        Return the records of the last days, counted back from the latest date in the store
+        '''
+        df = self.load()
+        if df.empty:
+            return df
+        dates = pd.to_datetime(df[self.date_field])
+        return df[dates > dates.max() - pd.Timedelta(days=days)].reset_index(drop=True)
+
+    def compact(self):
+        '''
+        Merge all the segments into one, keeping only the latest revision of the records within the retention period
+        '''
+        state = self._read_state()
+        df = self.load()
+        if not df.empty:
+            dates = pd.to_datetime(df[self.date_field])
+            df = df[dates > dates.max() - pd.Timedelta(days=self.retention_days)]
+        old_segments = state['segments']
+        state['segments'] = [self._write_segment(df)] if len(df) else []
+        self._write_state(state)
+        for name in old_segments:
+            os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import uuid
+import functools
+import threading
+import contextlib
+
+script_dir_path = os.path.dirname(os.path.realpath(__file__))
+runs_dir_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'cache', 'runs'))
+
+# Number of runs kept for every run name
+KEEP_RUNS = 20
+
+# The run in progress in the current thread, the stages and downloads get attached to it
+_local = threading.local()
+
+def _current_rss() -> int:
+    '''
+    Return the current resident set size in bytes, falling back to the peak where /proc isn't available
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return _peak_rss()
+
+def _peak_rss() -> int:
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _current_run():
+    return getattr(_local, 'run', None)
+
+def _write_run(run):
+    '''
+    Store the finished run as a file of its own, so that runs finishing in different processes never clash,
+    and remove the oldest runs of the same name beyond KEEP_RUNS
+    '''
+    os.makedirs(runs_dir_path, exist_ok=True)
+    path = os.path.join(runs_dir_path, '{}-{:.6f}-{}.json'.format(run['name'], run['started_at'], uuid.uuid4().hex[:8]))
+    with open(path + '.tmp', 'w') as file:
+        json.dump(run, file, default=str)
+    os.replace(path + '.tmp', path)
+
+    previous = sorted(name for name in os.listdir(runs_dir_path)
+                      if name.startswith(run['name'] + '-') and name.endswith('.json'))
+    for name in previous[:-KEEP_RUNS]:
+        try:
+            os.remove(os.path.join(runs_dir_path, name))
+        except OSError:
+            pass
+
+@contextlib.contextmanager
+def run(name):
+    '''
+    Time a whole build or download, collecting the stages and the downloads that happen within it
+    '''
+    outer = _current_run()
+    if outer is not None:
+        # Nested runs are recorded as stages of the outer one
+        with stage(name):
+            yield outer
+        return
+
+    record = {'name': name, 'started_at': time.time(), 'pid': os.getpid(), 'status': 'ok',
+              'stages': [], 'downloads': [], 'rss_start': _current_rss()}
+    _local.run = record
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['status'] = 'failed'
+        record['error'] = repr(e)
+        raise
+    finally:
+        _local.run = None
+        record['duration'] = time.perf_counter() - start
+        record['rss_end'] = _current_rss()
+        record['peak_rss'] = _peak_rss()
+        try:
+            _write_run(record)
+        except OSError as e:
+            print(str(e) + '\nCould not store the metrics of ' + name)
+
+def instrumented(name):
+    '''
+    Decorator recording every call of the function as a run
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with run(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextlib.contextmanager
+def stage(name, **info):
+    '''
+    Time a stage of the current run and record the memory it took; extra info is stored with the stage
+    '''
+    record = dict(info, name=name, rss_start=_current_rss())
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['duration'] = time.perf_counter() - start
+        record['rss_end'] = _current_rss()
+        record['peak_rss'] = _peak_rss()
+        current = _current_run()
+        if current is not None:
+            current['stages'].append(record)
+
+def record_download(record):
+    current = _current_run()
+    if current is not None:
+        current['downloads'].append(record)
+
+def describe_frame(label, df):
+    '''
+    Print a one line summary of a DataFrame instead of the whole frame, and attach it to the current run
+    '''
+    summary = {'label': label,
+               'rows': len(df),
+               'columns': len(df.columns),
+               'null_values': int(df.isna().sum().sum()),
+               'memory_bytes': int(df.memory_usage(deep=True).sum())}
+    print('{label}: {rows} rows x {columns} columns, {null_values} null values, {memory_bytes} bytes'.format(**summary))
+    current = _current_run()
+    if current is not None:
+        current.setdefault('frames', []).append(summary)
+    return summary
+
+def load_runs(name=None) -> list:
+    '''
+    Return the stored runs, oldest first, optionally only the ones of the given name
+    '''
+    try:
+        names = sorted(os.listdir(runs_dir_path))
+    except OSError:
+        return []
+    runs = []
+    for filename in names:
+        if not filename.endswith('.json') or (name is not None and not filename.startswith(name + '-')):
+            continue
+        try:
+            with open(os.path.join(runs_dir_path, filename), 'r') as file:
+                runs.append(json.load(file))
+        except (OSError, ValueError):
+            # Pruned by another process meanwhile
+            pass
+    return sorted(runs, key=lambda run: run['started_at'])
@@ -0,0 +1,304 @@
+import html
+import numpy as np
+import pandas as pd
+from branca.element import MacroElement
+from folium.map import Layer
+from folium.plugins import MarkerCluster
+from jinja2 import Template
+import topology
+import streaming
+import coordinates
+
+class SharedGeometryChoropleth(MacroElement):
+    '''
+    Choropleth which embeds the geometry only once and switches between several metrics on the client.
+    Every feature carries the metric values and their colors as properties ('<metric>' and '<metric>_color');
+    picking one of the metric base layers in the LayerControl restyles the features in place
+    '''
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_metrics = {{ this.metrics|tojson }};
+        var {{ this.get_name() }}_current = {{ this.metrics[0]|tojson }};
+        var {{ this.get_name() }}_style = function(feature) {
+            return {
+                fillColor: feature.properties[{{ this.get_name() }}_current + '_color'],
+                fillOpacity: {{ this.fill_opacity }},
+                color: {{ this.line_color|tojson }},
+                weight: {{ this.line_weight }}
+            };
+        };
+        var {{ this.get_name() }} = L.geoJson({{ this.data }}, {
+            style: {{ this.get_name() }}_style,
+            onEachFeature: function(feature, layer) {
+                layer.bindPopup(function() {
+                    var value = feature.properties[{{ this.get_name() }}_current];
+                    return '<b>' + feature.properties[{{ this.name_field|tojson }}] + '</b><br>'
+                        + (value === -1 ? 'No data' : value);
+                });
+            }
+        }).addTo({{ this._parent.get_name() }});
+        {{ this._parent.get_name() }}.on('baselayerchange', function(e) {
+            if ({{ this.get_name() }}_metrics.indexOf(e.name) !== -1) {
+                {{ this.get_name() }}_current = e.name;
+                {{ this.get_name() }}.setStyle({{ this.get_name() }}_style);
+            }
+        });
+        {% endmacro %}
+        """)
+
+    def __init__(self, data, metrics, name_field, fill_opacity=0.7, line_color='black', line_weight=1):
+        super(SharedGeometryChoropleth, self).__init__()
+        self._name = 'SharedGeometryChoropleth'
+        self.data = data if isinstance(data, str) else streaming.DataBlock(data, 'geometry')
+        self.metrics = list(metrics)
+        self.name_field = name_field
+        self.fill_opacity = fill_opacity
+        self.line_color = line_color
+        self.line_weight = line_weight
+
+class ClientJoinChoropleth(MacroElement):
+    '''
+    Choropleth which fetches the borders and the metric data separately and joins them on the client.
+    The borders come from an immutable GeoJSON or TopoJSON resource, or from TopoJSON levels of detail
+    ([{'url': ..., 'min_zoom': ...}]) swapped as the map zooms, each metric from a small JSON document
+    ({'values': {name: value}, 'colors': {name: color}}) fetched when the metric is first shown.
+    Picking one of the metric base layers in the LayerControl restyles the features in place
+    '''
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        {%- if this.borders_format == 'topojson' %}
+        {{ this.topojson_decoder }}
+        {%- endif %}
+        {%- if this.border_levels %}
+        {{ this.border_levels_loader }}
+        {%- endif %}
+        var {{ this.get_name() }} = (function() {
+            var data_urls = {{ this.data_urls|tojson }};
+            var data = {}, pending = {};
+            var current = {{ this.metrics[0]|tojson }};
+            var layer = L.geoJson(null, {
+                style: function(feature) {
+                    var metric = data[current];
+                    return {
+                        fillColor: (metric && metric.colors[feature.properties[{{ this.name_field|tojson }}]]) || {{ this.no_data_color|tojson }},
+                        fillOpacity: {{ this.fill_opacity }},
+                        color: {{ this.line_color|tojson }},
+                        weight: {{ this.line_weight }}
+                    };
+                },
+                onEachFeature: function(feature, layer) {
+                    layer.bindPopup(function() {
+                        var name = feature.properties[{{ this.name_field|tojson }}];
+                        var value = data[current] ? data[current].values[name] : undefined;
+                        return '<b>' + name + '</b><br>' + (value === undefined || value === null ? 'No data' : value);
+                    });
+                }
+            }).addTo({{ this._parent.get_name() }});
+            var fetch_json = function(url) {
+                return fetch(url).then(function(response) {
+                    if (!response.ok) { throw new Error(url + ': ' + response.status); }
+                    return response.json();
+                });
+            };
+            var load = function(metric) {
+                if (!pending[metric]) {
+                    pending[metric] = fetch_json(data_urls[metric]).then(function(metric_data) {
+                        data[metric] = metric_data;
+                    });
+                }
+                return pending[metric];
+            };
+            var show = function(metric) {
+                current = metric;
+                load(metric).then(function() {
+                    if (current === metric) { layer.setStyle(layer.options.style); }
+                });
+            };
+            var set_borders = function(features) {
+                layer.clearLayers();
+                layer.addData(features);
+                show(current);
+            };
+            {%- if this.border_levels %}
+            borderLevels({{ this._parent.get_name() }}, {{ this.border_levels|tojson }}, {{ this.object_name|tojson }}, set_borders);
+            {%- else %}
+            fetch_json({{ this.borders_url|tojson }}).then(function(borders) {
+                {%- if this.borders_format == 'topojson' %}
+                set_borders(topojsonFeatures(borders, {{ this.object_name|tojson }}));
+                {%- else %}
+                set_borders(borders);
+                {%- endif %}
+            });
+            {%- endif %}
+            {{ this._parent.get_name() }}.on('baselayerchange', function(e) {
+                if (e.name in data_urls) { show(e.name); }
+            });
+            return layer;
+        })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, borders_url, data_urls, name_field, borders_format='topojson', object_name='borders',
+                 fill_opacity=0.7, line_color='black', line_weight=1, no_data_color='#808080', border_levels=None):
+        super(ClientJoinChoropleth, self).__init__()
+        self._name = 'ClientJoinChoropleth'
+        self.borders_url = borders_url
+        self.border_levels = list(border_levels or [])
+        self.border_levels_loader = topology.border_levels_js
+        if self.border_levels:
+            borders_format = 'topojson'
+        self.data_urls = dict(data_urls)
+        self.metrics = list(data_urls)
+        self.name_field = name_field
+        self.borders_format = borders_format
+        self.object_name = object_name
+        self.fill_opacity = fill_opacity
+        self.line_color = line_color
+        self.line_weight = line_weight
+        self.no_data_color = no_data_color
+        self.topojson_decoder = topology.topojson_decoder_js
+
+class TimeSliderDeltaChoropleth(Layer):
+    '''
+    Choropleth with a time slider for delta encoded styledicts (see utils.create_styledict), in which a feature 
+    only has entries at the timestamps where its style changes. The client resolves the latest entry at or 
+    before the selected timestamp, so the slider can jump to any position.
+    With border_levels the geometry isn't embedded, the TopoJSON levels of detail are fetched as the map zooms
+    '''
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        {%- if this.border_levels %}
+        {{ this.topojson_decoder }}
+        {{ this.border_levels_loader }}
+        {%- endif %}
+        var {{ this.get_name() }}_timestamps = {{ this.timestamps|tojson }};
+        var {{ this.get_name() }}_changes = (function(styledict) {
+            var changes = {};
+            for (var feature_id in styledict) {
+                changes[feature_id] = Object.keys(styledict[feature_id])
+                    .sort(function(a, b) { return a - b; })
+                    .map(function(t) { return [Number(t), styledict[feature_id][t]]; });
+            }
+            return changes;
+        })({{ this.styledict }});
+        var {{ this.get_name() }} = L.geoJson({{ this.data if this.data else 'null' }}, {
+            style: {color: {{ this.stroke_color|tojson }}, weight: {{ this.stroke_width }}, fillOpacity: 0}
+        });
+        var {{ this.get_name() }}_timestamp = null;
+        var {{ this.get_name() }}_fill = function(timestamp) {
+            {{ this.get_name() }}_timestamp = timestamp;
+            {{ this.get_name() }}.eachLayer(function(layer) {
+                // Binary search for the latest change at or before the timestamp
+                var changes = {{ this.get_name() }}_changes[layer.feature.id] || [];
+                var low = 0, high = changes.length - 1, style = null;
+                while (low <= high) {
+                    var mid = (low + high) >> 1;
+                    if (changes[mid][0] <= timestamp) { style = changes[mid][1]; low = mid + 1; }
+                    else { high = mid - 1; }
+                }
+                layer.setStyle(style ? {fillColor: style.color, fillOpacity: style.opacity} : {fillOpacity: 0});
+            });
+        };
+        (function() {
+            var map_div = document.getElementById({{ this._parent.get_name()|tojson }});
+            var slider = document.createElement('div');
+            var output = document.createElement('output');
+            var input = document.createElement('input');
+            output.style.cssText = 'font-size: 18px; margin: 5px;';
+            input.type = 'range';
+            input.min = 0;
+            input.max = {{ this.get_name() }}_timestamps.length - 1;
+            input.step = 1;
+            input.value = {{ this.init_timestamp }};
+            slider.appendChild(output);
+            slider.appendChild(input);
+            map_div.parentNode.insertBefore(slider, map_div);
+            var update = function() {
+                var timestamp = Number({{ this.get_name() }}_timestamps[input.value]);
+                output.textContent = new Date(timestamp * 1000).toISOString().slice(0, {{ this.date_length }});
+                {{ this.get_name() }}_fill(timestamp);
+            };
+            input.addEventListener('input', update);
+            {{ this.get_name() }}.on('add', function() { slider.style.display = ''; update(); });
+            {{ this.get_name() }}.on('remove', function() { slider.style.display = 'none'; });
+        })();
+        {%- if this.border_levels %}
+        borderLevels({{ this._parent.get_name() }}, {{ this.border_levels|tojson }}, {{ this.object_name|tojson }}, function(features) {
+            {{ this.get_name() }}.clearLayers();
+            {{ this.get_name() }}.addData(features);
+            if ({{ this.get_name() }}_timestamp !== null) { {{ this.get_name() }}_fill({{ this.get_name() }}_timestamp); }
+        });
+        {%- endif %}
+        {%- if this.show %}
+        {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+        {%- endif %}
+        {% endmacro %}
+        """)
+
+    def __init__(self, data, styledict, timestamps, name=None, overlay=True, control=True, show=True,
+                 init_timestamp=0, date_length=10, stroke_color='#FFFFFF', stroke_width=0.8, border_levels=None,
+                 object_name='borders'):
+        super(TimeSliderDeltaChoropleth, self).__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = 'TimeSliderDeltaChoropleth'
+        self.border_levels = list(border_levels or [])
+        if self.border_levels:
+            data = None
+        self.data = data if data is None or isinstance(data, str) else streaming.DataBlock(data, 'geometry')
+        self.object_name = object_name
+        self.topojson_decoder = topology.topojson_decoder_js
+        self.border_levels_loader = topology.border_levels_js
+        self.styledict = streaming.DataBlock(styledict, 'styles')
+        self.timestamps = [str(timestamp) for timestamp in timestamps]
+        self.init_timestamp = init_timestamp % len(self.timestamps)
+        self.date_length = date_length
+        self.stroke_color = stroke_color
+        self.stroke_width = stroke_width
+
+class BulkMarkerCluster(MarkerCluster):
+    '''
+    Marker cluster for large point sets. The coordinates, in the encoding of the given coordinates.CoordinateEncoder, 
+    and the popup fields are embedded once, every popup field being dictionary encoded (codes + unique values),
+    and streamed into the page when it's written.
+    The markers share a single icon and their popup HTML is only rendered on the client when a marker gets clicked
+    '''
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = (function() {
+            var positions = {{ this.positions }};
+            var fields = {{ this.fields }};
+            var icon = L.AwesomeMarkers.icon({{ this.icon_options|tojson }});
+            var popup = function(layer) {
+                var row = layer.options.row;
+                return fields.map(function(field) {
+                    return '<strong>' + field.label + ': </strong>' + field.values[field.codes[row]];
+                }).join('<br>');
+            };
+            var markers = new Array(positions.length);
+            for (var i = 0; i < markers.length; i++) {
+                markers[i] = L.marker(positions[i], {icon: icon, row: i}).bindPopup(popup);
+            }
+            var cluster = L.markerClusterGroup({{ this.cluster_options|tojson }});
+            cluster.addLayers(markers);
+            {%- if this.show %}
+            cluster.addTo({{ this._parent.get_name() }});
+            {%- endif %}
+            return cluster;
+        })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, locations, popup_fields=None, icon_options=None, name=None, overlay=True, control=True,
+                 show=True, encoder=None):
+        super(BulkMarkerCluster, self).__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = 'BulkMarkerCluster'
+        encoder = encoder or coordinates.CoordinateEncoder('fixed', precision=6)
+        locations = np.asarray(locations, dtype=float)
+        fields = []
+        for label, values in (popup_fields or {}).items():
+            codes, uniques = pd.factorize(pd.Series(values).astype(str))
+            fields.append({'label': label, 'codes': codes, 'values': [html.escape(value) for value in uniques]})
+        self.positions = streaming.DataBlock(encoder.encode(locations), 'markers', count=len(locations),
+                                             function='decodeCoordinates' if encoder.decoded_on_client else None)
+        self.fields = streaming.DataBlock(fields, 'popups', count=len(locations))
+        self.icon_options = icon_options or {}
+        self.cluster_options = {'chunkedLoading': True}
@@ -0,0 +1,248 @@
+import os
+import re
+import sys
+import json
+
+# Payload components of a generated map page
+components = ['geometry', 'properties', 'styles', 'popups', 'markers', 'legend', 'includes', 'other']
+
+# Byte budgets of every viz, in total and per component; a page over budget is not published
+payload_budgets = {
+    'COVID-19_viz.html': {'total': 32 * 2**20, 'geometry': 28 * 2**20, 'includes': 8 * 2**10},
+    'GDP_viz.html': {'total': 32 * 2**20, 'geometry': 28 * 2**20, 'styles': 2 * 2**20, 'includes': 8 * 2**10},
+    'SF_crime_viz.html': {'total': 4 * 2**20, 'markers': 2 * 2**20, 'popups': 2 * 2**20, 'geometry': 2 * 2**20,
+                          'includes': 8 * 2**10},
+    'UK_accidents_viz.html': {'total': 48 * 2**20, 'markers': 46 * 2**20, 'includes': 8 * 2**10}
+}
+
+# Literals shorter than this are left to the 'other' component, they're options rather than data
+MIN_LITERAL_SIZE = 64
+
+include_pattern = re.compile(r'<script[^>]*\bsrc=[^>]*>\s*</script>|<link[^>]*\bstylesheet\b[^>]*>', re.IGNORECASE)
+include_url_pattern = re.compile(r'\b(?:src|href)=["\']?([^"\'\s>]+)', re.IGNORECASE)
+legend_pattern = re.compile(r"<!doctype html>(?:(?!<!doctype html>).)*?class='maplegend'.*?</html>\s*<style type='text/css'>.*?</style>",
+                            re.IGNORECASE | re.DOTALL)
+inline_script_pattern = re.compile(r'<script>(.*?)</script>', re.IGNORECASE | re.DOTALL)
+literal_start_pattern = re.compile(r'[\[{]')
+
+# Statements of the legacy per-object markers and popups: (component, pattern, whether it counts an item)
+object_statements = [
+    ('markers', re.compile(r'var marker_\w+ = L\.marker\(.*?\)\.addTo\(\w+\);', re.DOTALL), True),
+    ('markers', re.compile(r'var icon_\w+ = L\.AwesomeMarkers\.icon\(.*?\);', re.DOTALL), False),
+    ('markers', re.compile(r'\w+\.setIcon\(\w+\);'), False),
+    ('popups', re.compile(r'var popup_\w+ = L\.popup\(.*?\);', re.DOTALL), True),
+    ('popups', re.compile(r'var html_\w+ = \$\(`.*?`\)\[0\];', re.DOTALL), False),
+    ('popups', re.compile(r'\w+\.setContent\(\w+\);'), False),
+    ('popups', re.compile(r'\w+\.bindPopup\(\w+\)\s*;'), False)
+]
+class PayloadBudgetError(Exception):
+    pass
+
+class PayloadProfile:
+    '''
+    Byte and item counts of the components of a page. Bytes are counted in the page's own serialization,
+    the parts of a JSON literal being attributed to the components in proportion to their compact size
+    '''
+    def __init__(self, total):
+        self.total = total
+        self.bytes = {component: 0 for component in components}
+        self.counts = {component: 0 for component in components}
+        self.vertices = 0
+        self.include_urls = []
+
+    def add(self, component, size, count=0):
+        self.bytes[component] += int(round(size))
+        self.counts[component] += count
+
+    def to_dict(self) -> dict:
+        return {'total': self.total,
+                'components': {component: {'bytes': self.bytes[component], 'count': self.counts[component]}
+                               for component in components},
+                'vertices': self.vertices,
+                'includes': self.include_urls}
+
+    def report(self) -> str:
+        lines = ['{:<12}{:>14}{:>8}{:>10}'.format('component', 'bytes', '%', 'count')]
+        for component in components:
+            lines.append('{:<12}{:>14,}{:>7.1f}%{:>10,}'.format(component, self.bytes[component],
+                                                                100 * self.bytes[component] / max(self.total, 1),
+                                                                self.counts[component]))
+        lines.append('{:<12}{:>14,}  ({:,} vertices)'.format('total', self.total, self.vertices))
+        return '\n'.join(lines)
+
+def _compact_size(value) -> int:
+    return len(json.dumps(value, separators=(',', ':')))
+
+def _count_vertices(coordinates) -> int:
+    if not coordinates:
+        return 0
+    if not isinstance(coordinates[0], list):
+        return 1
+    return sum(_count_vertices(part) for part in coordinates)
+
+def _is_point_list(value) -> bool:
+    return (isinstance(value, list) and len(value) > 0 and isinstance(value[0], list) and 2 <= len(value[0]) <= 3
+            and all(isinstance(item, (int, float)) for item in value[0]))
+
+def _is_encoded(value) -> bool:
+    # Delta or polyline encoded coordinates, see coordinates.CoordinateEncoder
+    return isinstance(value, dict) and {'encoding', 'precision', 'values'} <= set(value)
+
+def _encoded_count(value) -> int:
+    # Polyline strings don't tell their number of points without decoding them
+    return len(value['values']) // 2 if isinstance(value['values'], list) else 0
+
+def _profile_features(profile, features, size, scale):
+    geometry = properties = styles = 0
+    for feature in features:
+        if feature.get('geometry'):
+            geometry += _compact_size(feature['geometry'])
+            profile.vertices += _count_vertices(feature['geometry'].get('coordinates'))
+        for key, value in (feature.get('properties') or {}).items():
+            # Styles embedded per feature by folium, or the colors precomputed for the client
+            if key in ['style', 'highlight'] or key.endswith('_color'):
+                styles += _compact_size({key: value})
+            else:
+                properties += _compact_size({key: value})
+    profile.add('geometry', geometry * scale, len(features))
+    profile.add('properties', properties * scale, len(features))
+    profile.add('styles', styles * scale)
+    profile.add('other', size - (geometry + properties + styles) * scale)
+
+def _profile_literal(profile, value, size):
+    '''
+    Attribute a JSON literal found in the page's scripts to the components
+    '''
+    scale = size / max(_compact_size(value), 1)
+    if isinstance(value, dict) and value.get('type') == 'FeatureCollection':
+        _profile_features(profile, value.get('features') or [], size, scale)
+    elif isinstance(value, dict) and value.get('type') == 'Feature':
+        _profile_features(profile, [value], size, scale)
+    elif _is_encoded(value):
+        profile.add('markers', size, _encoded_count(value))
+    elif isinstance(value, list) and value and all(_is_encoded(frame) for frame in value):
+        profile.add('markers', size, sum(_encoded_count(frame) for frame in value))
+    elif isinstance(value, list) and value and all(isinstance(field, dict) and {'label', 'codes', 'values'} <= set(field)
+                                                   for field in value):
+        # Dictionary encoded popup fields of the bulk marker cluster
+        profile.add('popups', size, len(value[0]['codes']))
+    elif isinstance(value, dict) and value and all(isinstance(entry, dict) for entry in value.values()) \
+            and any(isinstance(style, dict) and 'color' in style
+                    for entry in value.values() for style in entry.values()):
+        # Time slider styledict, {feature id: {timestamp: style}}
+        profile.add('styles', size, len(value))
+    elif _is_point_list(value):
+        profile.add('markers', size, len(value))
+    elif isinstance(value, list) and value and all(_is_point_list(frame) or frame == [] for frame in value):
+        # Heatmap frames, one list of points per frame
+        profile.add('markers', size, sum(len(frame) for frame in value))
+    else:
+        profile.add('other', size)
+
+def _profile_script(profile, script):
+    '''
+    Find the JSON literals in an inline script, leaving the code around them to the 'other' component
+    '''
+    # Legacy markers and popups, a few Leaflet objects per item
+    for component, pattern, counted in object_statements:
+        statements = pattern.findall(script)
+        profile.add(component, sum(len(statement) for statement in statements), len(statements) if counted else 0)
+        script = pattern.sub('', script)
+
+    decoder = json.JSONDecoder()
+    position, literals = 0, 0
+    while True:
+        match = literal_start_pattern.search(script, position)
+        if match is None:
+            break
+        try:
+            value, end = decoder.raw_decode(script, match.start())
+        except ValueError:
+            position = match.start() + 1
+            continue
+        if end - match.start() >= MIN_LITERAL_SIZE:
+            _profile_literal(profile, value, end - match.start())
+            literals += end - match.start()
+        position = end
+    profile.add('other', len(script) - literals)
+
+def profile_html(html) -> PayloadProfile:
+    '''
+    Break the bytes of a generated map page down by component
+    '''
+    if isinstance(html, bytes):
+        html = html.decode('utf-8')
+    profile = PayloadProfile(len(html.encode('utf-8')))
+    remaining = html
+
+    # Library includes, the external scripts and stylesheets the browser fetches on top of the page
+    includes = include_pattern.findall(remaining)
+    profile.add('includes', sum(len(tag) for tag in includes), len(includes))
+    profile.include_urls = [url for tag in includes for url in include_url_pattern.findall(tag)]
+    remaining = include_pattern.sub('', remaining)
+
+    # Legends rendered from the legend template
+    legends = legend_pattern.findall(remaining)
+    profile.add('legend', sum(len(legend) for legend in legends), len(legends))
+    remaining = legend_pattern.sub('', remaining)
+
+    scripts = inline_script_pattern.findall(remaining)
+    for script in scripts:
+        _profile_script(profile, script)
+    profile.add('other', len(remaining) - sum(len(script) for script in scripts))
+
+    # Bytes were counted in characters, attribute the multi-byte characters to the rest of the page
+    profile.bytes['other'] += profile.total - sum(profile.bytes.values())
+    return profile
+
+def profile_streamed(skeleton, blocks) -> PayloadProfile:
+    '''
+    Profile a page written by streaming.write_map from its rendered skeleton and the (block, bytes)
+    of its data blocks, every block being attributed to its own component
+    '''
+    profile = profile_html(skeleton)
+    for block, size in blocks:
+        placeholder = len(block.placeholder)
+        profile.total += size - placeholder
+        profile.bytes['other'] -= placeholder
+        profile.add(block.component, size, block.count)
+    return profile
+
+def profile_map(map_object) -> PayloadProfile:
+    '''
+    Profile a folium Map before it's saved, rendering it the same way Map.save does
+    '''
+    return profile_html(map_object.get_root().render())
+
+def profile_file(path) -> PayloadProfile:
+    with open(path, 'rb') as file:
+        return profile_html(file.read())
+
+def check_budget(profile, filename, budgets=None) -> list:
+    '''
+    Return the budget violations of a page, an empty list when it fits its budget
+    '''
+    budget = (budgets or payload_budgets).get(filename, {})
+    violations = []
+    for component, limit in budget.items():
+        size = profile.total if component == 'total' else profile.bytes[component]
+        if size > limit:
+            violations.append('{} {}: {:,} bytes over the budget of {:,} bytes'.format(filename, component, size, limit))
+    return violations
+
+def enforce_budget(profile, filename, budgets=None):
+    violations = check_budget(profile, filename, budgets)
+    if violations:
+        raise PayloadBudgetError('\n'.join(violations))
+
+if __name__ == '__main__':
+    # Profile the given pages: payload_profiler.py page.html [...]; exits with 1 when any is over budget
+    over_budget = False
+    for path in sys.argv[1:]:
+        profile = profile_file(path)
+        print(path)
+        print(profile.report())
+        for violation in check_budget(profile, os.path.basename(path)):
+            print('Over budget: ' + violation)
+            over_budget = True
+    sys.exit(1 if over_budget else 0)
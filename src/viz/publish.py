@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import uuid
+from datetime import datetime
+import utils
+import instrumentation
+import payload_profiler
+import streaming
+
+script_dir_path = os.path.dirname(os.path.realpath(__file__))
+artifacts_dir_path = os.path.normpath(os.path.join(script_dir_path, '..', 'webapp', 'artifacts'))
+resources_dir_path = os.path.join(artifacts_dir_path, 'resources')
+
+# Where the web app serves the immutable resources
+resources_url_path = '/resources/'
+resource_url_pattern = re.compile(re.escape(resources_url_path) + r'([0-9a-f]{20}\.\w+)')
+
+# Number of published versions kept around for rollbacks
+KEEP_VERSIONS = 5
+
+# Age in seconds under which an unreferenced resource is kept, builds publish their resources before their page
+RESOURCE_GRACE_PERIOD = 6 * 3600
+
+# Growth of a payload component over the live version that gets reported
+PAYLOAD_GROWTH_WARNING = 0.25
+
+# Precompressed variant file extensions
+variant_extensions = {'gzip': '.gz', 'br': '.br'}
+
+def _artifact_dir(filename):
+    return os.path.join(artifacts_dir_path, filename)
+
+def _write_json_atomically(path, content):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(content, file)
+    os.replace(path + '.tmp', path)
+
+def get_published(filename) -> dict:
+    '''
+    Return the information on the live version of an artifact, None if it was never published
+    '''
+    try:
+        with open(os.path.join(_artifact_dir(filename), 'current.json'), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def get_published_path(filename) -> str:
+    published = get_published(filename)
+    if published is None:
+        return None
+    return os.path.join(_artifact_dir(filename), published['version'], filename)
+
+def list_versions(filename) -> list:
+    '''
+    Return the stored versions of an artifact, oldest first
+    '''
+    try:
+        entries = os.listdir(_artifact_dir(filename))
+    except OSError:
+        return []
+    # Staging directories also hold a version.json before they're renamed, they're never versions
+    return sorted(entry for entry in entries if not entry.startswith('.')
+                  and os.path.isfile(os.path.join(_artifact_dir(filename), entry, 'version.json')))
+
+def _activate(filename, version):
+    with open(os.path.join(_artifact_dir(filename), version, 'version.json'), 'r') as file:
+        published = json.load(file)
+    published['activated_at'] = time.time()
+
+    # Renaming the pointer file is atomic, readers see either the old or the new version
+    _write_json_atomically(os.path.join(_artifact_dir(filename), 'current.json'), published)
+    return published
+
+def _prune(filename):
+    live = (get_published(filename) or {}).get('version')
+    for version in list_versions(filename)[:-KEEP_VERSIONS]:
+        if version != live:
+            shutil.rmtree(os.path.join(_artifact_dir(filename), version), ignore_errors=True)
+    _prune_resources()
+
+def _version_resources(filename, version) -> list:
+    '''
+    Return the names of the resources referenced by a version of an artifact. The versions published before
+    the resources were recorded get their file scanned for resource URLs instead, a chunk at a time
+    '''
+    version_dir = os.path.join(_artifact_dir(filename), version)
+    with open(os.path.join(version_dir, 'version.json'), 'r') as file:
+        resources = json.load(file).get('resources')
+    if resources is not None:
+        return resources
+    resources, tail = set(), ''
+    with open(os.path.join(version_dir, filename), 'r', encoding='utf-8', errors='replace') as file:
+        for chunk in iter(lambda: file.read(1 << 20), ''):
+            text = tail + chunk
+            resources.update(resource_url_pattern.findall(text))
+            # Keep enough of the chunk's end for a URL split between two chunks
+            tail = text[-64:]
+    return sorted(resources)
+
+def _referenced_resources() -> set:
+    '''
+    Return the names of the resources referenced by the stored versions of all the artifacts,
+    None when one of them couldn't be read
+    '''
+    referenced = set()
+    try:
+        filenames = [entry for entry in os.listdir(artifacts_dir_path) if entry != 'resources']
+    except OSError:
+        return referenced
+    for filename in filenames:
+        for version in list_versions(filename):
+            try:
+                referenced.update(_version_resources(filename, version))
+            except (OSError, ValueError):
+                return None
+    return referenced
+
+def _prune_resources():
+    '''
+    Remove the resources which none of the stored versions references anymore, together with their variants.
+    Recently published ones are kept, they may belong to a page which another process is still building
+    '''
+    referenced = _referenced_resources()
+    if referenced is None:
+        return
+    try:
+        entries = os.listdir(resources_dir_path)
+    except OSError:
+        return
+    threshold = time.time() - RESOURCE_GRACE_PERIOD
+    for name in entries:
+        path = os.path.join(resources_dir_path, name)
+        if name.endswith('.tmp') or name in referenced or not os.path.isfile(path) or os.stat(path).st_mtime > threshold:
+            continue
+        if any(name.endswith(extension) for extension in variant_extensions.values()):
+            continue
+        # The main file goes first, a resource without it is never served
+        for resource_path in [path] + [path + extension for extension in variant_extensions.values()]:
+            try:
+                os.remove(resource_path)
+            except OSError:
+                pass
+
+def _check_payload(filename, profile):
+    '''
+    Refuse pages over their payload budget, and report the components that grew much over the live version
+    '''
+    payload_profiler.enforce_budget(profile, filename)
+
+    previous = (get_published(filename) or {}).get('payload')
+    if previous is None:
+        return
+    for component, size in profile.bytes.items():
+        before = previous['components'].get(component, {}).get('bytes', 0)
+        if before and size > before * (1 + PAYLOAD_GROWTH_WARNING):
+            print('Payload of {} grew in {}: {:,} -> {:,} bytes'.format(filename, component, before, size))
+
+def _remove_staging(artifact_dir):
+    '''
+    Remove the staging directories left behind by builds killed while publishing. A pipeline runs one build
+    at a time, so no other build of the artifact is staging meanwhile
+    '''
+    try:
+        entries = os.listdir(artifact_dir)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.startswith('.staging-'):
+            shutil.rmtree(os.path.join(artifact_dir, entry), ignore_errors=True)
+
+def _publish(filename, write, metadata=None) -> str:
+    '''
+    Write an artifact into a new version directory together with its gzip and brotli variants, then make it
+    the live version in one atomic step. write(path) writes the artifact and returns extra version info
+    '''
+    artifact_dir = _artifact_dir(filename)
+    _remove_staging(artifact_dir)
+    staging_dir = os.path.join(artifact_dir, '.staging-' + uuid.uuid4().hex)
+    os.makedirs(staging_dir)
+    try:
+        path = os.path.join(staging_dir, filename)
+        info = write(path)
+        # The artifact is hashed and compressed from the file a chunk at a time, it's never held in memory whole
+        with instrumentation.stage('compress'):
+            utils.compress_file(path, {encoding: path + extension for encoding, extension in variant_extensions.items()})
+        fingerprint = utils.file_fingerprint(path)
+
+        sha256 = fingerprint['sha256']
+        version = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f') + '-' + sha256[:8]
+        version_info = dict(metadata or {}, **info, version=version, sha256=sha256, size=fingerprint['size'],
+                            published_at=time.time())
+        with open(os.path.join(staging_dir, 'version.json'), 'w') as file:
+            json.dump(version_info, file)
+        os.rename(staging_dir, os.path.join(artifact_dir, version))
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    _activate(filename, version)
+    _prune(filename)
+    print('Published {} version {}'.format(filename, version))
+    return version
+
+def publish_map(map_object, filename, metadata=None) -> str:
+    '''
+    Render a completed map and make it the live version of the page, unless it's over its payload budget.
+    The data blocks of the page are streamed straight into the file (see streaming.write_map), the resources
+    referenced by the page are recorded in its version info. Returns the version id
+    '''
+    def write(path):
+        with instrumentation.stage('render') as record:
+            with open(path, 'w', encoding='utf-8', newline='') as file:
+                skeleton, blocks = streaming.write_map(map_object, file)
+            record['bytes'] = os.path.getsize(path)
+        with instrumentation.stage('profile') as record:
+            profile = payload_profiler.profile_streamed(skeleton, blocks)
+            record['payload'] = payload = profile.to_dict()
+        _check_payload(filename, profile)
+        # The resource URLs are template values, they're always in the rendered part of the page
+        resources = sorted(set(resource_url_pattern.findall(skeleton)))
+        return {'payload': payload, 'resources': resources}
+    return _publish(filename, write, metadata)
+
+def publish_resource(data, extension) -> str:
+    '''
+    Store immutable content under a name derived from its hash, together with its compressed variants.
+    Content that is already stored is only touched, so it isn't pruned before the page using it gets published.
+    Returns the name of the resource
+    '''
+    name = hashlib.sha256(data).hexdigest()[:20] + extension
+    path = os.path.join(resources_dir_path, name)
+    try:
+        os.utime(path)
+    except OSError:
+        os.makedirs(resources_dir_path, exist_ok=True)
+        # The variants are written first, a resource is complete once its main file exists
+        for encoding, compressed in utils.compress_variants(data).items():
+            with open(path + variant_extensions[encoding] + '.tmp', 'wb') as file:
+                file.write(compressed)
+            os.replace(path + variant_extensions[encoding] + '.tmp', path + variant_extensions[encoding])
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+    return name
+
+def get_resource_path(name) -> str:
+    '''
+    Return the path of a stored resource, None for unknown names
+    '''
+    path = os.path.join(resources_dir_path, os.path.basename(name))
+    return path if os.path.isfile(path) else None
+
+def rollback(filename, version=None) -> str:
+    '''
+    Make an older version live again, by default the one published before the current one
+    '''
+    versions = list_versions(filename)
+    if version is None:
+        live = (get_published(filename) or {}).get('version')
+        older = [v for v in versions if live is None or v < live]
+        if not older:
+            raise ValueError('No older version of ' + filename + ' to roll back to')
+        version = older[-1]
+    elif version not in versions:
+        raise ValueError('Unknown version of ' + filename + ': ' + version)
+
+    _activate(filename, version)
+    print('Rolled {} back to version {}'.format(filename, version))
+    return version
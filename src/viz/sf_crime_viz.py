@@ -1,70 +1,200 @@
 import os
-import requests
 import utils
-import glob
+import coordinates
+import publish
+import layers
+import stage_cache
+import instrumentation
+import numpy as np
 import pandas as pd
+import geopandas as gpd
 import folium
+from shapely.geometry import box
 from branca.element import Template, MacroElement
 from folium.plugins import MarkerCluster
 from config import *
-from sodapy import Socrata
+from incident_store import IncidentStore
 from datetime import datetime, timedelta
 
 script_dir_path = os.path.dirname(os.path.realpath(__file__))
 data_dir_path = os.path.join(script_dir_path, '..', 'data')
+store_dir_path = os.path.join(data_dir_path, 'sf_crime_store')
+seed_csv_path = os.path.join(data_dir_path, 'last_week_SF_crimes.csv')
+
+# San Francisco Police Department Incident Reports dataset id
+dataset_id = 'wg3w-h783'
+
+# Polygon files the incidents can be aggregated into, exported from DataSF into the data folder,
+# with the field naming every polygon
+region_files = {
+    'police_districts': (os.path.join(data_dir_path, 'sf_police_districts.geojson'), 'district'),
+    'neighborhoods': (os.path.join(data_dir_path, 'sf_analysis_neighborhoods.geojson'), 'nhood')
+}
+
+# Extent of the square grid the incidents can be aggregated into instead, (min lon, min lat, max lon, max lat)
+grid_bounds = (-122.52, 37.70, -122.35, 37.84)
+
+# Colors of the aggregated counts, the first one reserved for missing data
+region_colors = ['#808080','#fff5eb','#fee6ce','#fdd0a2','#fdae6b','#fd8d3c','#f16913','#d94801','#a63603','#7f2704']
 pd.set_option('display.max_rows', None)
 
-def download_sf_crime_data():
+def get_incident_store() -> IncidentStore:
     '''
-    Download the latest San Francisco Police Department Incident Reports dataset
+    Return the local incident store, seeded from the bundled last week CSV when it's still empty
+    '''
+    store = IncidentStore(store_dir_path)
+    if store.is_empty() and os.path.exists(seed_csv_path):
+        store.append(pd.read_csv(seed_csv_path, index_col=0))
+    return store
+
+@instrumentation.instrumented('sf_crime_download')
+def download_sf_crime_data(client=None, page_size=50000):
+    '''
+    Download the San Francisco Police Department Incident Reports added or revised since the last fetch
+    into the local incident store. The client can be replaced by anything implementing SocrataClient's get().
+    Raises utils.DownloadError when the fetch fails, leaving the store as it was
     '''
     # Setting up the Socrata API client    
-    client = Socrata('data.sfgov.org', sf_data_token)
-    
-    # Subtracting a day from the current timestamp, since the data updates introduce yesterday's data
-    current_timestamp = datetime.now() - timedelta(days=1)
-    week_before = current_timestamp - timedelta(weeks=1)
-    current_timestamp = current_timestamp.strftime('%Y-%m-%d')
-    week_before = week_before.strftime('%Y-%m-%d')
-    where_clause = 'incident_date between \''  + str(week_before) + 'T00:00:00.000\' and \'' + str(current_timestamp) + 'T00:00:00.000\' ' 
-    
-    # Getting the data with Socrata API and applying an SoQL clause to the downloaded .json
-    try:  
-        results = client.get('wg3w-h783', where=where_clause, limit=100000)
+    if client is None:
+        client = utils.SocrataClient('data.sfgov.org', sf_data_token)
+    store = get_incident_store()
+    high_water_mark = store.high_water_mark()
+    
+    if high_water_mark is None:
+        # First fetch, get the last week; subtracting a day from the current timestamp, since the data updates introduce yesterday's data
+        current_timestamp = datetime.now() - timedelta(days=1)
+        week_before = current_timestamp - timedelta(weeks=1)
+        current_timestamp = current_timestamp.strftime('%Y-%m-%d')
+        week_before = week_before.strftime('%Y-%m-%d')
+        where_clause = 'incident_date between \''  + str(week_before) + 'T00:00:00.000\' and \'' + str(current_timestamp) + 'T00:00:00.000\' ' 
+    else:
+        # Records added or revised since the last fetch, the ones at the mark itself get deduplicated by the store
+        where_clause = ':updated_at >= \'' + high_water_mark + '\''
+    
+    # Getting the data page by page with Socrata API, applying an SoQL clause to the downloaded .json
+    results = []
+    try:
+        while True:
+            page = client.get(dataset_id, select=':*, *', where=where_clause, order=':updated_at, row_id', 
+                              limit=page_size, offset=len(results))
+            results.extend(page)
+            if len(page) < page_size:
+                break
     except Exception as e:
-        print(str(e) + '\nCould not fetch newest dataset.')
-        return
+        raise utils.DownloadError('Could not fetch the newest San Francisco crime data: ' + str(e)) from e
+    
     df_results = pd.DataFrame.from_records(results)
-    df_results.to_csv(os.path.join(data_dir_path, 'last_week_SF_crimes.csv'))
-    print(df_results) 
+    if len(results):
+        high_water_mark = max(df_results[':updated_at'].max(), high_water_mark or '')
+    store.append(df_results, high_water_mark=high_water_mark)
+    print('Fetched {} new or revised incidents'.format(len(results)))
 
-def create_sf_crime_viz():
+def load_sf_crime_data(days):
     '''
-    Load and pre-process the San Francisco crime data
+    Return the incidents of the last days with lat lon data, and their trimmed timestamps
     '''
-    # Load the crime data
-    df_crime = pd.read_csv(os.path.join(data_dir_path, 'last_week_SF_crimes.csv'))
+    # Load the last days of crime data from the incident store
+    df_crime = get_incident_store().load_window(days=days)
     
     # Drop the rows in which there's no lat lon data
     df_crime = df_crime[df_crime['latitude'].notna()]
     df_crime = df_crime[df_crime['longitude'].notna()]
     
-    # Create popups and their contents
-    popups_list, locations_list = [], []
-    for _, row in df_crime.iterrows():
-        # Trim unnecessary information from the timestamp
-        incident_timestamp = row['incident_datetime']
-        incident_timestamp = incident_timestamp.replace('T', ' ')
-        incident_timestamp = incident_timestamp[:-7]
-        
-        # Create a popup object and append it to the popups array
-        popup_content = '<strong>Timestamp: </strong>' + incident_timestamp + '<br>' \
-                        + '<strong>Day of the week: </strong>' + row['incident_day_of_week'] + '<br>' \
-                        + '<strong>Description: </strong>' + row['incident_description']
-        popups_list.append(folium.Popup(html=popup_content))
+    # Trim unnecessary information from the timestamps
+    incident_timestamps = df_crime['incident_datetime'].str.replace('T', ' ').str[:-7]
+    return df_crime, incident_timestamps
+
+def load_sf_regions(regions, grid_size=0.005) -> gpd.GeoDataFrame:
+    '''
+    Return the polygons to aggregate the incidents into, with their names in a 'region' column: one of the
+    region_files, or a square grid of grid_size degrees over the grid_bounds
+    '''
+    if regions == 'grid':
+        min_lon, min_lat, max_lon, max_lat = grid_bounds
+        lons, lats = np.meshgrid(np.arange(min_lon, max_lon, grid_size), np.arange(min_lat, max_lat, grid_size))
+        rows, columns = np.indices(lons.shape)
+        return gpd.GeoDataFrame({'region': ['Cell ' + str(row) + ', ' + str(column) 
+                                            for row, column in zip(rows.ravel(), columns.ravel())]},
+                                geometry=[box(lon, lat, lon + grid_size, lat + grid_size) 
+                                          for lon, lat in zip(lons.ravel(), lats.ravel())],
+                                crs='EPSG:4326')
+    
+    if regions not in region_files:
+        raise ValueError('Unknown regions: ' + str(regions))
+    path, name_field = region_files[regions]
+    if not os.path.exists(path):
+        raise FileNotFoundError('The {} polygons are missing, export them from DataSF as {}'.format(regions, path))
+    gdf_regions = gpd.read_file(path)
+    if gdf_regions.crs is None:
+        gdf_regions.crs = 'EPSG:4326'
+    elif gdf_regions.crs.to_epsg() != 4326:
+        gdf_regions = gdf_regions.to_crs(epsg=4326)
+    gdf_regions = gdf_regions.rename(columns={name_field: 'region'})[['region', 'geometry']]
+    return gdf_regions.reset_index(drop=True)
+
+def aggregate_sf_crime(crime_window, regions, grid_size, top_categories) -> dict:
+    '''
+    Count the incidents of every polygon, in total and for the most frequent categories. The incidents are
+    assigned to the polygons in one bulk spatial join over the polygons' spatial index, rather than testing
+    every point against every polygon. The grid cells without incidents are left out
+    '''
+    df_crime, _ = crime_window
+    gdf_regions = load_sf_regions(regions, grid_size=grid_size)
+    
+    points = gpd.GeoDataFrame({'category': df_crime['incident_category'].fillna('Unknown').to_numpy()},
+                              geometry=gpd.points_from_xy(df_crime['longitude'], df_crime['latitude']),
+                              crs=gdf_regions.crs)
+    joined = gpd.sjoin(points, gdf_regions, how='inner')
+    # A point on a shared boundary intersects both polygons, it's only counted for the first one
+    joined = joined[~joined.index.duplicated()]
+    
+    counts = pd.crosstab(joined['index_right'], joined['category'])
+    categories = counts.sum().sort_values(ascending=False).index[:top_categories].tolist()
+    counts = counts[categories].assign(**{'All incidents': counts.sum(axis=1)})
+    metrics = ['All incidents'] + categories
+    counts = counts[metrics].reindex(gdf_regions.index, fill_value=0)
+    
+    gdf_regions = pd.concat([gdf_regions, counts], axis=1)
+    if regions == 'grid':
+        gdf_regions = gdf_regions[gdf_regions['All incidents'] > 0].reset_index(drop=True)
+    instrumentation.describe_frame('gdf_regions', gdf_regions)
+    return {'regions': gdf_regions, 'metrics': metrics}
+
+@instrumentation.instrumented('sf_crime_build')
+def create_sf_crime_viz(bulk_markers=True, coordinate_encoding='delta', coordinate_precision=6, regions=None,
+                        grid_size=0.005, top_categories=8):
+    '''
+    Create the San Francisco crime map. With bulk_markers the incidents are embedded as compact column arrays
+    and the markers and popups are created on the client, instead of one Popup and Icon object per incident.
+    The coordinates are embedded in the given encoding (see coordinates.CoordinateEncoder).
+    With regions ('police_districts', 'neighborhoods' or 'grid') no markers are drawn, the incidents are 
+    counted per polygon, in total and for the top_categories, and shown as a choropleth; so the size of 
+    the page depends on the number of polygons instead of the number of incidents
+    '''
+    
+    '''
+    Load and pre-process the San Francisco crime data
+    '''
+    store = get_incident_store()
+    crime_stage = stage_cache.stage('sf_crime_window', load_sf_crime_data, inputs={'store': store.fingerprint()},
+                                    params={'days': 7})
+    df_crime, incident_timestamps = crime_stage.result()
+    # The polygons and the per incident markers only take the fixed precision
+    encoder = coordinates.CoordinateEncoder(coordinate_encoding if bulk_markers and regions is None else 'fixed',
+                                      precision=coordinate_precision)
+    
+    if regions is None and not bulk_markers:
+        # Create popups and their contents
+        popups_list = []
+        for (_, row), incident_timestamp in zip(df_crime.iterrows(), incident_timestamps):
+            # Create a popup object and append it to the popups array
+            popup_content = '<strong>Timestamp: </strong>' + incident_timestamp + '<br>' \
+                            + '<strong>Day of the week: </strong>' + row['incident_day_of_week'] + '<br>' \
+                            + '<strong>Description: </strong>' + row['incident_description']
+            popups_list.append(folium.Popup(html=popup_content))
         
-        # Get the lat, lon location data and add it to the list
-        locations_list.append(row[['latitude', 'longitude']].to_numpy().tolist())
+        # Get the lat, lon location data
+        locations_list = encoder.encode(df_crime[['latitude', 'longitude']].to_numpy()).tolist()
     
     ''' 
     Initialize the map
@@ -81,31 +211,74 @@ def create_sf_crime_viz():
     '''
     Create the map content and add it to the map object
     '''
+    legend_labels = None
+    if regions is not None:
+        # Count the incidents per polygon and category, the metrics being switched on the client
+        region_inputs = {}
+        if regions in region_files:
+            region_inputs['regions'] = utils.file_fingerprint(region_files[regions][0])['sha256']
+        aggregated = stage_cache.stage('sf_crime_regions', aggregate_sf_crime, inputs=region_inputs, args=[crime_stage],
+                                       params={'regions': regions, 'grid_size': grid_size, 
+                                               'top_categories': top_categories}).result()
+        gdf_regions, metrics = aggregated['regions'], aggregated['metrics']
+        
+        # Classify all the metrics over the same bins, so they share the legend
+        counts = gdf_regions[metrics].to_numpy(dtype=float)
+        bins = utils.classify_bins(counts, k=len(region_colors) - 1, scheme='geometric')
+        color_index = utils.classify(counts, bins)
+        gdf_regions = encoder.encode_geometries(gdf_regions)
+        for i, name in enumerate(metrics):
+            gdf_regions[name + '_color'] = np.take(region_colors, color_index[:, i])
+        choropleth = layers.SharedGeometryChoropleth(data=gdf_regions, metrics=metrics, name_field='region')
+        map_crime.add_child(choropleth)
+        
+        # The empty FeatureGroups are the LayerControl switches between the metrics
+        for i, name in enumerate(metrics):
+            folium.FeatureGroup(name, overlay=False, show=(i == 0)).add_to(map_crime)
+        folium.LayerControl(collapsed=True).add_to(map_crime)
+        legend_labels = utils.create_legend_labels(bins, region_colors, decimals=0)
     # Create marker cluster
-    icon_list = []
-    for _ in range(len(locations_list)):
-        icon_list.append(folium.Icon(icon='exclamation', prefix='fa', color='orange'))
-
-    marker_cluster = MarkerCluster(locations=locations_list, popups=popups_list, icons=icon_list)
-    marker_cluster.add_to(map_crime)
+    elif bulk_markers:
+        # Column arrays embedded once, popups rendered on the client when a marker is clicked
+        marker_cluster = layers.BulkMarkerCluster(locations=df_crime[['latitude', 'longitude']].to_numpy(),
+                                                  popup_fields={
+                                                      'Timestamp': incident_timestamps,
+                                                      'Day of the week': df_crime['incident_day_of_week'],
+                                                      'Description': df_crime['incident_description']
+                                                  },
+                                                  icon_options={'icon': 'exclamation', 'prefix': 'fa', 'markerColor': 'orange'},
+                                                  encoder=encoder)
+        marker_cluster.add_to(map_crime)
+        encoder.add_decoder(map_crime)
+    else:
+        icon_list = []
+        for _ in range(len(locations_list)):
+            icon_list.append(folium.Icon(icon='exclamation', prefix='fa', color='orange'))
+        
+        marker_cluster = MarkerCluster(locations=locations_list, popups=popups_list, icons=icon_list)
+        marker_cluster.add_to(map_crime)
     
-    # Create map legend
-    current_timestamp = datetime.now() - timedelta(days=1)
-    week_before = current_timestamp - timedelta(weeks=1)
-    current_timestamp = current_timestamp.strftime('%Y-%m-%d')
-    week_before = week_before.strftime('%Y-%m-%d')
+    # Create map legend, spanning the dates of the stored window
+    incident_dates = pd.to_datetime(df_crime['incident_date'])
+    current_timestamp = incident_dates.max().strftime('%Y-%m-%d')
+    week_before = incident_dates.min().strftime('%Y-%m-%d')
     
-    template = utils.create_legend(caption='San Francisco crimes between ' + week_before + ' and ' + current_timestamp)
+    template = utils.create_legend(caption='San Francisco crimes between ' + week_before + ' and ' + current_timestamp,
+                                   legend_labels=legend_labels)
     macro = MacroElement()
     macro._template = Template(template)
     map_crime.get_root().add_child(macro)  
     
     '''
-    Save completed map viz to an appropriate folder
+    Publish the completed map viz as the new live version
     '''
-    map_crime.save(os.path.join(script_dir_path, '..', 'webapp', 'templates', 'SF_crime_viz.html'))
+    encoder.print_report('SF_crime_viz.html')
+    publish.publish_map(map_crime, 'SF_crime_viz.html', metadata={'coordinates': encoder.report()})
     print('Successfully created the San Francisco crime viz!')    
     
 if __name__ == '__main__':
-    download_sf_crime_data()
+    try:
+        download_sf_crime_data()
+    except utils.DownloadError as e:
+        print(str(e) + '\nBuilding from the stored incidents.')
     create_sf_crime_viz()
\ No newline at end of file
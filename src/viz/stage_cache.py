@@ -0,0 +1,125 @@
+import os
+import time
+import pickle
+import threading
+import utils
+import instrumentation
+
+stages_dir_path = os.path.join(utils.cache_dir_path, 'stages')
+
+# Bump whenever the pickled layout of the stage results changes, so that old entries get discarded
+CACHE_VERSION = 1
+
+class Stage:
+    '''
+    A named step of a build pipeline. Its key covers the stage name and version, the hashes of its inputs,
+    the keys of the upstream stages it takes as arguments and its parameters, so equal keys mean equal results.
+    The result is computed (or read from the cache) only when asked for, which means that the upstream
+    stages of a cached stage never run at all
+    '''
+    def __init__(self, cache, name, function, inputs=None, args=(), params=None, version=1):
+        self.cache = cache
+        self.name = name
+        self.function = function
+        self.args = args
+        self.params = params or {}
+        self.key = utils.hash_inputs({'cache_version': CACHE_VERSION,
+                                      'stage': name,
+                                      'version': version,
+                                      'inputs': inputs or {},
+                                      'upstream': [arg.key if isinstance(arg, Stage) else arg for arg in args],
+                                      'params': self.params})
+
+    def result(self):
+        if not hasattr(self, '_result'):
+            self._result = self.cache.get_or_run(self)
+        return self._result
+
+    def run(self):
+        args = [arg.result() if isinstance(arg, Stage) else arg for arg in self.args]
+        return self.function(*args, **self.params)
+
+class StageCache:
+    '''
+    Content-addressed on-disk cache of the intermediate results of the build pipelines.
+    The least recently used entries are evicted once the cache grows past max_bytes
+    '''
+    def __init__(self, directory=stages_dir_path, max_bytes=512 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def stage(self, name, function, inputs=None, args=(), params=None, version=1) -> Stage:
+        return Stage(self, name, function, inputs=inputs, args=args, params=params, version=version)
+
+    def _entry_path(self, stage) -> str:
+        return os.path.join(self.directory, stage.name + '-' + stage.key + '.pkl')
+
+    def get_or_run(self, stage):
+        with instrumentation.stage(stage.name, key=stage.key) as record:
+            result, record['cached'] = self._get_or_run(stage)
+        return result
+
+    def _get_or_run(self, stage):
+        path = self._entry_path(stage)
+        start = time.perf_counter()
+        try:
+            with open(path, 'rb') as file:
+                result = pickle.load(file)
+            # The mtime tracks the last use of an entry for the LRU eviction
+            os.utime(path)
+            print('Stage {} reused from the cache in {:.3f}s'.format(stage.name, time.perf_counter() - start))
+            return result, True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(str(e) + '\nCould not load the cached {} stage, running it again.'.format(stage.name))
+
+        result = stage.run()
+        print('Stage {} ran in {:.3f}s'.format(stage.name, time.perf_counter() - start))
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'wb') as file:
+                pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            self.evict()
+        except Exception as e:
+            print(str(e) + '\nCould not cache the {} stage.'.format(stage.name))
+        return result, False
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in max_bytes
+        '''
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                try:
+                    if name.endswith('.pkl'):
+                        stat = os.stat(os.path.join(self.directory, name))
+                        entries.append((stat.st_mtime, stat.st_size, name))
+                except OSError:
+                    # Removed meanwhile by a build running in another process
+                    pass
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        with self._lock:
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    os.remove(os.path.join(self.directory, name))
+
+# Cache shared by all the viz modules
+stage_cache = StageCache()
+
+def stage(name, function, inputs=None, args=(), params=None, version=1) -> Stage:
+    return stage_cache.stage(name, function, inputs=inputs, args=args, params=params, version=version)
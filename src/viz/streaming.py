@@ -0,0 +1,128 @@
+import re
+import json
+import uuid
+import threading
+import weakref
+import itertools
+import numpy as np
+
+# Rows of an array, or items of a list, serialized at once
+CHUNK_ROWS = 16384
+
+placeholder_pattern = re.compile(r'__data_block_[0-9a-f]{32}__')
+
+# Every live data block by its placeholder, for write_map to find the blocks of a rendered page
+_blocks = weakref.WeakValueDictionary()
+
+# Whether the blocks render as their placeholders in the current thread, which they do inside write_map
+_local = threading.local()
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+def _dumps(value) -> str:
+    return json.dumps(value, separators=(',', ':'), default=_json_default)
+
+def _is_container(value) -> bool:
+    # Series, Index and DataFrame are recognized by their to_numpy, so that pandas isn't imported by the web process
+    return isinstance(value, (dict, list, tuple, np.ndarray, DataBlock)) or hasattr(value, 'to_numpy')
+
+def iter_json(value):
+    '''
+    Serialize a value into compact JSON text chunks. Numpy arrays and long lists are written a slice
+    of rows at a time and GeoDataFrames a feature at a time, so only one chunk is ever built in memory
+    '''
+    if isinstance(value, DataBlock):
+        yield from value.chunks()
+    elif hasattr(value, 'iterfeatures'):
+        # GeoDataFrame, written as a FeatureCollection like its to_json
+        yield '{"type":"FeatureCollection","features":['
+        for i, feature in enumerate(value.iterfeatures(na='null', show_bbox=False)):
+            yield (',' if i else '') + _dumps(feature)
+        yield ']}'
+    elif hasattr(value, 'to_numpy'):
+        # Series and Index
+        yield from iter_json(value.to_numpy())
+    elif isinstance(value, np.ndarray) and value.ndim > 0:
+        yield '['
+        for start in range(0, len(value), CHUNK_ROWS):
+            yield (',' if start else '') + _dumps(value[start:start + CHUNK_ROWS].tolist())[1:-1]
+        yield ']'
+    elif isinstance(value, dict) and any(_is_container(item) for item in value.values()):
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            yield (',' if i else '') + _dumps(str(key)) + ':'
+            yield from iter_json(item)
+        yield '}'
+    elif isinstance(value, (list, tuple)) and any(_is_container(item) for item in value):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ','
+            yield from iter_json(item)
+        yield ']'
+    elif isinstance(value, (list, tuple)) and len(value) > CHUNK_ROWS:
+        yield '['
+        for start in range(0, len(value), CHUNK_ROWS):
+            yield (',' if start else '') + _dumps(list(value[start:start + CHUNK_ROWS]))[1:-1]
+        yield ']'
+    else:
+        yield _dumps(value)
+
+class DataBlock:
+    '''
+    Large JSON data embedded in a map template with {{ this.attribute }}. When a page is written with
+    write_map the template only renders a placeholder, which gets replaced by the data streamed from
+    its source arrays; anywhere else the block renders as its whole JSON text. With a function name the JSON is
+    passed through that client side function, to decode it. The component and count feed the payload profile
+    of the streamed page
+    '''
+    def __init__(self, value, component='other', count=None, function=None):
+        self.value = value
+        self.component = component
+        self.count = len(value) if count is None else count
+        self.function = function
+        self.placeholder = '__data_block_' + uuid.uuid4().hex + '__'
+        _blocks[self.placeholder] = self
+
+    def chunks(self):
+        if self.function is None:
+            return iter_json(self.value)
+        return itertools.chain([self.function + '('], iter_json(self.value), [')'])
+
+    def __len__(self):
+        return len(self.value)
+
+    def __str__(self):
+        if getattr(_local, 'placeholders', False):
+            return self.placeholder
+        return ''.join(self.chunks())
+
+def write_map(map_object, file) -> tuple:
+    '''
+    Write a folium Map into a text file object the way Map.save does, but without holding the page in memory:
+    the page is rendered with placeholders for its data blocks, which are streamed in between the rendered parts.
+    Returns the rendered page with the placeholders and the (block, bytes written) of every block
+    '''
+    _local.placeholders = True
+    try:
+        skeleton = map_object.get_root().render()
+    finally:
+        _local.placeholders = False
+
+    blocks = []
+    position = 0
+    for match in placeholder_pattern.finditer(skeleton):
+        file.write(skeleton[position:match.start()])
+        block, size = _blocks[match.group(0)], 0
+        for chunk in block.chunks():
+            file.write(chunk)
+            size += len(chunk.encode('utf-8'))
+        blocks.append((block, size))
+        position = match.end()
+    file.write(skeleton[position:])
+    return skeleton, blocks
@@ -0,0 +1,226 @@
+import numpy as np
+
+def _polygons(geometry) -> list:
+    if geometry is None or geometry.is_empty:
+        return []
+    if geometry.geom_type == 'Polygon':
+        return [geometry]
+    if geometry.geom_type == 'MultiPolygon':
+        return list(geometry.geoms)
+    raise ValueError('Unsupported geometry type: ' + geometry.geom_type)
+
+def _quantize_ring(ring, x0, y0, kx, ky) -> list:
+    '''
+    Quantize a ring into a closed list of integer points, dropping the consecutive points falling onto
+    the same position. Returns None for the rings collapsing into fewer than three distinct points
+    '''
+    points = np.round((np.asarray(ring.coords)[:, :2] - [x0, y0]) / [kx, ky]).astype(np.int64)
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    points = [tuple(point) for point in points[keep].tolist()]
+    if points[-1] != points[0]:
+        points.append(points[0])
+    return points if len(points) >= 4 else None
+
+def _extract_arcs(rings) -> tuple:
+    '''
+    Cut the closed rings into arcs at their junctions, the points where the neighbours of a point differ
+    between the rings passing through it, and store every arc once. Returns the arcs and, for every ring,
+    the indices of its arcs, ~index standing for an arc walked in reverse
+    '''
+    neighbours, junctions = {}, set()
+    for ring in rings:
+        for i in range(len(ring) - 1):
+            previous, following = ring[i - 1] if i else ring[-2], ring[i + 1]
+            pair = (previous, following) if previous <= following else (following, previous)
+            seen = neighbours.setdefault(ring[i], pair)
+            if seen != pair:
+                junctions.add(ring[i])
+
+    arcs, arc_index = [], {}
+    def add_arc(arc):
+        index = arc_index.get(tuple(arc))
+        if index is not None:
+            return index
+        index = arc_index.get(tuple(reversed(arc)))
+        if index is not None:
+            return ~index
+        arcs.append(arc)
+        arc_index[tuple(arc)] = len(arcs) - 1
+        return len(arcs) - 1
+
+    ring_arcs = []
+    for ring in rings:
+        points = ring[:-1]
+        cuts = [i for i, point in enumerate(points) if point in junctions]
+        if not cuts:
+            # A ring meeting no other ring is a single closed arc, starting at its smallest point so that
+            # the other copies of the ring are recognized whatever their start
+            start = points.index(min(points))
+            points = points[start:] + points[:start]
+            ring_arcs.append([add_arc(points + points[:1])])
+            continue
+        points = points[cuts[0]:] + points[:cuts[0]]
+        points.append(points[0])
+        cuts = [cut - cuts[0] for cut in cuts] + [len(points) - 1]
+        ring_arcs.append([add_arc(points[start:end + 1]) for start, end in zip(cuts[:-1], cuts[1:])])
+    return arcs, ring_arcs
+
+def _simplify_arc(arc, tolerance, kx, ky) -> list:
+    '''
+    Douglas-Peucker simplification of a quantized arc with the tolerance in degrees. The endpoints are kept,
+    being junctions shared with other arcs, as well as enough points for the rings to keep an area
+    '''
+    points = np.asarray(arc, dtype=float) * [kx, ky]
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    # Closed arcs need two more points to stay a ring, the others one more not to collapse onto their chord
+    minimum = min(len(points), 4 if arc[0] == arc[-1] else 3)
+    kept = 2
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        chord = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(chord[0], chord[1])
+        if length:
+            distances = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / length
+        else:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance or kept < minimum:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            kept += 1
+            stack += [(start, middle), (middle, end)]
+    return [point for point, kept_point in zip(arc, keep) if kept_point]
+
+def to_topojson(gdf, properties, quantization=100000, object_name='borders', id_field=None, tolerance=None) -> dict:
+    '''
+    Encode the polygons of a GeoDataFrame as a quantized, delta-encoded TopoJSON topology. The rings are cut
+    into arcs where they meet, so a border shared by two polygons is stored once and, when a tolerance in
+    degrees is given, simplified once, leaving no gaps or overlaps between the neighbours.
+    Only the listed properties are kept
+    '''
+    x0, y0, x1, y1 = gdf.total_bounds
+    kx = (x1 - x0) / (quantization - 1) or 1
+    ky = (y1 - y0) / (quantization - 1) or 1
+
+    # Quantized rings of every feature's polygons, the rings collapsed by the quantization being dropped
+    rings, features = [], []
+    for geometry in gdf.geometry:
+        polygons = []
+        for polygon in _polygons(geometry):
+            exterior = _quantize_ring(polygon.exterior, x0, y0, kx, ky)
+            if exterior is None:
+                continue
+            polygon_rings = [exterior] + [ring for ring in (_quantize_ring(interior, x0, y0, kx, ky)
+                                                           for interior in polygon.interiors) if ring is not None]
+            polygons.append(list(range(len(rings), len(rings) + len(polygon_rings))))
+            rings += polygon_rings
+        features.append(polygons)
+
+    arcs, ring_arcs = _extract_arcs(rings)
+    if tolerance:
+        arcs = [_simplify_arc(arc, tolerance, kx, ky) for arc in arcs]
+    encoded_arcs = [np.diff(np.asarray(arc, dtype=np.int64), axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).tolist()
+                    for arc in arcs]
+
+    geometries = []
+    for (_, row), polygons in zip(gdf.iterrows(), features):
+        polygons = [[ring_arcs[ring] for ring in polygon] for polygon in polygons]
+        entry = {'properties': {field: row[field] for field in properties}}
+        if id_field is not None:
+            entry['id'] = row[id_field]
+        if len(polygons) == 1:
+            entry.update(type='Polygon', arcs=polygons[0])
+        elif polygons:
+            entry.update(type='MultiPolygon', arcs=polygons)
+        else:
+            entry['type'] = None
+        geometries.append(entry)
+
+    return {'type': 'Topology',
+            'transform': {'scale': [kx, ky], 'translate': [x0, y0]},
+            'bbox': [x0, y0, x1, y1],
+            'objects': {object_name: {'type': 'GeometryCollection', 'geometries': geometries}},
+            'arcs': encoded_arcs}
+
+# Client side decoder of the topologies above, turning an object back into a GeoJSON FeatureCollection
+topojson_decoder_js = '''
+function topojsonFeatures(topology, name) {
+    var scale = topology.transform.scale, translate = topology.transform.translate;
+    var decoded = topology.arcs.map(function(arc) {
+        var x = 0, y = 0;
+        return arc.map(function(delta) {
+            x += delta[0];
+            y += delta[1];
+            return [x * scale[0] + translate[0], y * scale[1] + translate[1]];
+        });
+    });
+    var ring = function(indices) {
+        var points = [];
+        indices.forEach(function(index, k) {
+            var arc = index < 0 ? decoded[~index].slice().reverse() : decoded[index];
+            points = points.concat(k ? arc.slice(1) : arc);
+        });
+        return points;
+    };
+    var polygon = function(rings) { return rings.map(ring); };
+    return {
+        type: 'FeatureCollection',
+        features: topology.objects[name].geometries.map(function(geometry) {
+            var coordinates = null;
+            if (geometry.type === 'Polygon') {
+                coordinates = polygon(geometry.arcs);
+            } else if (geometry.type === 'MultiPolygon') {
+                coordinates = geometry.arcs.map(polygon);
+            }
+            return {
+                type: 'Feature',
+                id: geometry.id,
+                properties: geometry.properties || {},
+                geometry: geometry.type ? {type: geometry.type, coordinates: coordinates} : null
+            };
+        })
+    };
+}
+'''
+
+# Client side loader of the levels of detail of a topology, [{'url': ..., 'min_zoom': ...}] ordered by min_zoom.
+# The level matching the zoom is fetched when first needed and handed to apply(features) as a GeoJSON
+# FeatureCollection; a level arriving after the zoom moved on to another one is only kept for later
+border_levels_js = '''
+function borderLevels(map, levels, name, apply) {
+    var loaded = {}, wanted = -1, shown = -1;
+    var load = function(index) {
+        if (!loaded[index]) {
+            loaded[index] = fetch(levels[index].url).then(function(response) {
+                if (!response.ok) { throw new Error(levels[index].url + ': ' + response.status); }
+                return response.json();
+            }).then(function(topology) {
+                return topojsonFeatures(topology, name);
+            });
+        }
+        return loaded[index];
+    };
+    var update = function() {
+        var zoom = map.getZoom(), index = 0;
+        levels.forEach(function(level, k) {
+            if (level.min_zoom <= zoom) { index = k; }
+        });
+        if (index === wanted) { return; }
+        wanted = index;
+        load(index).then(function(features) {
+            if (wanted === index && shown !== index) {
+                shown = index;
+                apply(features);
+            }
+        });
+    };
+    map.on('zoomend', update);
+    update();
+}
+'''
@@ -2,41 +2,192 @@ import folium
 import os
 import pandas as pd
 import numpy as np
+import json
+import time
+import shutil
 import utils
+import coordinates
+import publish
+import stage_cache
+import instrumentation
+import streaming
 from folium.plugins import HeatMapWithTime
 from branca.element import Template, MacroElement
 
 script_dir_path = os.path.dirname(os.path.realpath(__file__))
+df_accidents_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'Accidents1115.csv'))
+accidents_cache_path = os.path.join(utils.cache_dir_path, 'accidents')
 
-def create_uk_accidents_viz():
+# Bump whenever the ingest below changes, so that old caches get discarded
+CACHE_VERSION = 1
+
+# Columns of the ingest cache and their compact dtypes
+cache_columns = {
+    'date': 'datetime64[D]',
+    'hour': 'int8',
+    'latitude': 'float32',
+    'longitude': 'float32',
+    'severity': 'int8'
+}
+
+# Heatmap frame granularities and the format of their slider labels
+frame_formats = {
+    'day': '%Y-%m-%d %A',
+    'week': '%Y-%m-%d (week %W)',
+    'hour': '%Y-%m-%d %A %H:00'
+}
+
+def ingest_accidents_data(chunksize=500000) -> dict:
     '''
-    Load and pre-process the UK accidents data
+    Read the accidents CSV in chunks with compact dtypes, drop the rows without lat lon data, 
+    sort them by date and hour and return the cleaned columns as NumPy arrays
+    '''
+    header = pd.read_csv(df_accidents_path, nrows=0).columns
+    fields = ['Latitude', 'Longitude', 'Date', 'Accident_Severity']
+    if 'Time' in header:
+        fields.append('Time')
+    dtypes = {'Latitude': 'float32', 'Longitude': 'float32', 'Accident_Severity': 'int8', 'Date': 'str', 'Time': 'str'}
+    
+    chunks = {column: [] for column in cache_columns}
+    for df_chunk in pd.read_csv(df_accidents_path, usecols=fields, dtype=dtypes, chunksize=chunksize):
+        # Drop the rows in which there's no lat lon data
+        df_chunk = df_chunk[df_chunk['Latitude'].notna() & df_chunk['Longitude'].notna()]
+        
+        chunks['date'].append(pd.to_datetime(df_chunk['Date'], format='%Y-%m-%d', errors='raise').to_numpy().astype('datetime64[D]'))
+        if 'Time' in df_chunk:
+            hours = pd.to_numeric(df_chunk['Time'].str[:2], errors='coerce').fillna(0)
+        else:
+            hours = np.zeros(len(df_chunk))
+        chunks['hour'].append(np.asarray(hours, dtype=np.int8))
+        chunks['latitude'].append(df_chunk['Latitude'].to_numpy())
+        chunks['longitude'].append(df_chunk['Longitude'].to_numpy())
+        chunks['severity'].append(df_chunk['Accident_Severity'].to_numpy())
+    
+    columns = {column: np.concatenate(chunks[column]).astype(dtype) for column, dtype in cache_columns.items()}
+    
+    # Sort by date and hour, so that every heatmap frame is a contiguous block of rows
+    order = np.lexsort((columns['hour'], columns['date']))
+    return {column: values[order] for column, values in columns.items()}
+
+def _read_source_meta():
+    try:
+        with open(os.path.join(accidents_cache_path, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return meta.get('source') if meta.get('version') == CACHE_VERSION else None
+
+def get_source_fingerprint() -> dict:
+    '''
+    Return the fingerprint of the accidents CSV, reusing the cached hash while the file is untouched
+    '''
+    return utils.file_fingerprint(df_accidents_path, previous=_read_source_meta())
+
+def load_accidents_data() -> dict:
+    '''
+    Return the cleaned accidents columns memory-mapped from the ingest cache in the data/cache folder. 
+    The CSV is only ingested again when its hash changes; the source file itself is never rewritten
+    '''
+    meta_path = os.path.join(accidents_cache_path, 'meta.json')
+    previous = _read_source_meta()
+    fingerprint = utils.file_fingerprint(df_accidents_path, previous=previous)
+    columns_path = os.path.join(accidents_cache_path, fingerprint['sha256'])
+    
+    stale = previous is None or previous['sha256'] != fingerprint['sha256'] or not os.path.isdir(columns_path)
+    if stale:
+        start = time.perf_counter()
+        columns = ingest_accidents_data()
+        
+        # Replace the old cache, writing the metadata last so that a partial cache is never picked up
+        if os.path.isdir(accidents_cache_path):
+            shutil.rmtree(accidents_cache_path)
+        os.makedirs(columns_path)
+        for column, values in columns.items():
+            np.save(os.path.join(columns_path, column + '.npy'), values)
+        print('Ingested {} accidents in {:.3f}s'.format(len(columns['date']), time.perf_counter() - start))
+    
+    if stale or previous != fingerprint:
+        with open(meta_path, 'w') as file:
+            json.dump({'version': CACHE_VERSION, 'source': fingerprint}, file)
+    
+    return {column: np.load(os.path.join(columns_path, column + '.npy'), mmap_mode='r') for column in cache_columns}
+
+def get_frame_starts(dates, hours, frame):
+    '''
+    Return the start of the heatmap frame every accident belongs to
+    '''
+    if frame == 'day':
+        return dates
+    if frame == 'week':
+        # 1970-01-01 was a Thursday, shift the day numbers so that weeks start on Monday
+        return dates - (dates.astype(np.int64) + 3) % 7
+    if frame == 'hour':
+        return dates.astype('datetime64[h]') + hours.astype(np.int64)
+    raise ValueError('Unknown heatmap frame: ' + str(frame))
+
+def create_heatmap_data(start_year, end_year, frame, cell_size, cell_shape, weight_by_severity):
+    '''
+    Return the heatmap frame labels and the heatmap data of every frame, an array of either the raw accident
+    locations or the [lat, lon(, weight)] cells the accidents are aggregated into. The coordinates are kept
+    at full precision, they're encoded when the map is built
     '''
     # Load the accidents data
-    df_accidents_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'Accidents1115.csv'))
-    fields = ['Accident_Index', 'Latitude', 'Longitude', 'Date', 'Accident_Severity']
-    df_accidents = pd.read_csv(df_accidents_path, index_col='Accident_Index', usecols=fields)
+    accidents = load_accidents_data()
 
-    # Format and sort by date
-    df_accidents['Date'] = pd.to_datetime(df_accidents['Date'], format='%Y-%m-%d', errors='raise')
-    df_accidents.sort_values('Date', inplace=True)
+    # Leave only the accidents from the requested years, a zero-copy slice since the rows are sorted by date
+    first, last = np.searchsorted(accidents['date'], [np.datetime64(str(start_year) + '-01-01'),
+                                                      np.datetime64(str(end_year + 1) + '-01-01')])
+    dates, hours = accidents['date'][first:last], accidents['hour'][first:last]
+    latitudes, longitudes = accidents['latitude'][first:last], accidents['longitude'][first:last]
 
-    # Drop the rows in which there's no lat lon data
-    df_accidents = df_accidents[df_accidents['Latitude'].notna()]
+    # Get the heatmap index values and the frame every accident belongs to
+    frame_starts = get_frame_starts(dates, hours, frame)
+    frame_index, block_starts, frame_ids = np.unique(frame_starts, return_index=True, return_inverse=True)
+    heatmap_time_dates = pd.DatetimeIndex(frame_index).strftime(frame_formats[frame]).tolist()
 
-    df_accidents.to_csv(df_accidents_path)
+    if cell_size is None:
+        # Split the raw locations into the heatmap data in a single pass
+        locations = np.column_stack([latitudes, longitudes]).astype(np.float64)
+        heatmap_time_data = np.split(locations, block_starts[1:])
+    else:
+        # Aggregate the accidents into [lat, lon, weight] grid cells per frame, fatal accidents weighing the most
+        alphas = (4 - accidents['severity'][first:last]) / 3 if weight_by_severity else None
+        cell_frames, cell_latitudes, cell_longitudes, weights = utils.aggregate_points(latitudes, longitudes, frame_ids,
+                                                                                      cell_size=cell_size, shape=cell_shape,
+                                                                                      alphas=alphas)
+        cells = np.column_stack([cell_latitudes, cell_longitudes, np.round(weights, 3)])
+        if alphas is None:
+            # Every cell weighs 1, which is the heatmap's default weight
+            cells = cells[:, :2]
+        cell_block_starts = np.searchsorted(cell_frames, np.arange(len(frame_index)))
+        heatmap_time_data = np.split(cells, cell_block_starts[1:])
+        print('Aggregated {} accidents into {} heatmap cells'.format(len(latitudes), len(cells)))
     
-    # Leave only the 2015 accidents
-    df_accidents = df_accidents[df_accidents['Date'].dt.year == 2015]
+    return heatmap_time_dates, heatmap_time_data
 
-    # Get the heatmap index values
-    heatmap_time_dates = df_accidents['Date'].dt.strftime('%Y-%m-%d %A').unique().tolist()
+@instrumentation.instrumented('uk_accidents_build')
+def create_uk_accidents_viz(start_year=2015, end_year=2015, frame='day', cell_size=None, cell_shape='square',
+                            weight_by_severity=False, coordinate_encoding='fixed', coordinate_precision=5):
+    '''
+    Create the UK accidents heatmap for the given range of years, with one heatmap frame per day, week or hour.
+    With a cell_size (in degrees) the accidents are aggregated into square or hex cells for every frame,
+    so the payload grows with the number of occupied cells instead of the number of accidents.
+    The coordinates are embedded in the given encoding (see coordinates.CoordinateEncoder).
+    The heatmap data is cached, keyed by the hash of the CSV and the parameters above
+    '''
+    
+    '''
+    Load and pre-process the UK accidents data
+    '''
+    heatmap_stage = stage_cache.stage('uk_accidents_heatmap', create_heatmap_data,
+                                      inputs={'accidents': get_source_fingerprint()['sha256']},
+                                      params={'start_year': start_year, 'end_year': end_year, 'frame': frame,
+                                              'cell_size': cell_size, 'cell_shape': cell_shape,
+                                              'weight_by_severity': weight_by_severity},
+                                      version=3)
+    heatmap_time_dates, heatmap_time_data = heatmap_stage.result()
 
-    # Get the heatmap data
-    heatmap_time_data = []
-    for date in heatmap_time_dates:
-        df_accidents_daily = df_accidents.loc[df_accidents['Date'] == date]
-        heatmap_time_data.append(df_accidents_daily[['Latitude', 'Longitude']].to_numpy().tolist())
+    years_label = str(start_year) if start_year == end_year else str(start_year) + '-' + str(end_year)
 
     '''    
     Initialize the map
@@ -53,10 +204,15 @@ def create_uk_accidents_viz():
     '''
     Create the map content and add it to the map object
     '''
-    # Create the HeatMapWithTime
-    heatmap = HeatMapWithTime(heatmap_time_data, 
+    # Create the HeatMapWithTime, its encoded frames are streamed into the page from the arrays
+    encoder = coordinates.CoordinateEncoder(coordinate_encoding, precision=coordinate_precision)
+    heatmap_frames = streaming.DataBlock(encoder.encode_frames(heatmap_time_data), 'markers',
+                                         count=sum(len(frame) for frame in heatmap_time_data),
+                                         function='decodeCoordinateFrames' if encoder.decoded_on_client else None)
+    encoder.add_decoder(map_accidents)
+    heatmap = HeatMapWithTime(heatmap_frames, 
                             index=heatmap_time_dates, 
-                            name='Traffic accidents in Great Britain (2015)', 
+                            name='Traffic accidents in Great Britain (' + years_label + ')', 
                             gradient={
                                 .8: 'blue',
                                 .95: 'lime',
@@ -70,15 +226,16 @@ def create_uk_accidents_viz():
     heatmap.add_to(map_accidents)
 
     # Create the legend
-    template = utils.create_legend(caption='UK traffic accidents in 2015')
+    template = utils.create_legend(caption='UK traffic accidents in ' + years_label)
     macro = MacroElement()
     macro._template = Template(template)
     map_accidents.get_root().add_child(macro) 
 
     '''
-    Save completed map viz to an appropriate folder
+    Publish the completed map viz as the new live version
     '''
-    map_accidents.save(os.path.join(script_dir_path, '..', 'webapp', 'templates', 'UK_accidents_viz.html'))
+    encoder.print_report('UK_accidents_viz.html')
+    publish.publish_map(map_accidents, 'UK_accidents_viz.html', metadata={'coordinates': encoder.report()})
     print('Successfully created the UK accidents viz!')
 
 if __name__ == '__main__':
@@ -1,25 +1,248 @@
 import os
 import requests
-import urllib
-from logging import log
-from branca.element import Template, MacroElement
+import requests.adapters
+import hashlib
+import asyncio
+import functools
+import threading
+import collections
+import gzip
+import json
+import time
+import numpy as np
+import instrumentation
+
+# brotli is optional, without it only the gzip variants get produced
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Brotli quality of the precompressed variants. Quality 11 takes seconds per megabyte, so the content
+# from BROTLI_LARGE_SIZE bytes up gets a cheaper quality, which compresses about ten percent worse
+BROTLI_QUALITY = 11
+BROTLI_LARGE_QUALITY = 9
+BROTLI_LARGE_SIZE = 1 << 20
 
 script_dir_path = os.path.dirname(os.path.realpath(__file__))
+cache_dir_path = os.path.normpath(os.path.join(script_dir_path, '..', 'data', 'cache'))
 
-def download_file(download_url='', location='', filename=''):
-    if not download_url:
-        raise AttributeError('Error. No url provided')
-    if not filename:
-        filename = download_url[download_url.rfind('/')+1:]
-    if location:
-        location = os.path.join(location, filename)
-    else:
-        location = filename
+class DownloadError(Exception):
+    '''
+    Raised by the download functions of the viz modules when the source couldn't be fetched; 
+    the data cached by the previous fetches is left as it was
+    '''
+    pass
+
+class ChecksumError(DownloadError):
+    pass
+
+# Statuses worth retrying, anything else is reported right away
+retry_statuses = {429, 500, 502, 503, 504}
+
+# Records of the latest fetches (url, status, bytes, latency, throughput...)
+fetch_log = collections.deque(maxlen=100)
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=8) -> requests.Session:
+    '''
+    Return the HTTP session shared by all the downloads, so that connections to a host are pooled and reused
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+def _fetch_once(url, path, headers, params, timeout, chunk_size) -> dict:
+    start = time.perf_counter()
+    with get_session().get(url, headers=headers, params=params, stream=True, timeout=timeout) as response:
+        record = {'url': url, 'status': response.status_code, 'latency': time.perf_counter() - start,
+                  'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        if response.status_code == 304:
+            return record
+        response.raise_for_status()
         
+        # Stream the body in chunks, to disk when a path is given, hashing it on the way
+        sha256, size, chunks = hashlib.sha256(), 0, []
+        file = open(path + '.part', 'wb') if path else None
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                sha256.update(chunk)
+                size += len(chunk)
+                if file:
+                    file.write(chunk)
+                else:
+                    chunks.append(chunk)
+        finally:
+            if file:
+                file.close()
+        
+        record.update(sha256=sha256.hexdigest(), size=size, duration=time.perf_counter() - start)
+        if not path:
+            record['content'] = b''.join(chunks)
+        return record
+
+async def fetch(url, path=None, headers=None, params=None, expected_sha256=None, timeout=(10, 60), 
+                retries=3, backoff=1.0, chunk_size=1 << 16) -> dict:
+    '''
+    Fetch a URL through the shared connection pool, streaming the body to path (or into the record's 'content'
+    when no path is given). Request errors such as connection errors, timeouts and truncated bodies, retryable 
+    statuses and checksum mismatches are retried with exponential backoff. Returns the fetch record, 
+    which is also appended to the fetch_log
+    '''
+    loop = asyncio.get_event_loop()
     try:
-        urllib.request.urlretrieve(download_url, location)
-    except Exception as e:
-        raise Exception(e)
+        for attempt in range(retries + 1):
+            try:
+                record = await loop.run_in_executor(None, functools.partial(_fetch_once, url, path, headers, params, 
+                                                                            timeout, chunk_size))
+                if expected_sha256 is not None and record['status'] != 304 and record['sha256'] != expected_sha256:
+                    raise ChecksumError('Checksum mismatch for ' + url)
+                break
+            # Any request failure, including a body cut off mid-stream, and the errors writing the body are retried
+            except (requests.RequestException, OSError, ChecksumError) as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if attempt == retries or (isinstance(e, requests.HTTPError) and status not in retry_statuses):
+                    fetch_log.append({'url': url, 'status': status, 'error': str(e), 'attempts': attempt + 1})
+                    instrumentation.record_download(fetch_log[-1])
+                    raise
+                await asyncio.sleep(backoff * 2 ** attempt)
+        
+        if path and record['status'] != 304:
+            os.replace(path + '.part', path)
+    finally:
+        # Left over by a failed attempt, a successful one has been moved into place
+        if path and os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+    record['attempts'] = attempt + 1
+    record['fetched_at'] = time.time()
+    if record.get('duration'):
+        record['throughput'] = record['size'] / record['duration']
+    fetch_log.append({k: v for k, v in record.items() if k != 'content'})
+    instrumentation.record_download(fetch_log[-1])
+    if record['status'] != 304:
+        print('Fetched {} ({} bytes, latency {:.2f}s, {:.1f} KB/s, {} attempt(s))'.format(
+            url, record['size'], record['latency'], record.get('throughput', 0) / 1024, record['attempts']))
+    return record
+
+async def fetch_all(requests_list, concurrency=4) -> list:
+    '''
+    Run several fetches concurrently, at most concurrency at a time. Each request is a dict of fetch() arguments.
+    The results keep the order of the requests, failed fetches being returned as their exception
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    async def bounded_fetch(request):
+        async with semaphore:
+            return await fetch(**request)
+    return await asyncio.gather(*[bounded_fetch(request) for request in requests_list], return_exceptions=True)
+
+def download_files(requests_list, concurrency=4) -> list:
+    return asyncio.run(fetch_all(requests_list, concurrency=concurrency))
+
+class SocrataClient:
+    '''
+    Minimal client of the Socrata SODA API, fetching through the shared download layer.
+    get() takes the same arguments as sodapy's, the SoQL clauses being passed as keyword arguments
+    '''
+    def __init__(self, domain, app_token=None, timeout=(10, 60), retries=3):
+        self.base_url = 'https://' + domain + '/resource/'
+        self.headers = {'Accept': 'application/json'}
+        if app_token:
+            self.headers['X-App-Token'] = app_token
+        self.timeout = timeout
+        self.retries = retries
+
+    def get(self, dataset_identifier, **kwargs) -> list:
+        params = {'$' + key: value for key, value in kwargs.items() if value is not None}
+        record = asyncio.run(fetch(self.base_url + dataset_identifier + '.json', headers=self.headers, params=params,
+                                   timeout=self.timeout, retries=self.retries))
+        return json.loads(record['content'])
+
+def conditional_download(url, path, previous=None) -> dict:
+    '''
+    Download a file unless the server reports it unchanged since the previous fetch (ETag / Last-Modified).
+    The content is streamed to disk and hashed on the way. Returns the fetch metadata, whose 'changed' 
+    entry tells whether the content on disk differs from the previous fetch
+    '''
+    headers = {}
+    if previous is not None and os.path.exists(path):
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+    
+    record = asyncio.run(fetch(url, path=path, headers=headers))
+    if record['status'] == 304:
+        return dict(previous, fetched_at=record['fetched_at'], changed=False)
+    return {'url': url,
+            'etag': record['etag'],
+            'last_modified': record['last_modified'],
+            'sha256': record['sha256'],
+            'size': record['size'],
+            'fetched_at': record['fetched_at'],
+            'changed': previous is None or previous.get('sha256') != record['sha256']}
+
+def hash_inputs(inputs) -> str:
+    '''
+    Hash a JSON-serializable description of a build's inputs (file hashes, parameters) into a single key
+    '''
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def get_brotli_quality(size) -> int:
+    return BROTLI_LARGE_QUALITY if size >= BROTLI_LARGE_SIZE else BROTLI_QUALITY
+
+def compress_variants(data, quality=None) -> dict:
+    '''
+    Return the precompressed variants of a page as a {content encoding: bytes} dictionary.
+    The brotli quality defaults to the one for the size of the data
+    '''
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=get_brotli_quality(len(data)) if quality is None else quality)
+    return variants
+
+def compress_file(path, variant_paths, chunk_size=1 << 20, quality=None) -> dict:
+    '''
+    Write the precompressed variants of a file, given as {content encoding: path}, a chunk at a time.
+    The brotli quality defaults to the one for the size of the file. Returns the {content encoding: path} 
+    of the variants written
+    '''
+    written = {}
+    with open(path, 'rb') as source, open(variant_paths['gzip'], 'wb') as target:
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=target, mtime=0) as compressed:
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                compressed.write(chunk)
+    written['gzip'] = variant_paths['gzip']
+
+    if brotli is not None and 'br' in variant_paths:
+        compressor = brotli.Compressor(quality=get_brotli_quality(os.path.getsize(path)) if quality is None else quality)
+        with open(path, 'rb') as source, open(variant_paths['br'], 'wb') as target:
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                target.write(compressor.process(chunk))
+            target.write(compressor.finish())
+        written['br'] = variant_paths['br']
+    return written
+
+def file_fingerprint(path, previous=None) -> dict:
+    '''
+    Return the mtime, size and sha256 of a file. The hash is reused from the previous 
+    fingerprint when neither the mtime nor the size changed, so unchanged files are not re-read
+    '''
+    stat = os.stat(path)
+    if previous is not None and previous.get('mtime') == stat.st_mtime and previous.get('size') == stat.st_size:
+        return dict(previous)
+    
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(chunk)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': sha256.hexdigest()}
     
 def create_legend(caption=None, legend_labels=None) -> str:
     file = open(os.path.join(script_dir_path, 'legend_template.txt'), 'r')
@@ -60,4 +283,178 @@ def create_legend(caption=None, legend_labels=None) -> str:
             label_index += 1
     
     separator = ''
-    return separator.join(lines)         
\ No newline at end of file
+    return separator.join(lines)         
+
+def _natural_breaks(values, k, max_sample=1000) -> list:
+    '''
+    Jenks natural breaks through Fisher's dynamic programming over sorted values. Large inputs 
+    are reduced to evenly spaced order statistics first, which keeps the cost at O(k * max_sample^2)
+    '''
+    values = np.sort(values)
+    if len(values) == 0:
+        # Like the other schemes, an all-NaN sample gets NaN edges
+        return [np.nan] * (k + 1)
+    if len(values) > max_sample:
+        values = values[np.linspace(0, len(values) - 1, max_sample).round().astype(int)]
+    n = len(values)
+    classes = min(k, n)
+    
+    # ssd[i, j] is the sum of squared deviations of values[i:j]
+    s1 = np.concatenate([[0.], np.cumsum(values)])
+    s2 = np.concatenate([[0.], np.cumsum(values ** 2)])
+    count = np.arange(n + 1)[None, :] - np.arange(n + 1)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssd = s2[None, :] - s2[:, None] - (s1[None, :] - s1[:, None]) ** 2 / count
+    ssd[count <= 0] = np.inf
+    
+    cost = ssd[0].copy()
+    starts = []
+    for _ in range(1, classes):
+        total = cost[:, None] + ssd
+        starts.append(np.argmin(total, axis=0))
+        cost = total[starts[-1], np.arange(n + 1)]
+    
+    # Backtrack the class boundaries, each break being the top value of a class
+    breaks, end = [], n
+    for start in reversed(starts):
+        end = start[end]
+        breaks.insert(0, values[end - 1])
+    edges = [values[0]] + breaks + [values[-1]]
+    return edges + [values[-1]] * (k + 1 - len(edges))
+
+def classify_bins(values, k, scheme='geometric', per_column=False) -> np.ndarray:
+    '''
+    Compute the k+1 class edges of the values, ignoring NaNs. Supported schemes are 'geometric',
+    'quantile', 'equal_interval' and 'natural_breaks'. With per_column the edges are computed 
+    separately for every column of a 2D input and an (columns, k+1) array is returned
+    '''
+    values = np.asarray(values, dtype=float)
+    if per_column:
+        values = values.reshape(len(values), -1)
+        axis = 0
+    else:
+        values = values.ravel()
+        axis = None
+    
+    vmin, vmax = np.nanmin(values, axis=axis), np.nanmax(values, axis=axis)
+    if scheme == 'geometric':
+        # Work-around for geometric space not accepting zeros in the sequence
+        edges = np.geomspace(np.maximum(vmin, 1), vmax, k + 1)
+        edges[0] = vmin
+    elif scheme == 'quantile':
+        edges = np.nanquantile(values, np.linspace(0, 1, k + 1), axis=axis)
+    elif scheme == 'equal_interval':
+        edges = np.linspace(vmin, vmax, k + 1)
+    elif scheme == 'natural_breaks':
+        columns = values.T if per_column else [values]
+        edges = np.array([_natural_breaks(column[~np.isnan(column)], k) for column in columns]).T
+    else:
+        raise ValueError('Unknown classification scheme: ' + str(scheme))
+    
+    edges = np.asarray(edges, dtype=float)
+    return edges.T if per_column else edges.ravel()
+
+def classify(values, edges) -> np.ndarray:
+    '''
+    Assign every value to a class in one vectorized pass. Index 0 is reserved for missing data and 
+    classes 1..k follow the edges, intervals being closed on the right. The edges are either shared 
+    (k+1,) or given per column (columns, k+1). Returns a uint8 color index matrix of the input's shape
+    '''
+    values = np.asarray(values, dtype=float)
+    edges = np.asarray(edges, dtype=float)
+    inner_edges = edges[..., 1:-1]
+    
+    if edges.ndim == 1:
+        color_index = np.searchsorted(inner_edges, values, side='left') + 1
+    else:
+        color_index = (values[..., None] > inner_edges).sum(axis=-1) + 1
+    color_index[np.isnan(values)] = 0
+    return color_index.astype(np.uint8)
+
+def create_legend_labels(edges, colors, decimals=2, unit='', no_data_label='No data') -> dict:
+    '''
+    Create the {color: label} legend dictionary for the classes computed by classify. The first color
+    is reserved for missing data, the last class is labeled as open-ended
+    '''
+    def format_value(value):
+        value = int(round(value)) if decimals == 0 else round(value, decimals)
+        return str(value) + unit
+    
+    legend_labels = {colors[0]: no_data_label}
+    for i in range(1, len(colors) - 1):
+        legend_labels[colors[i]] = format_value(edges[i-1]) + ' - ' + format_value(edges[i])
+    legend_labels[colors[-1]] = '> ' + format_value(edges[len(colors) - 2])
+    return legend_labels
+
+def to_unix_timestamps(dates) -> np.ndarray:
+    '''
+    Convert dates (strings, datetime64 or datetime objects) to integer unix timestamps in seconds
+    '''
+    return np.asarray(dates, dtype='datetime64[s]').astype(np.int64)
+
+def create_styledict(color_index, colors, timestamps, feature_ids, opacity=0.7, delta=False) -> dict:
+    '''
+    Build the TimeSliderChoropleth styledict straight from a (features x time steps) color index matrix.
+    The timestamp keys are formatted once and every color shares a single style dict. In delta mode a
+    feature only gets an entry at the first time step and whenever its color class changes
+    '''
+    color_index = np.asarray(color_index)
+    timestamp_keys = np.array([str(timestamp) for timestamp in timestamps], dtype=object)
+    styles = np.empty(len(colors), dtype=object)
+    styles[:] = [{'color': color, 'opacity': opacity} for color in colors]
+    style_matrix = styles[color_index]
+    
+    if delta:
+        changed = np.ones(color_index.shape, dtype=bool)
+        changed[:, 1:] = color_index[:, 1:] != color_index[:, :-1]
+    
+    styledict = {}
+    for i, feature_id in enumerate(feature_ids):
+        if delta:
+            columns = np.flatnonzero(changed[i])
+            styledict[str(feature_id)] = dict(zip(timestamp_keys[columns], style_matrix[i, columns]))
+        else:
+            styledict[str(feature_id)] = dict(zip(timestamp_keys, style_matrix[i]))
+    return styledict
+
+def aggregate_points(latitudes, longitudes, frames, cell_size, shape='square', alphas=None) -> tuple:
+    '''
+    Snap points to a grid of square or hex cells of roughly cell_size degrees and aggregate them per (frame, cell).
+    Every occupied cell yields the alpha-weighted mean position of its points and a weight equal to the points' 
+    per-point alphas (default 1) composited on top of each other, so the result stays within [0, 1] like the raw 
+    points drawn by the heatmap. Returns (frames, latitudes, longitudes, weights) sorted by frame
+    '''
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    frames = np.asarray(frames, dtype=np.int64)
+    alphas = np.ones(len(latitudes)) if alphas is None else np.clip(np.asarray(alphas, dtype=np.float64), 1e-9, 1 - 1e-9)
+    
+    # Planar coordinates in cell units, with the longitudes shrunk so that cells are about square on the ground
+    x = longitudes * np.cos(np.radians(np.mean(latitudes))) / cell_size if len(latitudes) else longitudes
+    y = latitudes / cell_size
+    if shape == 'square':
+        cell_x, cell_y = np.floor(x), np.floor(y)
+    elif shape == 'hex':
+        # Hexagons as the nearest centre of two interleaved rectangular lattices
+        sqrt3 = np.sqrt(3)
+        x1, y1 = np.round(x), np.round(y / sqrt3)
+        x2, y2 = np.floor(x), np.floor(y / sqrt3)
+        first = (x - x1) ** 2 + (y - y1 * sqrt3) ** 2 <= (x - x2 - 0.5) ** 2 + (y - (y2 + 0.5) * sqrt3) ** 2
+        cell_x = np.where(first, 2 * x1, 2 * x2 + 1)
+        cell_y = np.where(first, 2 * y1, 2 * y2 + 1)
+    else:
+        raise ValueError('Unknown cell shape: ' + str(shape))
+    
+    # One integer key per (frame, cell), ordered by frame first
+    cell_x = (cell_x - cell_x.min(initial=0)).astype(np.int64)
+    cell_y = (cell_y - cell_y.min(initial=0)).astype(np.int64)
+    width, height = cell_x.max(initial=0) + 1, cell_y.max(initial=0) + 1
+    keys = (frames * height + cell_y) * width + cell_x
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    
+    alpha_sums = np.bincount(inverse, weights=alphas)
+    cell_latitudes = np.bincount(inverse, weights=latitudes * alphas) / alpha_sums
+    cell_longitudes = np.bincount(inverse, weights=longitudes * alphas) / alpha_sums
+    weights = 1 - np.exp(np.bincount(inverse, weights=np.log1p(-alphas))) if alphas.max(initial=0) < 1 else np.ones(len(unique_keys))
+    return unique_keys // (width * height), cell_latitudes, cell_longitudes, weights
@@ -1,33 +1,54 @@
-from flask import Flask, render_template
+import os
+from flask import Flask
 from flask_apscheduler import APScheduler
+from artifacts import ArtifactStore, ResourceStore
+from monitoring import RequestMetrics, metrics_response
 import jobs
+import worker
 
 app = Flask(__name__)
 scheduler = APScheduler()
+artifacts = ArtifactStore(os.path.join(app.root_path, 'templates'))
+resources = ResourceStore()
+request_metrics = RequestMetrics(app)
+
+# The builds run in the worker processes; the web process only enqueues them and serves
+# the new versions, which the artifact store notices by their live version pointers
+build_queue = worker.JobQueue()
 
 @app.route('/')
 def index():
     return 'Hello, World!'
 
+@app.route('/metrics')
+def get_metrics():
+    return metrics_response(request_metrics)
+
 @app.route('/covid-19-viz/')
 def get_covid_viz():
-    return render_template('COVID-19_viz.html')
+    return artifacts.serve('COVID-19_viz.html')
 
 @app.route('/gdp-viz/')
 def get_gdp_viz():
-    return render_template('GDP_viz.html')
+    return artifacts.serve('GDP_viz.html')
 
 @app.route('/sf-crime-viz/')
 def get_crime_viz():
-    return render_template('SF_crime_viz.html')
+    return artifacts.serve('SF_crime_viz.html')
 
 @app.route('/uk-accidents-viz/')
 def get_accidents_viz():
-    return render_template('UK_accidents_viz.html')
+    return artifacts.serve('UK_accidents_viz.html')
+
+@app.route('/resources/<name>')
+def get_resource(name):
+    return resources.serve(name)
 
 if __name__ == '__main__':
-    jobs.create_all()
-    scheduler.add_job(id='Covid-19 data update', func=jobs.covid_update, trigger='cron', hour=6, minute=30)
-    scheduler.add_job(id='SF crime data update', func=jobs.sf_crime_update, trigger='cron', hour=19, minute=15)
+    worker.start_worker_process(workers=min(len(jobs.pipelines), os.cpu_count() or 1))
+    for pipeline in jobs.pipelines:
+        build_queue.enqueue(pipeline)
+    scheduler.add_job(id='Covid-19 data update', func=build_queue.enqueue, args=['covid'], trigger='cron', hour=6, minute=30)
+    scheduler.add_job(id='SF crime data update', func=build_queue.enqueue, args=['sf_crime'], trigger='cron', hour=19, minute=15)
     scheduler.start()
     app.run()
\ No newline at end of file
@@ -0,0 +1,129 @@
+import sys
+import os
+import hashlib
+import threading
+import mimetypes
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask import Response, request, abort
+
+script_dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir_path, '..', 'viz'))
+import utils
+import publish
+
+# Precompressed variant file extensions, in order of preference
+encoding_extensions = {'br': '.br', 'gzip': '.gz'}
+
+# Types of the artifacts which the mimetypes module doesn't know
+mimetypes.add_type('application/geo+json', '.geojson')
+mimetypes.add_type('application/json', '.topojson')
+
+class Artifact:
+    '''
+    In-memory copy of a generated page and its compressed variants
+    '''
+    def __init__(self, path, stamp):
+        self.stamp = stamp
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        with open(path, 'rb') as file:
+            identity = file.read()
+        self.mtime = os.stat(path).st_mtime
+        self.last_modified = datetime.fromtimestamp(stamp // 10**9, tz=timezone.utc)
+        self.variants = {'identity': identity}
+
+        # Use the variants produced by the build, compressing in memory only when they're missing or outdated
+        compressed = None
+        for encoding, extension in encoding_extensions.items():
+            variant_path = path + extension
+            if os.path.exists(variant_path) and os.stat(variant_path).st_mtime >= self.mtime:
+                with open(variant_path, 'rb') as file:
+                    self.variants[encoding] = file.read()
+            else:
+                compressed = compressed or utils.compress_variants(identity)
+                if encoding in compressed:
+                    self.variants[encoding] = compressed[encoding]
+
+        # Strong ETags have to differ between the encodings of the same page
+        digest = hashlib.sha256(identity).hexdigest()[:32]
+        self.etags = {encoding: digest + ('' if encoding == 'identity' else '-' + encoding) for encoding in self.variants}
+
+class ArtifactStore:
+    '''
+    Serves the published pages from memory, picking the best variant for the request's Accept-Encoding.
+    A page is read again only once a new version of it has been published (or rolled back to); pages 
+    which were never published are served from the fallback directory
+    '''
+    def __init__(self, fallback_directory):
+        self.fallback_directory = fallback_directory
+        self._artifacts = {}
+        self._lock = threading.Lock()
+
+    def _stamp(self, filename):
+        # The live version pointer is replaced on every publish, also by builds running in other processes
+        try:
+            return os.stat(os.path.join(publish.artifacts_dir_path, filename, 'current.json')).st_mtime_ns
+        except OSError:
+            return os.stat(os.path.join(self.fallback_directory, filename)).st_mtime_ns
+
+    def get(self, filename) -> Artifact:
+        stamp = self._stamp(filename)
+        artifact = self._artifacts.get(filename)
+        if artifact is None or artifact.stamp != stamp:
+            with self._lock:
+                path = publish.get_published_path(filename) or os.path.join(self.fallback_directory, filename)
+                artifact = Artifact(path, stamp)
+                self._artifacts[filename] = artifact
+        return artifact
+
+    def serve(self, filename) -> Response:
+        return _respond(self.get(filename), 'no-cache')
+
+class ResourceStore:
+    '''
+    Serves the immutable, content-addressed resources from memory. Their names change with their content,
+    so the browsers may cache them for good. Every build publishes new resources, so only the least recently
+    served ones over max_bytes (counting all their variants) are dropped from memory
+    '''
+    def __init__(self, max_bytes=128 * 2**20):
+        self.max_bytes = max_bytes
+        self._resources = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def serve(self, name) -> Response:
+        with self._lock:
+            resource = self._resources.get(name)
+            if resource is not None:
+                self._resources.move_to_end(name)
+        if resource is None:
+            path = publish.get_resource_path(name)
+            if path is None:
+                abort(404)
+            resource = Artifact(path, os.stat(path).st_mtime_ns)
+            with self._lock:
+                if name not in self._resources:
+                    self._resources[name] = resource
+                    self._bytes += _size(resource)
+                while self._bytes > self.max_bytes and len(self._resources) > 1:
+                    self._bytes -= _size(self._resources.popitem(last=False)[1])
+        return _respond(resource, 'public, max-age=31536000, immutable')
+
+def _size(artifact) -> int:
+    return sum(len(variant) for variant in artifact.variants.values())
+
+def _respond(artifact, cache_control) -> Response:
+    encoding = request.accept_encodings.best_match([encoding for encoding in encoding_extensions
+                                                    if encoding in artifact.variants])
+    encoding = encoding or 'identity'
+
+    response = Response(artifact.variants[encoding], mimetype=artifact.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(artifact.etags[encoding])
+    response.last_modified = artifact.last_modified
+
+    # Answers with 304 Not Modified when the request's validators match
+    return response.make_conditional(request)
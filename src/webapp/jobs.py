@@ -1,28 +1,83 @@
 import sys
 import os
+import time
+import importlib
 
 script_dir_path = os.path.dirname(os.path.realpath(__file__))
-sys.path.append(os.path.join(script_dir_path, '..', 'viz'))
-from covid_viz import download_covid_data, create_covid_viz
-from sf_crime_viz import download_sf_crime_data, create_sf_crime_viz
-from gdp_viz import create_gdp_viz
-from uk_accidents_viz import create_uk_accidents_viz
-
-def covid_update():
-    download_covid_data()
-    create_covid_viz()
-    
-def sf_crime_update():
-    download_sf_crime_data()
-    create_sf_crime_viz()
-
-def create_all():
-    download_covid_data()
-    create_covid_viz()
-    
-    download_sf_crime_data()
-    create_sf_crime_viz()
-    
-    create_gdp_viz()
-    
-    create_uk_accidents_viz()
\ No newline at end of file
+viz_dir_path = os.path.join(script_dir_path, '..', 'viz')
+sys.path.append(viz_dir_path)
+
+# Every pipeline is an optional download followed by the build that depends on it, as (module, download, build).
+# The viz modules are only imported by the processes running the pipelines, keeping pandas, geopandas 
+# and folium out of the web process
+pipelines = {
+    'covid': ('covid_viz', 'download_covid_data', 'create_covid_viz'),
+    'sf_crime': ('sf_crime_viz', 'download_sf_crime_data', 'create_sf_crime_viz'),
+    'gdp': ('gdp_viz', None, 'create_gdp_viz'),
+    'uk_accidents': ('uk_accidents_viz', None, 'create_uk_accidents_viz')
+}
+
+def get_pipeline(name) -> tuple:
+    '''
+    Return the (download, build) functions of a pipeline, download being None when it has none
+    '''
+    module_name, download, build = pipelines[name]
+    module = importlib.import_module(module_name)
+    return (getattr(module, download) if download is not None else None), getattr(module, build)
+
+def _run_pipeline(name) -> dict:
+    '''
+    Run the download of a pipeline, then its build. A failed download is reported as a failed pipeline,
+    but the build still runs from the data cached by the previous fetches
+    '''
+    report = {'status': 'ok'}
+    start = time.perf_counter()
+    try:
+        download, build = get_pipeline(name)
+        if download is not None:
+            try:
+                download()
+            except Exception as e:
+                report['status'] = 'failed'
+                report['download_error'] = repr(e)
+            report['download_time'] = time.perf_counter() - start
+        build_start = time.perf_counter()
+        build()
+        report['build_time'] = time.perf_counter() - build_start
+    except Exception as e:
+        report['status'] = 'failed'
+        report['error'] = repr(e)
+    report['wall_time'] = time.perf_counter() - start
+    return report
+
+def run_job(name) -> dict:
+    '''
+    Run a pipeline in the current process, which is how the build workers run their jobs.
+    Returns the report of the pipeline
+    '''
+    return _run_pipeline(name)
+
+def create_all(workers=None, poll_interval=1.0) -> dict:
+    '''
+    Build every pipeline through the job queue: a build job of every pipeline is enqueued and run by a
+    draining worker, then the jobs taken by another worker (the web server's) are waited for.
+    Returns a {pipeline: finished job} dictionary with the status and the report of every job
+    '''
+    import worker
+    queue = worker.JobQueue()
+    job_ids = {name: queue.enqueue(name) for name in pipelines}
+    worker.BuildWorker(queue, workers=workers or min(len(pipelines), os.cpu_count() or 1)).run(drain=True)
+    while True:
+        finished = {job['id']: job for job in queue.jobs('done') + queue.jobs('failed')}
+        if all(job_id in finished for job_id in job_ids.values()):
+            break
+        time.sleep(poll_interval)
+
+    jobs = {name: finished[job_id] for name, job_id in job_ids.items()}
+    for name, job in jobs.items():
+        errors = [job[key] for key in ('download_error', 'error') if key in job]
+        print('Pipeline {}: {}{}'.format(name, job['status'], ''.join(' - ' + error for error in errors)))
+    return jobs
+
+if __name__ == '__main__':
+    create_all()
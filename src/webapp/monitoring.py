@@ -0,0 +1,164 @@
+import sys
+import os
+import time
+import threading
+from flask import Response, request, g
+
+script_dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir_path, '..', 'viz'))
+import instrumentation
+import worker
+
+# Upper bounds of the request latency histogram buckets, in seconds
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+def _labels(**labels) -> str:
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+class RequestMetrics:
+    '''
+    Per route request counts, latency histograms and bytes served, exposed together with the
+    metrics of the latest build and download runs in the Prometheus text format
+    '''
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._latency = {}
+        self._bytes = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._start_timer)
+        app.after_request(self._observe)
+
+    def _start_timer(self):
+        g.request_start = time.perf_counter()
+
+    def _observe(self, response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        duration = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        sent = response.content_length or 0
+
+        with self._lock:
+            key = (route, response.status_code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            buckets, total, count = self._latency.get(route, ([0] * len(latency_buckets), 0.0, 0))
+            buckets = [n + (duration <= bound) for n, bound in zip(buckets, latency_buckets)]
+            self._latency[route] = (buckets, total + duration, count + 1)
+            self._bytes[route] = self._bytes.get(route, 0) + sent
+        return response
+
+    def lines(self) -> list:
+        lines = ['# HELP viz_http_requests_total Requests served, by route and status',
+                 '# TYPE viz_http_requests_total counter']
+        with self._lock:
+            for (route, status), count in sorted(self._requests.items()):
+                lines.append('viz_http_requests_total{} {}'.format(_labels(route=route, status=status), count))
+
+            lines += ['# HELP viz_http_request_duration_seconds Request latency, by route',
+                      '# TYPE viz_http_request_duration_seconds histogram']
+            for route, (buckets, total, count) in sorted(self._latency.items()):
+                for bound, n in zip(latency_buckets, buckets):
+                    lines.append('viz_http_request_duration_seconds_bucket{} {}'.format(_labels(route=route, le=bound), n))
+                lines.append('viz_http_request_duration_seconds_bucket{} {}'.format(_labels(route=route, le='+Inf'), count))
+                lines.append('viz_http_request_duration_seconds_sum{} {:.6f}'.format(_labels(route=route), total))
+                lines.append('viz_http_request_duration_seconds_count{} {}'.format(_labels(route=route), count))
+
+            lines += ['# HELP viz_http_response_bytes_total Response body bytes sent, by route',
+                      '# TYPE viz_http_response_bytes_total counter']
+            for route, sent in sorted(self._bytes.items()):
+                lines.append('viz_http_response_bytes_total{} {}'.format(_labels(route=route), sent))
+        return lines
+
+def _run_lines() -> list:
+    '''
+    Metrics of the stored build and download runs: totals over all the kept runs, and the
+    duration and memory of every stage and download of the latest run of each name
+    '''
+    latest = {}
+    totals = {}
+    for run in instrumentation.load_runs():
+        latest[run['name']] = run
+        count, duration, failed = totals.get(run['name'], (0, 0.0, 0))
+        totals[run['name']] = (count + 1, duration + run['duration'], failed + (run['status'] != 'ok'))
+
+    lines = ['# HELP viz_run_duration_seconds Duration of the kept runs', '# TYPE viz_run_duration_seconds summary']
+    for name, (count, duration, _) in sorted(totals.items()):
+        lines.append('viz_run_duration_seconds_sum{} {:.6f}'.format(_labels(run=name), duration))
+        lines.append('viz_run_duration_seconds_count{} {}'.format(_labels(run=name), count))
+    lines += ['# HELP viz_run_failures Failed runs among the kept runs', '# TYPE viz_run_failures gauge']
+    for name, (_, _, failed) in sorted(totals.items()):
+        lines.append('viz_run_failures{} {}'.format(_labels(run=name), failed))
+
+    gauges = [
+        ('viz_last_run_duration_seconds', 'Duration of the latest run', lambda run: run['duration']),
+        ('viz_last_run_timestamp_seconds', 'Start time of the latest run', lambda run: run['started_at']),
+        ('viz_last_run_success', 'Whether the latest run succeeded', lambda run: int(run['status'] == 'ok')),
+        ('viz_last_run_peak_rss_bytes', 'Peak resident memory of the process after the latest run', lambda run: run['peak_rss']),
+        ('viz_last_run_rss_delta_bytes', 'Resident memory change over the latest run', lambda run: run['rss_end'] - run['rss_start'])
+    ]
+    for metric, description, value in gauges:
+        lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} gauge'.format(metric)]
+        for name, run in sorted(latest.items()):
+            lines.append('{}{} {}'.format(metric, _labels(run=name), value(run)))
+
+    lines += ['# HELP viz_last_stage_duration_seconds Duration of the stages of the latest run',
+              '# TYPE viz_last_stage_duration_seconds gauge']
+    for name, run in sorted(latest.items()):
+        for stage in run['stages']:
+            labels = _labels(run=name, stage=stage['name'], cached=str(stage.get('cached', False)).lower())
+            lines.append('viz_last_stage_duration_seconds{} {:.6f}'.format(labels, stage['duration']))
+    lines += ['# HELP viz_last_stage_rss_delta_bytes Resident memory change over the stages of the latest run',
+              '# TYPE viz_last_stage_rss_delta_bytes gauge']
+    for name, run in sorted(latest.items()):
+        for stage in run['stages']:
+            lines.append('viz_last_stage_rss_delta_bytes{} {}'.format(_labels(run=name, stage=stage['name']),
+                                                                       stage['rss_end'] - stage['rss_start']))
+
+    downloads = [('viz_last_download_bytes', 'Bytes fetched by the downloads of the latest run', 'size'),
+                 ('viz_last_download_latency_seconds', 'Time to the response headers of the downloads of the latest run', 'latency'),
+                 ('viz_last_download_duration_seconds', 'Duration of the downloads of the latest run', 'duration'),
+                 ('viz_last_download_attempts', 'Attempts taken by the downloads of the latest run', 'attempts')]
+    for metric, description, field in downloads:
+        lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} gauge'.format(metric)]
+        for name, run in sorted(latest.items()):
+            for download in run['downloads']:
+                if download.get(field) is not None:
+                    lines.append('{}{} {}'.format(metric, _labels(run=name, url=download['url']), download[field]))
+    return lines
+
+def _queue_lines() -> list:
+    '''
+    Metrics of the build job queue: the jobs in every state and the latest finished job of every pipeline
+    '''
+    queue = worker.JobQueue()
+    lines = ['# HELP viz_build_jobs Build jobs in the queue, by state', '# TYPE viz_build_jobs gauge']
+    for state, count in queue.counts().items():
+        lines.append('viz_build_jobs{} {}'.format(_labels(state=state), count))
+
+    latest = {}
+    for job in queue.jobs('done') + queue.jobs('failed'):
+        if job['pipeline'] not in latest or job['finished_at'] > latest[job['pipeline']]['finished_at']:
+            latest[job['pipeline']] = job
+    gauges = [
+        ('viz_last_job_duration_seconds', 'Duration of the latest job of every pipeline', lambda job: job['finished_at'] - job['started_at']),
+        ('viz_last_job_wait_seconds', 'Time the latest job of every pipeline spent in the queue', lambda job: job['started_at'] - job['enqueued_at']),
+        ('viz_last_job_success', 'Whether the latest job of every pipeline succeeded', lambda job: int(job['status'] == 'ok')),
+        ('viz_last_job_peak_rss_bytes', 'Peak resident memory of the process of the latest job of every pipeline',
+         lambda job: int(job.get('peak_rss_mb', 0) * 2**20))
+    ]
+    for metric, description, value in gauges:
+        lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} gauge'.format(metric)]
+        for pipeline, job in sorted(latest.items()):
+            lines.append('{}{} {}'.format(metric, _labels(pipeline=pipeline), value(job)))
+    return lines
+
+def metrics_response(request_metrics) -> Response:
+    body = '\n'.join(request_metrics.lines() + _run_lines() + _queue_lines()) + '\n'
+    return Response(body, mimetype='text/plain; version=0.0.4')
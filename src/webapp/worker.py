@@ -0,0 +1,273 @@
+import sys
+import os
+import json
+import time
+import uuid
+import atexit
+import signal
+import argparse
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+script_dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir_path, '..', 'viz'))
+import utils
+
+queue_dir_path = os.path.join(utils.cache_dir_path, 'jobs')
+
+# Memory (resident, in MB) and time (in seconds) limits of a build job, per pipeline
+default_limits = {'memory_mb': 2048, 'time_limit': 30 * 60}
+job_limits = {
+    'uk_accidents': {'memory_mb': 4096, 'time_limit': 60 * 60}
+}
+
+# Number of finished jobs kept for inspection, per state
+KEEP_FINISHED = 50
+
+# Directories of the jobs, by state
+job_states = ['pending', 'running', 'done', 'failed']
+
+def get_limits(pipeline) -> dict:
+    return dict(default_limits, **job_limits.get(pipeline, {}))
+
+class JobQueue:
+    '''
+    Local queue of build jobs shared by the web process and the build workers, every job being a JSON file
+    which moves between the state directories. A move is an atomic rename, so a job is claimed by one worker only
+    '''
+    def __init__(self, directory=queue_dir_path):
+        self.directory = directory
+        for state in job_states:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def _path(self, state, job_id) -> str:
+        return os.path.join(self.directory, state, job_id + '.json')
+
+    def _write(self, state, job):
+        path = self._path(state, job['id'])
+        with open(path + '.tmp', 'w') as file:
+            json.dump(job, file)
+        os.replace(path + '.tmp', path)
+
+    def _read(self, state, job_id) -> dict:
+        try:
+            with open(self._path(state, job_id), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _ids(self, state) -> list:
+        # Ids start with the enqueue time, so the sorted ids are in the queue order
+        return sorted(name[:-len('.json')] for name in os.listdir(os.path.join(self.directory, state))
+                      if name.endswith('.json'))
+
+    def jobs(self, state) -> list:
+        return [job for job in (self._read(state, job_id) for job_id in self._ids(state)) if job is not None]
+
+    def counts(self) -> dict:
+        return {state: len(self._ids(state)) for state in job_states}
+
+    def enqueue(self, pipeline) -> str:
+        '''
+        Add a build job of the pipeline to the queue, unless one is pending already. Returns the job id
+        '''
+        for job in self.jobs('pending'):
+            if job['pipeline'] == pipeline:
+                return job['id']
+        job = {'id': datetime.utcnow().strftime('%Y%m%dT%H%M%S%f') + '-' + uuid.uuid4().hex[:8],
+               'pipeline': pipeline,
+               'enqueued_at': time.time()}
+        self._write('pending', job)
+        return job['id']
+
+    def claim(self, exclude=()) -> dict:
+        '''
+        Move the oldest pending job into the running state and return it, skipping the pipelines in exclude.
+        Returns None when there's nothing to run
+        '''
+        for job_id in self._ids('pending'):
+            job = self._read('pending', job_id)
+            if job is None or job['pipeline'] in exclude:
+                continue
+            try:
+                os.rename(self._path('pending', job_id), self._path('running', job_id))
+            except FileNotFoundError:
+                # Claimed meanwhile by another worker
+                continue
+            job['started_at'] = time.time()
+            self._write('running', job)
+            return job
+        return None
+
+    def finish(self, job, report):
+        job = dict(job, **report, finished_at=time.time())
+        state = 'done' if report.get('status') == 'ok' else 'failed'
+        self._write(state, job)
+        try:
+            os.remove(self._path('running', job['id']))
+        except OSError:
+            pass
+        for job_id in self._ids(state)[:-KEEP_FINISHED]:
+            try:
+                os.remove(self._path(state, job_id))
+            except OSError:
+                pass
+
+    def requeue(self, job):
+        job = {key: value for key, value in job.items() if key != 'started_at'}
+        self._write('pending', job)
+        try:
+            os.remove(self._path('running', job['id']))
+        except OSError:
+            pass
+
+    def requeue_running(self):
+        '''
+        Put back the jobs left running by a worker which didn't shut down cleanly
+        '''
+        for job in self.jobs('running'):
+            self.requeue(job)
+
+def _process_rss(pid) -> int:
+    try:
+        with open('/proc/{}/statm'.format(pid), 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _run_job(pipeline, memory_mb, connection):
+    '''
+    Entry point of a job's process. The data segment limit makes the large allocations fail with a
+    MemoryError once the job goes well over its memory limit, the worker kills it on its resident size anyway
+    '''
+    try:
+        import resource
+        limit = memory_mb * 2**20
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+    except (ImportError, ValueError, OSError, AttributeError):
+        pass
+    # The viz modules are imported here, in the job's own fresh process
+    import jobs
+    connection.send(jobs.run_job(pipeline))
+    connection.close()
+
+class BuildWorker:
+    '''
+    Runs the queued build jobs, every job in a fresh process of its own, so the memory of a build is
+    given back once it's done. Up to `workers` jobs run at once, at most one per pipeline; a job
+    over its time or memory limit is killed and reported as failed
+    '''
+    def __init__(self, queue=None, workers=1, poll_interval=0.5):
+        self.queue = queue or JobQueue()
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._context = multiprocessing.get_context('spawn')
+        self._running = {}
+        self._stopping = False
+
+    def _start(self, job):
+        limits = get_limits(job['pipeline'])
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_run_job, args=(job['pipeline'], limits['memory_mb'], sender),
+                                        name='build-' + job['pipeline'])
+        process.start()
+        sender.close()
+        self._running[job['id']] = {'job': job, 'process': process, 'receiver': receiver, 'limits': limits,
+                                    'deadline': time.time() + limits['time_limit'], 'peak_rss': 0}
+        print('Build job {} ({}) started in process {}'.format(job['id'], job['pipeline'], process.pid))
+
+    def _kill(self, process):
+        process.terminate()
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+
+    def _poll(self, entry) -> dict:
+        '''
+        Return the report of a finished job, None while it's still running within its limits
+        '''
+        process, limits = entry['process'], entry['limits']
+        rss = _process_rss(process.pid)
+        if rss is not None:
+            entry['peak_rss'] = max(entry['peak_rss'], rss)
+
+        if entry['receiver'].poll():
+            try:
+                return entry['receiver'].recv()
+            except EOFError:
+                pass
+        if not process.is_alive():
+            return {'status': 'failed', 'error': 'Build process exited with code {}'.format(process.exitcode)}
+        if time.time() > entry['deadline']:
+            self._kill(process)
+            return {'status': 'failed', 'error': 'Killed after the time limit of {}s'.format(limits['time_limit'])}
+        if rss is not None and rss > limits['memory_mb'] * 2**20:
+            self._kill(process)
+            return {'status': 'failed', 'error': 'Killed over the memory limit of {}MB'.format(limits['memory_mb'])}
+        return None
+
+    def _check(self):
+        for job_id, entry in list(self._running.items()):
+            report = self._poll(entry)
+            if report is None:
+                continue
+            entry['process'].join(5)
+            entry['receiver'].close()
+            del self._running[job_id]
+            report['peak_rss_mb'] = round(entry['peak_rss'] / 2**20, 1)
+            self.queue.finish(entry['job'], report)
+            errors = [report[key] for key in ('download_error', 'error') if key in report]
+            print('Build job {} ({}): {}{}'.format(job_id, entry['job']['pipeline'], report['status'],
+                                                  ''.join(' - ' + error for error in errors)))
+
+    def _fill(self):
+        while len(self._running) < self.workers:
+            job = self.queue.claim(exclude={entry['job']['pipeline'] for entry in self._running.values()})
+            if job is None:
+                break
+            self._start(job)
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def run(self, drain=False):
+        '''
+        Run the queued jobs until stopped, or with drain only until the queue is empty.
+        The jobs interrupted by a stop are put back into the queue
+        '''
+        self.queue.requeue_running()
+        try:
+            while not self._stopping:
+                self._check()
+                self._fill()
+                if drain and not self._running:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            for entry in self._running.values():
+                self._kill(entry['process'])
+                self.queue.requeue(entry['job'])
+            self._running.clear()
+
+def start_worker_process(workers=1) -> subprocess.Popen:
+    '''
+    Start a build worker next to the web server, stopped together with it
+    '''
+    process = subprocess.Popen([sys.executable, os.path.realpath(__file__), '--workers', str(workers)])
+    atexit.register(process.terminate)
+    return process
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the queued build jobs')
+    parser.add_argument('--workers', type=int, default=1, help='number of jobs run at once')
+    parser.add_argument('--drain', action='store_true', help='exit once the queue is empty')
+    parser.add_argument('--enqueue', nargs='*', default=[], help='pipelines to enqueue first')
+    args = parser.parse_args()
+
+    worker = BuildWorker(workers=args.workers)
+    for pipeline in args.enqueue:
+        worker.queue.enqueue(pipeline)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run(drain=args.drain)
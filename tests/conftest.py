@@ -0,0 +1,24 @@
+import os
+import sys
+import threading
+import http.server
+import pytest
+
+tests_dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(tests_dir_path, '..', 'src', 'viz'))
+
+@pytest.fixture
+def serve():
+    '''
+    Start a local HTTP server with the given request handler class, returning its base URL
+    '''
+    servers = []
+    def start(handler_class):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_port)
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,159 @@
+import http.server
+import requests
+import utils
+
+class VersionedHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves one file which answers the conditional requests matching its current version with a 304
+    '''
+    content = b'Country_Region,Confirmed\nPoland,1\n'
+    etag = '"v1"'
+    last_modified = 'Fri, 27 Nov 2020 06:00:00 GMT'
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', self.last_modified)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+def versioned_handler(**attributes):
+    return type('Handler', (VersionedHandler,), dict(attributes, requests=[]))
+
+def test_conditional_download_first_fetch(serve, tmp_path):
+    handler = versioned_handler()
+    path = str(tmp_path / 'covid.csv')
+    record = utils.conditional_download(serve(handler) + '/covid.csv', path)
+
+    assert record['changed']
+    assert record['etag'] == '"v1"'
+    assert record['last_modified'] == VersionedHandler.last_modified
+    assert record['size'] == len(VersionedHandler.content)
+    assert open(path, 'rb').read() == VersionedHandler.content
+    assert 'If-None-Match' not in handler.requests[0]
+
+def test_conditional_download_not_modified(serve, tmp_path):
+    handler = versioned_handler()
+    url, path = serve(handler) + '/covid.csv', str(tmp_path / 'covid.csv')
+    previous = utils.conditional_download(url, path)
+    record = utils.conditional_download(url, path, previous)
+
+    assert handler.requests[1]['If-None-Match'] == '"v1"'
+    assert handler.requests[1]['If-Modified-Since'] == VersionedHandler.last_modified
+    assert not record['changed']
+    assert record['sha256'] == previous['sha256']
+    assert record['fetched_at'] >= previous['fetched_at']
+    assert open(path, 'rb').read() == VersionedHandler.content
+
+def test_conditional_download_changed(serve, tmp_path):
+    path = str(tmp_path / 'covid.csv')
+    previous = utils.conditional_download(serve(versioned_handler()) + '/covid.csv', path)
+    content = b'Country_Region,Confirmed\nPoland,2\n'
+    record = utils.conditional_download(serve(versioned_handler(content=content, etag='"v2"')) + '/covid.csv', 
+                                        path, previous)
+
+    assert record['changed']
+    assert record['etag'] == '"v2"'
+    assert open(path, 'rb').read() == content
+
+def test_conditional_download_new_etag_same_content(serve, tmp_path):
+    path = str(tmp_path / 'covid.csv')
+    previous = utils.conditional_download(serve(versioned_handler()) + '/covid.csv', path)
+    record = utils.conditional_download(serve(versioned_handler(etag='"v2"')) + '/covid.csv', path, previous)
+
+    assert not record['changed']
+    assert record['etag'] == '"v2"'
+
+def test_conditional_download_missing_file_is_fetched(serve, tmp_path):
+    handler = versioned_handler()
+    url, path = serve(handler) + '/covid.csv', str(tmp_path / 'covid.csv')
+    previous = utils.conditional_download(url, path)
+    (tmp_path / 'covid.csv').unlink()
+    record = utils.conditional_download(url, path, previous)
+
+    assert 'If-None-Match' not in handler.requests[1]
+    assert not record['changed']
+    assert open(path, 'rb').read() == VersionedHandler.content
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Cuts the body of the first responses short, announcing more bytes than it sends
+    '''
+    content = b'x' * 100000
+    truncated = 1
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        body = self.content[:1000] if type(self).requests <= self.truncated else self.content
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+def flaky_handler(**attributes):
+    return type('Handler', (FlakyHandler,), dict(attributes, requests=0))
+
+def test_fetch_retries_a_truncated_body(serve, tmp_path):
+    handler = flaky_handler()
+    path = str(tmp_path / 'data.bin')
+    record = utils.download_files([{'url': serve(handler) + '/data.bin', 'path': path, 'backoff': 0}])[0]
+
+    assert record['attempts'] == 2
+    assert record['size'] == len(FlakyHandler.content)
+    assert open(path, 'rb').read() == FlakyHandler.content
+    assert list(tmp_path.iterdir()) == [tmp_path / 'data.bin']
+
+def test_fetch_gives_up_without_leaving_a_partial_file(serve, tmp_path):
+    handler = flaky_handler(truncated=10)
+    path = str(tmp_path / 'data.bin')
+    result = utils.download_files([{'url': serve(handler) + '/data.bin', 'path': path, 'retries': 2, 'backoff': 0}])[0]
+
+    assert isinstance(result, Exception)
+    assert handler.requests == 3
+    assert list(tmp_path.iterdir()) == []
+
+def test_checksum_mismatch_raises_download_error(serve, tmp_path):
+    handler = versioned_handler()
+    path = str(tmp_path / 'covid.csv')
+    result = utils.download_files([{'url': serve(handler) + '/covid.csv', 'path': path, 'expected_sha256': '0' * 64,
+                                    'retries': 1, 'backoff': 0}])[0]
+
+    assert isinstance(result, utils.DownloadError)
+    assert len(handler.requests) == 2
+    assert list(tmp_path.iterdir()) == []
+
+def test_client_errors_are_not_retried(serve, tmp_path):
+    class NotFoundHandler(VersionedHandler):
+        requests = []
+        def do_GET(self):
+            type(self).requests.append(dict(self.headers))
+            self.send_error(404)
+
+    result = utils.download_files([{'url': serve(NotFoundHandler) + '/missing.csv', 'path': str(tmp_path / 'missing.csv'),
+                                    'backoff': 0}])[0]
+
+    assert isinstance(result, requests.HTTPError)
+    assert len(NotFoundHandler.requests) == 1
+    assert list(tmp_path.iterdir()) == []
+
+def test_download_files_keeps_the_order(serve, tmp_path):
+    content = b'Country_Region,Confirmed\nPoland,2\n'
+    urls = [serve(versioned_handler()) + '/a.csv', serve(versioned_handler(content=content)) + '/b.csv']
+    results = utils.download_files([{'url': url} for url in urls], concurrency=2)
+
+    assert [result['content'] for result in results] == [VersionedHandler.content, content]
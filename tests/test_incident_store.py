@@ -0,0 +1,86 @@
+import sys
+import types
+import pytest
+import instrumentation
+import utils
+from incident_store import IncidentStore
+
+# The Socrata app token lives in the untracked config module, the fake client doesn't need it
+try:
+    import config
+except ImportError:
+    sys.modules['config'] = types.SimpleNamespace(sf_data_token=None)
+import sf_crime_viz
+
+def incident(row_id, updated_at, category='Larceny Theft', date='2020-11-20'):
+    return {'row_id': row_id, ':updated_at': updated_at, 'incident_category': category,
+            'incident_date': date + 'T00:00:00.000', 'incident_datetime': date + 'T12:00:00.000',
+            'latitude': '37.77', 'longitude': '-122.42'}
+
+class FakeClient:
+    '''
+    Answers the queries with the given records, a page at a time
+    '''
+    def __init__(self, records, error=None):
+        self.records = records
+        self.error = error
+        self.calls = []
+
+    def get(self, dataset_identifier, **kwargs):
+        self.calls.append(kwargs)
+        if self.error:
+            raise self.error
+        return self.records[kwargs['offset']:kwargs['offset'] + kwargs['limit']]
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = IncidentStore(str(tmp_path / 'store'))
+    monkeypatch.setattr(sf_crime_viz, 'get_incident_store', lambda: store)
+    monkeypatch.setattr(instrumentation, 'runs_dir_path', str(tmp_path / 'runs'))
+    return store
+
+def test_first_download_sets_the_high_water_mark(store):
+    client = FakeClient([incident('1', '2020-11-20T10:00:00.000'), incident('2', '2020-11-21T10:00:00.000')])
+    sf_crime_viz.download_sf_crime_data(client)
+
+    assert client.calls[0]['where'].startswith('incident_date between')
+    assert sorted(store.load()['row_id']) == ['1', '2']
+    assert store.high_water_mark() == '2020-11-21T10:00:00.000'
+
+def test_download_upserts_by_row_id(store):
+    sf_crime_viz.download_sf_crime_data(FakeClient([incident('1', '2020-11-20T10:00:00.000'),
+                                                    incident('2', '2020-11-21T10:00:00.000')]))
+    client = FakeClient([incident('2', '2020-11-21T10:00:00.000'),
+                         incident('1', '2020-11-22T08:00:00.000', category='Robbery'),
+                         incident('3', '2020-11-22T09:00:00.000')])
+    sf_crime_viz.download_sf_crime_data(client)
+
+    assert client.calls[0]['where'] == ':updated_at >= \'2020-11-21T10:00:00.000\''
+    df = store.load().set_index('row_id')
+    assert sorted(df.index) == ['1', '2', '3']
+    assert df.loc['1', 'incident_category'] == 'Robbery'
+    assert store.high_water_mark() == '2020-11-22T09:00:00.000'
+
+def test_download_pages_through_the_results(store):
+    client = FakeClient([incident(str(i), '2020-11-2{}T10:00:00.000'.format(i)) for i in range(5)])
+    sf_crime_viz.download_sf_crime_data(client, page_size=2)
+
+    assert [call['offset'] for call in client.calls] == [0, 2, 4]
+    assert len(store.load()) == 5
+    assert store.high_water_mark() == '2020-11-24T10:00:00.000'
+
+def test_empty_download_keeps_the_high_water_mark(store):
+    sf_crime_viz.download_sf_crime_data(FakeClient([incident('1', '2020-11-20T10:00:00.000')]))
+    sf_crime_viz.download_sf_crime_data(FakeClient([]))
+
+    assert store.high_water_mark() == '2020-11-20T10:00:00.000'
+    assert len(store.load()) == 1
+
+def test_failed_download_leaves_the_store(store):
+    sf_crime_viz.download_sf_crime_data(FakeClient([incident('1', '2020-11-20T10:00:00.000')]))
+    fingerprint = store.fingerprint()
+    with pytest.raises(utils.DownloadError):
+        sf_crime_viz.download_sf_crime_data(FakeClient([], error=OSError('connection reset')))
+
+    assert store.fingerprint() == fingerprint
+    assert store.high_water_mark() == '2020-11-20T10:00:00.000'